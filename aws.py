@@ -17,24 +17,58 @@
 """A Tornado-based Amazon S3 client"""
 
 import base64
+import collections
 import email.utils
+import functools
 import hashlib
 import hmac
+import logging
 import mimetypes
+import random
 import re
+import sqlite3
+import threading
 import time
 import tornado.httpclient
+import tornado.ioloop
 import urllib
+import workers
 
 from tornado.options import define, options
 
 define("aws_access_key_id")
 define("aws_secret_access_key")
+define("aws_s3_endpoint",
+       help="Base URL of an S3-compatible server to use instead of Amazon's")
 
 
 class S3Client(object):
-    def __init__(self, bucket, access_key_id=None, secret_access_key=None):
+    """An asynchronous client for one Amazon S3 bucket.
+
+    We run at most max_in_flight requests at once and queue the rest. We
+    use curl when pycurl is installed, since it keeps connections to S3
+    alive between requests. Requests that fail with a 5xx status or a
+    network error are retried up to max_retries times with exponential
+    backoff. Objects larger than multipart_threshold bytes are uploaded
+    in parts of part_size bytes, which also run in parallel.
+
+    If endpoint is given, we send requests to it, with the bucket in the
+    path, rather than to Amazon. This is useful for testing against a
+    local S3 stand-in.
+
+    If known_hashes is given, it should be a HashIndex of the objects
+    already in the bucket, which put_cdn_content() uses to skip uploads.
+    If pool is given, as a workers.ThreadPool, we read and write the index
+    on it, so a busy index file never blocks the IOLoop.
+    """
+    def __init__(self, bucket, access_key_id=None, secret_access_key=None,
+                 endpoint=None, max_in_flight=10, max_retries=3,
+                 request_timeout=60, multipart_threshold=16 * 1024 * 1024,
+                 part_size=8 * 1024 * 1024, known_hashes=None, pool=None,
+                 io_loop=None):
         self.bucket = bucket
+        self.known_hashes = known_hashes
+        self.pool = pool
         if access_key_id is not None:
             self.access_key_id = access_key_id
             self.secret_access_key = secret_access_key
@@ -43,16 +77,52 @@ class S3Client(object):
             self.secret_access_key = options.aws_secret_access_key
         if isinstance(self.secret_access_key, unicode):
             self.secret_access_key = self.secret_access_key.encode("utf-8")
-        self.host = "http://" + bucket + ".s3.amazonaws.com"
+        endpoint = endpoint or options.aws_s3_endpoint
+        if endpoint:
+            self.host = endpoint.rstrip("/") + "/" + bucket
+        else:
+            self.host = "http://" + bucket + ".s3.amazonaws.com"
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.request_timeout = request_timeout
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self._http = _http_client(self.io_loop, max_in_flight)
+        self._queue = collections.deque()
+        self._in_flight = 0
+        if self.access_key_id:
+            # We copy this for each signature rather than rehashing the key
+            self._hmac = hmac.new(
+                self.secret_access_key, digestmod=hashlib.sha1)
 
     def put_object(self, key, body, callback, headers={}):
-        headers = self._default_headers(headers)
-        headers["Content-Length"] = len(body)
-        if self.access_key_id:
-            headers["Authorization"] = self._auth_header("PUT", key, headers)
-        http = tornado.httpclient.AsyncHTTPClient()
-        http.fetch(self.host + "/" + key, method="PUT", headers=headers,
-                   body=body, callback=callback)
+        if len(body) > self.multipart_threshold:
+            _MultipartUpload(self, key, body, callback, headers).start()
+        else:
+            self._fetch("PUT", key, callback, body=body, headers=headers)
+
+    def list_objects(self, callback, prefix="", marker=None):
+        """Lists the names of up to 1000 objects in the bucket.
+
+        We call callback with the names and the marker to pass to get the
+        next page, which is None on the last page. On error, we call
+        callback with None for both.
+        """
+        params = {"prefix": prefix}
+        if marker:
+            params["marker"] = marker
+
+        def on_list(response):
+            if response.error:
+                logging.error("Amazon S3 error: %r", response)
+                callback(None, None)
+                return
+            names = [_xml_unescape(n) for n in
+                     re.findall(r"<Key>([^<]*)</Key>", response.body)]
+            truncated = "<IsTruncated>true</IsTruncated>" in response.body
+            callback(names, names[-1] if truncated and names else None)
+        self._fetch("GET", "", on_list, params=params)
 
     def put_cdn_content(self, data, callback, file_name=None, mime_type=None):
         """Uploads the given data as an object optimized for CloudFront.
@@ -69,7 +139,10 @@ class S3Client(object):
         have a friendlier name upon download. If given, we also infer
         the mime type from the file name.
 
-        We return the hash we used as the object name.
+        We return the hash we used as the object name. If the hash is in
+        our known_hashes index, the object is already in the bucket, and
+        we return the hash without uploading anything. If the index is too
+        busy to answer, we ask S3 with a HEAD request instead.
         """
         # Infer the mime type and extension if not given
         if not mime_type and file_name:
@@ -88,7 +161,10 @@ class S3Client(object):
             "Vary": "Accept-Encoding",
             "x-amz-acl": "public-read",
         }
-        file_hash = hashlib.sha1(mime_type + "|" + data).hexdigest()
+        # Hash incrementally rather than copying data to prepend the type
+        file_hash = hashlib.sha1(mime_type + "|")
+        file_hash.update(data)
+        file_hash = file_hash.hexdigest()
 
         # Retain the file name for friendly downloading
         if file_name:
@@ -108,8 +184,102 @@ class S3Client(object):
                 logging.error("Amazon S3 error: %r", response)
                 callback(None)
             else:
+                self._add_known_hash(file_hash)
+                callback(file_hash)
+
+        def upload():
+            self.put_object(file_hash, data, callback=on_put, headers=headers)
+
+        def on_head(response):
+            if response.code == 200:
+                self._add_known_hash(file_hash)
+                callback(file_hash)
+            else:
+                upload()
+
+        def on_lookup(known):
+            if known:
                 callback(file_hash)
-        self.put_object(file_hash, data, callback=on_put, headers=headers)
+            elif known is None:
+                self._fetch("HEAD", file_hash, on_head)
+            else:
+                upload()
+
+        if self.known_hashes is None:
+            upload()
+        else:
+            self._on_pool(on_lookup, self.known_hashes.lookup, file_hash)
+
+    def _add_known_hash(self, file_hash):
+        if self.known_hashes is not None:
+            self._on_pool(lambda result: None, self.known_hashes.add,
+                          file_hash)
+
+    def _on_pool(self, callback, fn, *args):
+        """Calls fn on our pool, or right away if we don't have one.
+
+        If the pool is full, we call callback with None.
+        """
+        if self.pool is None:
+            callback(fn(*args))
+            return
+        try:
+            self.pool.submit(callback, fn, *args)
+        except workers.PoolFullError:
+            callback(None)
+
+    def _fetch(self, method, key, callback, body=None, headers={},
+               subresource="", params=None):
+        """Queues a signed request, calling callback with the response.
+
+        subresource is signed along with the key, while params are only
+        added to the URL.
+        """
+        self._queue.append(
+            (method, key, body, headers, subresource, params, callback, 0))
+        self._start_requests()
+
+    def _start_requests(self):
+        while self._queue and self._in_flight < self.max_in_flight:
+            request = self._queue.popleft()
+            method, key, body, custom_headers, subresource, params = \
+                request[:6]
+            headers = self._default_headers(custom_headers)
+            if body is not None:
+                headers["Content-Length"] = len(body)
+            if self.access_key_id:
+                headers["Authorization"] = self._auth_header(
+                    method, key, headers, subresource)
+            url = self.host + "/" + key
+            query = [subresource] if subresource else []
+            if params:
+                query.append(urllib.urlencode(params))
+            if query:
+                url += "?" + "&".join(query)
+            self._in_flight += 1
+            self._http.fetch(tornado.httpclient.HTTPRequest(
+                url, method=method, headers=headers, body=body,
+                request_timeout=self.request_timeout),
+                functools.partial(self._on_response, request))
+
+    def _on_response(self, request, response):
+        self._in_flight -= 1
+        attempts = request[7]
+        if (response.code >= 500 or response.code == 599) and \
+           attempts < self.max_retries:
+            delay = (2 ** attempts) * 0.1 * (1 + random.random())
+            logging.warning("Retrying S3 %s %s in %.2fs: %r", request[0],
+                            request[1], delay, response.error)
+            self.io_loop.add_timeout(
+                time.time() + delay, functools.partial(
+                    self._retry, request[:7] + (attempts + 1,)))
+        else:
+            request[6](response)
+        self._start_requests()
+
+    def _retry(self, request):
+        self._queue.append(request)
+        self._start_requests()
 
     def _default_headers(self, custom={}):
         headers = {
@@ -118,7 +288,7 @@ class S3Client(object):
         headers.update(custom)
         return headers
 
-    def _auth_header(self, method, key, headers):
+    def _auth_header(self, method, key, headers, subresource=""):
         special_headers = ("content-md5", "content-type", "date")
         signed_headers = dict((k, "") for k in special_headers)
         signed_headers.update(
@@ -133,7 +303,171 @@ class S3Client(object):
             else:
                 buffer += "%s\n" % signed_headers[header_key]
         buffer += "/%s" % self.bucket + "/%s" % urllib.quote_plus(key)
-        
-        signature = hmac.new(self.secret_access_key, buffer, hashlib.sha1)
+        if subresource:
+            buffer += "?" + subresource
+
+        signature = self._hmac.copy()
+        signature.update(buffer)
         return "AWS " + self.access_key_id + ":" + \
             base64.encodestring(signature.digest()).strip()
+
+
+class _MultipartUpload(object):
+    """Uploads an object to S3 in parts, calling callback when done.
+
+    We abort the upload if any part fails, so S3 does not keep the parts.
+    The callback gets the response to the final request, or to the first
+    request that failed.
+    """
+    def __init__(self, client, key, body, callback, headers):
+        self.client = client
+        self.key = key
+        self.body = body
+        self.callback = callback
+        self.headers = headers
+        self.upload_id = None
+        self.etags = {}
+        self.failed = False
+
+    def start(self):
+        self.client._fetch("POST", self.key, self._on_initiate, body="",
+                           headers=self.headers, subresource="uploads")
+
+    def _on_initiate(self, response):
+        match = re.search(r"<UploadId>([^<]+)</UploadId>", response.body or "")
+        if response.error or not match:
+            self.callback(response)
+            return
+        self.upload_id = match.group(1)
+        size = self.client.part_size
+        self.num_parts = (len(self.body) + size - 1) // size
+        for i in xrange(self.num_parts):
+            part_number = i + 1
+            self.client._fetch(
+                "PUT", self.key,
+                functools.partial(self._on_part, part_number),
+                body=self.body[i * size:(i + 1) * size],
+                subresource="partNumber=%d&uploadId=%s" %
+                    (part_number, self.upload_id))
+
+    def _on_part(self, part_number, response):
+        if self.failed:
+            return
+        if response.error:
+            self._abort(response)
+            return
+        self.etags[part_number] = response.headers.get("Etag", "")
+        if len(self.etags) < self.num_parts:
+            return
+        body = "<CompleteMultipartUpload>" + "".join(
+            "<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>" %
+            (n, self.etags[n]) for n in sorted(self.etags)) + \
+            "</CompleteMultipartUpload>"
+        self.client._fetch(
+            "POST", self.key, self._on_complete, body=body,
+            subresource="uploadId=" + self.upload_id)
+
+    def _on_complete(self, response):
+        # S3 can report an error in the body of a 200 response here
+        if response.error or "<Error>" in (response.body or ""):
+            self._abort(response)
+        else:
+            self.callback(response)
+
+    def _abort(self, response):
+        self.failed = True
+        logging.error("Aborting multipart upload of %s: %r", self.key,
+                      response)
+        self.client._fetch(
+            "DELETE", self.key, lambda r: None,
+            subresource="uploadId=" + self.upload_id)
+        if not response.error:
+            response.error = tornado.httpclient.HTTPError(
+                500, "Multipart upload failed")
+        self.callback(response)
+
+
+class HashIndex(object):
+    """A persistent set of the names of objects known to be in a bucket.
+
+    We keep the names in a SQLite file on local disk, so the index survives
+    restarts and all the server processes on a machine share it. Lookups
+    don't touch the network. The index only knows about objects we have
+    uploaded or added from a listing of the bucket, so it may be missing
+    objects but should never claim one that isn't there, as long as
+    nothing deletes objects from the bucket.
+
+    Each thread gets its own connection. We wait at most timeout seconds
+    for another process to release the file: lookup() then returns None,
+    and add() skips the names, which only costs a later upload.
+    """
+    def __init__(self, path, timeout=0.5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        db = self._connect()
+        db.execute("PRAGMA journal_mode = WAL")
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS objects "
+                "(name TEXT NOT NULL PRIMARY KEY)")
+
+    def __contains__(self, name):
+        return bool(self.lookup(name))
+
+    def __len__(self):
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM objects").fetchone()[0]
+
+    def lookup(self, name):
+        """Returns whether name is in the index, or None if the file is
+        locked.
+        """
+        try:
+            cursor = self._connect().execute(
+                "SELECT 1 FROM objects WHERE name = ?", (name,))
+            return cursor.fetchone() is not None
+        except sqlite3.OperationalError, e:
+            logging.warning("Could not read the CDN index: %s", e)
+            return None
+
+    def add(self, name):
+        self.add_many([name])
+
+    def add_many(self, names):
+        db = self._connect()
+        try:
+            with db:
+                db.executemany(
+                    "INSERT OR IGNORE INTO objects (name) VALUES (?)",
+                    [(name,) for name in names])
+        except sqlite3.OperationalError, e:
+            logging.warning("Could not add %d names to the CDN index: %s",
+                            len(names), e)
+
+    def _connect(self):
+        if not hasattr(self._local, "db"):
+            self._local.db = sqlite3.connect(self.path, timeout=self.timeout)
+            # With WAL, commits don't wait for the disk
+            self._local.db.execute("PRAGMA synchronous = NORMAL")
+        return self._local.db
+
+
+def _xml_unescape(value):
+    return value.replace("&lt;", "<").replace("&gt;", ">") \
+        .replace("&quot;", '"').replace("&apos;", "'").replace("&amp;", "&")
+
+
+def _http_client(io_loop, max_clients):
+    """Returns a dedicated AsyncHTTPClient, preferring one that uses curl.
+
+    curl keeps connections open between requests, so we don't pay for a
+    new connection to S3 for every upload.
+    """
+    try:
+        import tornado.curl_httpclient
+        impl = tornado.curl_httpclient.CurlAsyncHTTPClient
+    except ImportError:
+        import tornado.simple_httpclient
+        impl = tornado.simple_httpclient.SimpleAsyncHTTPClient
+    return impl(io_loop, max_clients=max_clients, force_instance=True)
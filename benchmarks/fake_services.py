@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Local stand-ins for the Facebook Graph API and S3, for load tests.
+
+Both answer the calls cookbook.py makes, after --latency milliseconds, so
+load tests measure our servers rather than Facebook's or Amazon's. S3
+objects are kept in memory. Point the servers at them with:
+
+    python benchmarks/fake_services.py
+    python cookbook.py --facebook_graph_url=http://localhost:9001/ \\
+        --aws_s3_endpoint=http://localhost:9002
+"""
+
+import hashlib
+import json
+import logging
+import re
+import time
+import tornado.httpserver
+import tornado.ioloop
+import tornado.options
+import tornado.web
+import urllib
+import uuid
+
+from tornado.options import define, options
+
+define("graph_port", type=int, default=9001)
+define("s3_port", type=int, default=9002)
+define("latency", type=float, default=20,
+       help="Milliseconds to wait before answering each request")
+
+
+class DelayedHandler(tornado.web.RequestHandler):
+    """Answers requests after --latency milliseconds without blocking."""
+    def reply(self, status=200, body="", headers={}):
+        def send():
+            self.set_status(status)
+            for name, value in headers.iteritems():
+                self.set_header(name, value)
+            self.finish(body)
+        tornado.ioloop.IOLoop.instance().add_timeout(
+            time.time() + options.latency / 1000.0, send)
+
+
+class GraphAccessTokenHandler(DelayedHandler):
+    @tornado.web.asynchronous
+    def get(self):
+        # Logins pass the user id we should return as the code
+        self.reply(body=urllib.urlencode({
+            "access_token": "fake-" + self.get_argument("code"),
+            "expires": 5183999,
+        }))
+
+
+class GraphMeHandler(DelayedHandler):
+    @tornado.web.asynchronous
+    def get(self):
+        id = self.get_argument("access_token")[len("fake-"):]
+        self.reply(body=json.dumps({
+            "id": id,
+            "name": "Load Test User " + id,
+            "link": "http://www.facebook.com/" + id,
+            "gender": "female",
+        }))
+
+
+class GraphFriendsHandler(DelayedHandler):
+    @tornado.web.asynchronous
+    def get(self):
+        # Seeded users already have their friends in cookbook_friends
+        self.reply(body=json.dumps({"data": []}))
+
+
+class GraphBatchHandler(DelayedHandler):
+    @tornado.web.asynchronous
+    def post(self):
+        batch = json.loads(self.get_argument("batch"))
+        self.application.graph_calls += len(batch)
+        self.reply(body=json.dumps([
+            {"code": 200, "headers": [],
+             "body": json.dumps({"id": uuid.uuid4().hex})}
+            for call in batch]))
+
+
+class S3ObjectHandler(DelayedHandler):
+    @tornado.web.asynchronous
+    def get(self, bucket, key):
+        if not key:
+            self.list_objects(bucket)
+            return
+        obj = self.application.objects.get((bucket, key))
+        if obj is None:
+            self.reply(404, "<Error><Code>NoSuchKey</Code></Error>")
+            return
+        self.reply(body=obj["body"], headers=obj["headers"])
+
+    @tornado.web.asynchronous
+    def head(self, bucket, key):
+        obj = self.application.objects.get((bucket, key))
+        self.reply(200 if obj else 404)
+
+    @tornado.web.asynchronous
+    def put(self, bucket, key):
+        upload_id = self.get_argument("uploadId", None)
+        body = self.request.body
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if upload_id:
+            parts = self.application.uploads.get(upload_id)
+            if parts is None:
+                self.reply(404, "<Error><Code>NoSuchUpload</Code></Error>")
+                return
+            parts[int(self.get_argument("partNumber"))] = body
+        else:
+            headers = dict((name, value) for name, value in
+                           self.request.headers.iteritems()
+                           if name.lower() in ("content-type",
+                                               "content-disposition",
+                                               "cache-control"))
+            self.application.objects[(bucket, key)] = {
+                "body": body, "headers": headers}
+        self.reply(headers={"ETag": etag})
+
+    @tornado.web.asynchronous
+    def post(self, bucket, key):
+        # Tornado drops arguments without values, like "?uploads"
+        if "uploads" in self.request.query.split("&"):
+            upload_id = uuid.uuid4().hex
+            self.application.uploads[upload_id] = {}
+            self.reply(body="<InitiateMultipartUploadResult><UploadId>%s"
+                       "</UploadId></InitiateMultipartUploadResult>" %
+                       upload_id)
+            return
+        parts = self.application.uploads.pop(
+            self.get_argument("uploadId"), None)
+        if parts is None:
+            self.reply(404, "<Error><Code>NoSuchUpload</Code></Error>")
+            return
+        numbers = [int(n) for n in re.findall(
+            r"<PartNumber>(\d+)</PartNumber>", self.request.body)]
+        self.application.objects[(bucket, key)] = {
+            "body": "".join(parts[n] for n in numbers), "headers": {}}
+        self.reply(body="<CompleteMultipartUploadResult><Key>%s</Key>"
+                   "</CompleteMultipartUploadResult>" % key)
+
+    @tornado.web.asynchronous
+    def delete(self, bucket, key):
+        self.application.uploads.pop(self.get_argument("uploadId", ""), None)
+        self.application.objects.pop((bucket, key), None)
+        self.reply(204)
+
+    def list_objects(self, bucket):
+        prefix = self.get_argument("prefix", "")
+        marker = self.get_argument("marker", "")
+        keys = sorted(key for b, key in self.application.objects
+                      if b == bucket and key.startswith(prefix) and
+                      key > marker)
+        self.reply(body="<ListBucketResult>%s<IsTruncated>%s</IsTruncated>"
+                   "</ListBucketResult>" % (
+                       "".join("<Contents><Key>%s</Key></Contents>" % key
+                               for key in keys[:1000]),
+                       "true" if len(keys) > 1000 else "false"))
+
+
+class GraphApplication(tornado.web.Application):
+    def __init__(self):
+        self.graph_calls = 0
+        tornado.web.Application.__init__(self, [
+            (r"/oauth/access_token", GraphAccessTokenHandler),
+            (r"/me", GraphMeHandler),
+            (r"/me/friends", GraphFriendsHandler),
+            (r"/", GraphBatchHandler),
+        ])
+
+
+class S3Application(tornado.web.Application):
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        tornado.web.Application.__init__(self, [
+            (r"/([^/]+)/?(.*)", S3ObjectHandler),
+        ])
+
+
+def main():
+    tornado.options.parse_command_line()
+    graph = GraphApplication()
+    s3 = S3Application()
+    tornado.httpserver.HTTPServer(graph).listen(options.graph_port)
+    tornado.httpserver.HTTPServer(s3).listen(options.s3_port)
+    logging.info("Graph API on port %d, S3 on port %d", options.graph_port,
+                 options.s3_port)
+
+    def report():
+        logging.info("%d Graph API calls, %d S3 objects", graph.graph_calls,
+                     len(s3.objects))
+    tornado.ioloop.PeriodicCallback(report, 10000).start()
+    tornado.ioloop.IOLoop.instance().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compares IN lists and joins for queries over a user's friends.
+
+We create users with 10, 500 and 5000 friends in the configured database,
+time the Backend's friend queries for each with --friend_join_threshold
+forcing either strategy, and then delete everything we created. Run it
+against a development database:
+
+    python benchmarks/friend_queries.py
+"""
+
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import cookbook
+import tornado.options
+
+from tornado.options import define, options
+
+define("degrees", default="10,500,5000",
+       help="Comma-separated friend counts to benchmark")
+define("iterations", type=int, default=20)
+define("clips_per_friend", type=int, default=5)
+
+PREFIX = "bench-"
+
+
+def seed(db, degree, recipe_ids):
+    """Creates a user with the given number of friends who clip recipes."""
+    user_id = PREFIX + "user-%d" % degree
+    friend_ids = [PREFIX + "%d-%d" % (degree, i) for i in xrange(degree)]
+    db.executemany(
+        "INSERT IGNORE INTO cookbook_users (id,name,link,gender,"
+        "access_token,created) VALUES (%s,%s,'','male','',UTC_TIMESTAMP)",
+        [(id, id) for id in [user_id] + friend_ids])
+    db.executemany(
+        "INSERT IGNORE INTO cookbook_friends (user_id, friend_id) "
+        "VALUES (%s,%s)",
+        [(user_id, id) for id in friend_ids] +
+        [(id, user_id) for id in friend_ids])
+    clips = []
+    for i, friend_id in enumerate(friend_ids):
+        for j in xrange(options.clips_per_friend):
+            recipe_id = recipe_ids[(i * 7 + j) % len(recipe_ids)]
+            clips.append((friend_id, recipe_id))
+    db.executemany(
+        "INSERT IGNORE INTO cookbook_clipped (user_id, recipe_id, created) "
+        "VALUES (%s,%s,UTC_TIMESTAMP)", clips)
+    db.execute(
+        "INSERT INTO cookbook_categories (user_id, category, recipes) "
+        "SELECT c.user_id, r.category, COUNT(*) FROM cookbook_clipped c "
+        "JOIN cookbook_recipes r ON r.id = c.recipe_id WHERE c.user_id "
+        "LIKE %s GROUP BY c.user_id, r.category ON DUPLICATE KEY UPDATE "
+        "recipes = VALUES(recipes)", PREFIX + str(degree) + "-%")
+    return {"id": user_id}
+
+
+def create_recipes(db, num):
+    db.execute(
+        "INSERT IGNORE INTO cookbook_users (id,name,link,gender,"
+        "access_token,created) VALUES (%s,'Author','','male','',"
+        "UTC_TIMESTAMP)", PREFIX + "author")
+    ids = []
+    # create_recipe strips underscores, so no real recipe has these slugs
+    for i in xrange(num):
+        ids.append(db.execute(
+            "INSERT INTO cookbook_recipes (title,category,description,"
+            "ingredients,instructions,description_html,ingredients_html,"
+            "instructions_html,html_version,author_id,slug,created) VALUES "
+            "(%s,%s,'','','','','','',%s,%s,%s,UTC_TIMESTAMP)",
+            "Recipe %d" % i, "Category %d" % (i % 12),
+            cookbook.MARKDOWN_VERSION, PREFIX + "author",
+            PREFIX + "recipe_%d" % i))
+    return ids
+
+
+def clean_up(db):
+    # Select recipes by their author, since a real recipe's slug can start
+    # with our prefix but its author's Facebook id can't
+    db.execute("DELETE FROM cookbook_recipes WHERE author_id = %s",
+               PREFIX + "author")
+    for table, column in (("cookbook_clipped", "user_id"),
+                          ("cookbook_categories", "user_id"),
+                          ("cookbook_friends", "user_id"),
+                          ("cookbook_friends", "friend_id"),
+                          ("cookbook_users", "id")):
+        db.execute("DELETE FROM " + table + " WHERE " + column + " LIKE %s",
+                   PREFIX + "%")
+
+
+def time_queries(backend, user, recipes):
+    """Returns the mean seconds each friend query takes for the user."""
+    queries = {
+        "recently_clipped": lambda b: b.get_friends_recently_clipped_recipes(
+            user, 10),
+        "friends_who_clipped": lambda b: b.prefetch_friends_who_clipped(
+            user, recipes),
+        "categories": lambda b: b.get_category_counts(user),
+    }
+    results = {}
+    for name, query in queries.iteritems():
+        total = 0.0
+        for i in xrange(options.iterations):
+            scoped = backend.scoped()
+            # Load the friend ids first, since both strategies need them
+            scoped.get_friend_ids(user)
+            start = time.time()
+            query(scoped)
+            total += time.time() - start
+        results[name] = total / options.iterations
+    return results
+
+
+def main():
+    tornado.options.parse_command_line()
+    if options.config:
+        tornado.options.parse_config_file(options.config)
+    else:
+        tornado.options.parse_config_file(os.path.join(
+            os.path.dirname(__file__), "..", "settings.py"))
+    backend = cookbook.Backend.instance(services=False)
+    db = backend.db
+    clean_up(db)
+    try:
+        recipe_ids = create_recipes(db, 200)
+        recipes = backend.get_recipes(recipe_ids[:20]).values()
+        print "%-8s %-20s %10s %10s" % ("friends", "query", "in (ms)",
+                                        "join (ms)")
+        for degree in [int(d) for d in options.degrees.split(",")]:
+            user = seed(db, degree, recipe_ids)
+            options.friend_join_threshold = sys.maxint
+            in_times = time_queries(backend, user, recipes)
+            options.friend_join_threshold = 0
+            join_times = time_queries(backend, user, recipes)
+            for name in sorted(in_times):
+                print "%-8d %-20s %10.2f %10.2f" % (
+                    degree, name, in_times[name] * 1000,
+                    join_times[name] * 1000)
+    finally:
+        clean_up(db)
+
+
+if __name__ == "__main__":
+    main()
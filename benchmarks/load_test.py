@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Drives a running server with a mix of requests from seeded users.
+
+We log in as users created by seed_data.py by minting their login cookies
+with the server's cookie_secret, then keep --concurrency requests in
+flight for --duration seconds. Each request is picked from --mix, which
+weights the home page, recipe pages, cookbooks, categories, clips and
+photo uploads. At the end we print each handler's throughput, p50 and p99
+latency and, if the server runs with --query_count_header, the MySQL
+queries per request. To compare commits, save the results of one run with
+--output and pass the file to a later run as --baseline:
+
+    python benchmarks/fake_services.py &
+    python cookbook.py --facebook_graph_url=http://localhost:9001/ \\
+        --aws_s3_endpoint=http://localhost:9002 --query_count_header &
+    python benchmarks/seed_data.py
+    python benchmarks/load_test.py --output=before.json
+    python benchmarks/load_test.py --baseline=before.json
+"""
+
+import base64
+import functools
+import hashlib
+import hmac
+import json
+import mimetools
+import os.path
+import random
+import subprocess
+import sys
+import time
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import cookbook  # Defines the server's options, like cookie_secret
+import tornado.database
+import tornado.httpclient
+import tornado.ioloop
+import tornado.options
+
+from tornado.options import define, options
+
+define("url", default="http://localhost:8080",
+       help="Server to load, without a trailing slash")
+define("concurrency", type=int, default=20)
+define("duration", type=float, default=60,
+       help="Seconds to send requests for, after the warmup")
+define("warmup", type=float, default=10,
+       help="Seconds to send requests for before we start measuring")
+define("mix", default="home=30,recipe=35,cookbook=15,category=10,clip=8,"
+       "upload=2", help="Relative weights of each kind of request")
+define("photo", help="JPEG file to upload; without one, we skip uploads")
+define("prefix", default="load-",
+       help="Prefix of the user ids seed_data.py created")
+define("sample_size", type=int, default=1000,
+       help="Number of users and recipes to pick requests from")
+define("output", help="File to save the results to as JSON")
+define("baseline", help="Results file from an earlier run to compare to")
+define("label", help="Name for this run; defaults to the git revision")
+
+
+def mint_cookie(secret, name, value):
+    """Returns a cookie value that get_secure_cookie() accepts.
+
+    This is how tornado.web.RequestHandler.create_signed_value() signs
+    cookies, which we can't call without a request.
+    """
+    timestamp = str(int(time.time()))
+    value = base64.b64encode(value)
+    signature = hmac.new(secret, digestmod=hashlib.sha1)
+    for part in (name, value, timestamp):
+        signature.update(part)
+    return "|".join([value, timestamp, signature.hexdigest()])
+
+
+def load_sample(db):
+    """Returns the users, recipes and categories to make requests for."""
+    users = [r["id"] for r in db.query(
+        "SELECT id FROM cookbook_users WHERE id LIKE %s ORDER BY RAND() "
+        "LIMIT %s", options.prefix + "%", options.sample_size)]
+    recipes = db.query(
+        "SELECT id, slug FROM cookbook_recipes WHERE author_id LIKE %s "
+        "ORDER BY RAND() LIMIT %s", options.prefix + "%", options.sample_size)
+    categories = [r["category"] for r in db.query(
+        "SELECT DISTINCT category FROM cookbook_recipes WHERE author_id "
+        "LIKE %s", options.prefix + "%")]
+    if not users or not recipes:
+        raise SystemExit("No seeded data; run benchmarks/seed_data.py first")
+    return users, recipes, categories
+
+
+def multipart_body(fields, files):
+    boundary = mimetools.choose_boundary()
+    lines = []
+    for name, value in fields:
+        lines += ["--" + boundary,
+                  'Content-Disposition: form-data; name="%s"' % name, "",
+                  value]
+    for name, file_name, data in files:
+        lines += ["--" + boundary,
+                  'Content-Disposition: form-data; name="%s"; '
+                  'filename="%s"' % (name, file_name),
+                  "Content-Type: image/jpeg", "", data]
+    lines += ["--" + boundary + "--", ""]
+    return "multipart/form-data; boundary=" + boundary, "\r\n".join(lines)
+
+
+class LoadTest(object):
+    """Keeps concurrency requests in flight, recording how each went."""
+    def __init__(self, users, recipes, categories, photo=None):
+        self.users = users
+        self.recipes = recipes
+        self.categories = categories
+        self.photo = photo
+        self.cookies = {}
+        self.results = {}
+        self.kinds = []
+        for part in options.mix.split(","):
+            kind, weight = part.split("=")
+            if kind == "upload" and not photo:
+                continue
+            self.kinds += [kind] * int(weight)
+        self.client = tornado.httpclient.AsyncHTTPClient(
+            max_clients=options.concurrency)
+        self.io_loop = tornado.ioloop.IOLoop.instance()
+        self.start = None
+        self.measure_from = None
+        self.end = None
+
+    def run(self):
+        self.start = time.time()
+        self.measure_from = self.start + options.warmup
+        self.end = self.measure_from + options.duration
+        self.active = options.concurrency
+        for i in xrange(options.concurrency):
+            self.send()
+        self.io_loop.start()
+        return self.results
+
+    def send(self):
+        if time.time() >= self.end:
+            self.active -= 1
+            if not self.active:
+                self.io_loop.stop()
+            return
+        kind = random.choice(self.kinds)
+        user = random.choice(self.users)
+        path, method, body, headers = getattr(self, "request_" + kind)(user)
+        headers["Cookie"] = "uid=" + self.cookie(user)
+        request = tornado.httpclient.HTTPRequest(
+            options.url + path, method=method, body=body, headers=headers,
+            follow_redirects=False, request_timeout=60)
+        self.client.fetch(request, functools.partial(
+            self.on_response, kind, time.time()))
+
+    def on_response(self, kind, started, response):
+        finished = time.time()
+        if started >= self.measure_from:
+            result = self.results.setdefault(kind, {
+                "latencies": [], "errors": 0, "queries": []})
+            result["latencies"].append(finished - started)
+            # Redirects to log in mean our cookie didn't work
+            location = response.headers.get("Location", "")
+            if response.code >= 400 or "/a/login" in location or \
+               "facebook.com" in location:
+                result["errors"] += 1
+            queries = response.headers.get("X-Query-Count")
+            if queries is not None:
+                result["queries"].append(int(queries))
+        self.send()
+
+    def cookie(self, user):
+        if user not in self.cookies:
+            self.cookies[user] = mint_cookie(
+                options.cookie_secret, "uid", user)
+        return self.cookies[user]
+
+    def request_home(self, user):
+        return "/", "GET", None, {}
+
+    def request_recipe(self, user):
+        recipe = random.choice(self.recipes)
+        return "/recipe/" + urllib.quote(recipe["slug"]), "GET", None, {}
+
+    def request_cookbook(self, user):
+        # Half the time look at our own cookbook, and otherwise someone's
+        other = user if random.random() < 0.5 else random.choice(self.users)
+        return "/cookbook/" + urllib.quote(other), "GET", None, {}
+
+    def request_category(self, user):
+        return "/category?" + urllib.urlencode({
+            "name": random.choice(self.categories)}), "GET", None, {}
+
+    def request_clip(self, user):
+        recipe = random.choice(self.recipes)
+        return "/a/clip", "POST", urllib.urlencode({
+            "recipe": recipe["id"]}), {}
+
+    def request_upload(self, user):
+        recipe = random.choice(self.recipes)
+        content_type, body = multipart_body(
+            [("recipe", str(recipe["id"]))],
+            [("file", "photo.jpg", self.photo)])
+        return "/a/upload", "POST", body, {"Content-Type": content_type}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def summarize(results, duration):
+    summary = {}
+    for kind, result in results.iteritems():
+        latencies = result["latencies"]
+        queries = result["queries"]
+        summary[kind] = {
+            "requests": len(latencies),
+            "errors": result["errors"],
+            "throughput": len(latencies) / duration,
+            "p50": percentile(latencies, 0.5) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "queries": float(sum(queries)) / len(queries) if queries
+                       else None,
+        }
+    return summary
+
+
+def print_summary(summary, baseline=None):
+    print "%-10s %8s %7s %9s %9s %9s %8s" % (
+        "handler", "requests", "errors", "req/s", "p50 (ms)", "p99 (ms)",
+        "queries")
+    for kind in sorted(summary):
+        row = summary[kind]
+        print "%-10s %8d %7d %9.1f %9.1f %9.1f %8s" % (
+            kind, row["requests"], row["errors"], row["throughput"],
+            row["p50"], row["p99"],
+            "%.1f" % row["queries"] if row["queries"] is not None else "-")
+        old = (baseline or {}).get(kind)
+        if old:
+            print "%-10s %8s %7s %9s %9s %9s %8s" % (
+                "", "", "vs base", change(row, old, "throughput"),
+                change(row, old, "p50"), change(row, old, "p99"),
+                change(row, old, "queries"))
+
+
+def change(row, old, field):
+    if not row[field] or not old.get(field):
+        return "-"
+    return "%+.0f%%" % ((row[field] - old[field]) * 100.0 / old[field])
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    tornado.options.parse_command_line()
+    if options.config:
+        tornado.options.parse_config_file(options.config)
+    else:
+        tornado.options.parse_config_file(os.path.join(
+            os.path.dirname(__file__), "..", "settings.py"))
+    db = tornado.database.Connection(
+        host=options.mysql_host, database=options.mysql_database,
+        user=options.mysql_user, password=options.mysql_password)
+    users, recipes, categories = load_sample(db)
+    db.close()
+    photo = None
+    if options.photo:
+        with open(options.photo, "rb") as f:
+            photo = f.read()
+    print "Sending %d requests at a time for %ds after a %ds warmup" % (
+        options.concurrency, options.duration, options.warmup)
+    results = LoadTest(users, recipes, categories, photo).run()
+    summary = summarize(results, options.duration)
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        print "Compared to %s" % baseline["label"]
+    print_summary(summary, baseline["handlers"] if baseline else None)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump({
+                "label": options.label or git_revision(),
+                "time": time.time(),
+                "concurrency": options.concurrency,
+                "duration": options.duration,
+                "mix": options.mix,
+                "handlers": summary,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Fills the configured database with users, friends, recipes and clips.
+
+The data is shaped like a real social app's: a few people have thousands
+of friends while most have a hundred or so, friends tend to come from the
+same circle, and a few popular recipes get most of the clips. Every user
+id we create starts with --prefix, and we find our recipes by their
+authors, so running this again, or with --clean, replaces only the rows
+it made. Our slugs contain an underscore, which create_recipe strips, so
+they don't collide with real ones. We then rebuild the derived
+tables, which covers the whole database, so use one set aside for load
+tests:
+
+    python benchmarks/seed_data.py --users=10000 --recipes=20000
+"""
+
+import datetime
+import os.path
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import cookbook
+import tornado.options
+
+from tornado.options import define, options
+
+define("users", type=int, default=2000)
+define("friends_per_user", type=int, default=120,
+       help="Median number of friends a user has")
+define("recipes", type=int, default=5000)
+define("clips_per_user", type=int, default=25)
+define("cooks_per_user", type=int, default=5)
+define("circle_size", type=int, default=500,
+       help="Users in each circle, which most friends come from")
+define("days", type=int, default=90,
+       help="Days over which clips and cooks are spread")
+define("prefix", default="load-")
+define("seed", type=int, default=1)
+define("clean", type=bool, default=False,
+       help="Delete the rows we created and exit")
+
+CATEGORIES = (
+    "Appetizers", "Beverages", "Breads", "Breakfast", "Desserts",
+    "Main Dishes", "Salads", "Sandwiches", "Side Dishes", "Soups",
+)
+ADJECTIVES = (
+    "Classic", "Crispy", "Easy", "Grandma's", "Grilled", "Roasted", "Smoky",
+    "Spicy", "Sweet", "Tangy", "Weeknight", "Creamy", "Lemon", "Garlic",
+)
+INGREDIENTS = (
+    "chicken", "beef", "salmon", "tofu", "black beans", "chickpeas",
+    "mushrooms", "spinach", "sweet potatoes", "tomatoes", "zucchini",
+    "cauliflower", "chocolate", "oatmeal", "apples", "blueberries",
+    "pumpkin", "cheddar", "ginger", "coconut", "pasta", "rice", "lentils",
+)
+DISHES = (
+    "Soup", "Stew", "Salad", "Tacos", "Curry", "Pie", "Bread", "Muffins",
+    "Casserole", "Stir-Fry", "Pancakes", "Chili", "Cookies", "Risotto",
+)
+UNITS = ("cup", "cups", "tbsp", "tsp", "oz", "lb", "cloves", "pinch")
+STEPS = (
+    "Preheat the oven to 375 degrees.",
+    "Chop the %s and set aside.",
+    "Heat the oil in a large skillet over medium heat.",
+    "Add the %s and cook until soft, about 5 minutes.",
+    "Stir in the remaining ingredients and bring to a simmer.",
+    "Season with salt and pepper to taste.",
+    "Bake for 25 minutes, or until golden brown.",
+    "Let cool for 10 minutes before serving.",
+)
+
+
+def user_id(i):
+    return options.prefix + str(i)
+
+
+def friend_degrees(rng, num_users):
+    """Returns a friend count for each user, with a long tail."""
+    median = options.friends_per_user
+    limit = max(1, num_users - 1)
+    return [min(limit, max(1, int(rng.lognormvariate(0, 1) * median)))
+            for i in xrange(num_users)]
+
+
+def make_friends(rng, num_users):
+    """Returns a set of (user, friend) pairs with both directions."""
+    edges = set()
+    circle = max(2, min(options.circle_size, num_users))
+    for user, degree in enumerate(friend_degrees(rng, num_users)):
+        # Each user makes half their edges and their friends the rest.
+        # Most come from the user's circle, until it runs out of people.
+        for i in xrange(degree // 2 + 1):
+            if rng.random() < 0.8 and i < circle // 2:
+                start = user - user % circle
+                friend = start + rng.randrange(
+                    min(circle, num_users - start))
+            else:
+                friend = rng.randrange(num_users)
+            if friend != user:
+                edges.add((user, friend))
+                edges.add((friend, user))
+    return edges
+
+
+def make_recipe(rng, i):
+    main = rng.choice(INGREDIENTS)
+    title = "%s %s %s" % (rng.choice(ADJECTIVES), main.title(),
+                          rng.choice(DISHES))
+    ingredients = "\n".join(
+        "%d %s %s" % (rng.randint(1, 4), rng.choice(UNITS), ingredient)
+        for ingredient in [main] + rng.sample(INGREDIENTS, 5))
+    instructions = "\n\n".join(
+        step % main if "%s" in step else step
+        for step in rng.sample(STEPS, 5))
+    description = "A %s %s that comes together in %d minutes." % (
+        rng.choice(ADJECTIVES).lower(), rng.choice(DISHES).lower(),
+        rng.choice([20, 30, 45, 60]))
+    return {
+        "title": title,
+        "category": rng.choice(CATEGORIES),
+        "description": description,
+        "ingredients": ingredients,
+        "instructions": instructions,
+        "author_id": user_id(rng.randrange(options.users)),
+        "slug": options.prefix + "recipe_%d" % i,
+    }
+
+
+def popular_recipe(rng, recipe_ids):
+    """Picks a recipe, favoring the ones at the front of the list."""
+    return recipe_ids[int(len(recipe_ids) * rng.random() ** 3)]
+
+
+def random_time(rng, now):
+    return now - datetime.timedelta(seconds=rng.randrange(
+        options.days * 86400))
+
+
+def insert_many(db, query, rows, batch_size=1000):
+    for i in xrange(0, len(rows), batch_size):
+        db.executemany(query, rows[i:i + batch_size])
+
+
+def clean_up(db):
+    like = options.prefix + "%"
+    for table, column in (("cookbook_clipped", "user_id"),
+                          ("cookbook_cooked", "user_id"),
+                          ("cookbook_activity", "user_id"),
+                          ("cookbook_categories", "user_id"),
+                          ("cookbook_friends", "user_id"),
+                          ("cookbook_users", "id")):
+        db.execute("DELETE FROM " + table + " WHERE " + column + " LIKE %s",
+                   like)
+    # Real recipes can have slugs like ours, but not authors
+    db.execute(
+        "DELETE FROM cookbook_counts WHERE recipe_id IN (SELECT id FROM "
+        "cookbook_recipes WHERE author_id LIKE %s)", like)
+    db.execute("DELETE FROM cookbook_recipes WHERE author_id LIKE %s", like)
+
+
+def seed(backend):
+    db = backend.db
+    rng = random.Random(options.seed)
+    now = datetime.datetime.utcnow()
+    print "Creating %d users" % options.users
+    insert_many(db, "INSERT INTO cookbook_users (id,name,link,gender,"
+                "access_token,created) VALUES (%s,%s,%s,%s,'',%s)", [
+                    (user_id(i), "Load Test User %d" % i,
+                     "http://www.facebook.com/" + user_id(i),
+                     rng.choice(["female", "male"]), random_time(rng, now))
+                    for i in xrange(options.users)])
+    edges = make_friends(rng, options.users)
+    print "Creating %d friend edges" % len(edges)
+    insert_many(db, "INSERT INTO cookbook_friends (user_id, friend_id) "
+                "VALUES (%s,%s)",
+                [(user_id(a), user_id(b)) for a, b in edges])
+    print "Creating %d recipes" % options.recipes
+    recipe_ids = []
+    for i in xrange(options.recipes):
+        recipe = make_recipe(rng, i)
+        recipe_ids.append(db.execute(
+            "INSERT INTO cookbook_recipes (title,category,description,"
+            "ingredients,instructions,description_html,ingredients_html,"
+            "instructions_html,html_version,author_id,slug,created) VALUES "
+            "(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)", recipe["title"],
+            recipe["category"], recipe["description"],
+            recipe["ingredients"], recipe["instructions"],
+            cookbook.markdown(recipe["description"]),
+            cookbook.markdown(recipe["ingredients"]),
+            cookbook.markdown(recipe["instructions"]),
+            cookbook.MARKDOWN_VERSION, recipe["author_id"], recipe["slug"],
+            random_time(rng, now)))
+    clips = {}
+    cooks = []
+    for i in xrange(options.users):
+        num = max(0, int(rng.expovariate(1.0 / options.clips_per_user)))
+        for j in xrange(num):
+            clips[(user_id(i), popular_recipe(rng, recipe_ids))] = \
+                random_time(rng, now)
+    clipped = clips.keys()
+    # People cook recipes they clipped
+    for i in xrange(options.users * options.cooks_per_user if clipped else 0):
+        user, recipe_id = rng.choice(clipped)
+        cooks.append((user, recipe_id, random_time(rng, now)))
+    print "Creating %d clips and %d cooks" % (len(clips), len(cooks))
+    insert_many(db, "INSERT INTO cookbook_clipped (user_id, recipe_id, "
+                "created) VALUES (%s,%s,%s)",
+                [(u, r, created) for (u, r), created in clips.iteritems()])
+    insert_many(db, "INSERT INTO cookbook_cooked (user_id, recipe_id, "
+                "created) VALUES (%s,%s,%s)", cooks)
+    print "Rebuilding derived tables"
+    backend.reconcile_counts()
+    backend.rebuild_categories()
+    backend.rebuild_activity()
+
+
+def main():
+    tornado.options.parse_command_line()
+    if options.config:
+        tornado.options.parse_config_file(options.config)
+    else:
+        tornado.options.parse_config_file(os.path.join(
+            os.path.dirname(__file__), "..", "settings.py"))
+    backend = cookbook.Backend.instance(services=False)
+    clean_up(backend.db)
+    if not options.clean:
+        seed(backend)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A bounded in-process cache with LRU eviction and expiration times"""
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """A dict-like cache holding at most max_size entries.
+
+    When the cache is full, we evict the least recently used entry. If ttl
+    is given, entries also expire that many seconds after they are set. We
+    count hits and misses so callers can tell whether the cache is sized
+    well. All methods are safe to call from multiple threads.
+    """
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._get(key, default)
+
+    def get_many(self, keys):
+        """Returns a dict of the given keys to their values, skipping misses.
+        """
+        result = {}
+        missing = object()
+        with self._lock:
+            for key in keys:
+                value = self._get(key, missing)
+                if value is not missing:
+                    result[key] = value
+        return result
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the size and hit rate of the cache as a dict"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits * 1.0 / total if total else 0.0,
+        }
+
+    def _get(self, key, default):
+        entry = self._entries.pop(key, None)
+        if entry is None or (entry[1] is not None and entry[1] < time.time()):
+            self.misses += 1
+            return default
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
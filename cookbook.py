@@ -16,43 +16,150 @@
 
 import aws
 import base64
+import cache
+import calendar
+import copy
 import datetime
+import dbpool
+import email.utils
 import functools
+import glob
+import graph
+import hashlib
 import images
+import itertools
 import json
 import logging
 import os.path
+import prefork
 import random
 import re
+import search
+import signal
+import spool
 import string
+import tempfile
+import threading
+import time
 import tornado.database
 import tornado.escape
 import tornado.httpclient
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.stack_context
 import tornado.web
 import urllib
 import urlparse
+import workers
 
 from tornado.options import define, options
 
+define("activity_timeline_size", type=int, default=100,
+       help="Number of activity items we keep in each user's timeline")
+define("activity_trim_interval", type=float, default=60,
+       help="Seconds between trimming the timelines we added activity to")
 define("aws_s3_bucket")
+define("aws_s3_max_connections", type=int, default=10,
+       help="Maximum number of concurrent requests to Amazon S3")
+define("aws_s3_retries", type=int, default=3,
+       help="Times we retry an S3 request that fails with a server error")
+define("aws_s3_timeout", type=float, default=60,
+       help="Seconds before an S3 request times out")
 define("aws_cloudfront_host")
+define("cache_check_interval", type=float, default=2,
+       help="Seconds a cached user, recipe or photo is used before we check "
+       "MySQL for changes made by other processes")
+define("cache_size", type=int, default=20000,
+       help="Maximum number of users, recipes and photos to cache each")
+define("cdn_index_path",
+       help="SQLite file listing the photos already uploaded to S3")
 define("compiled_css_url")
 define("compiled_jquery_url")
 define("compiled_js_url")
 define("config")
 define("cookie_secret")
+define("count_flush_interval", type=float, default=5,
+       help="Seconds between writes of buffered clip and cook counts. We "
+       "write them on shutdown, but a process that crashes loses up to "
+       "this many seconds of counts")
 define("comments", type=bool, default=True)
+define("db_idle_timeout", type=int, default=300,
+       help="Seconds before we close an idle MySQL connection")
+define("db_pool_max_size", type=int, default=12)
+define("db_pool_min_size", type=int, default=2)
+define("db_query_timeout", type=float,
+       help="Seconds before MySQL aborts a SELECT (MySQL 5.7.8+)")
+define("db_queue_size", type=int, default=1000,
+       help="Maximum number of database jobs waiting for a thread")
+define("db_threads", type=int, default=10,
+       help="Number of threads that run database queries")
+define("db_wait_timeout", type=float, default=10,
+       help="Seconds to wait for a free MySQL connection")
 define("debug", type=bool)
 define("facebook_app_id")
 define("facebook_app_secret")
 define("facebook_canvas_id")
+define("facebook_graph_url", default="https://graph.facebook.com/",
+       help="Base URL of the Graph API, e.g., a local stand-in for load "
+       "tests")
+define("fragment_cache_size", type=int, default=10000,
+       help="Maximum number of rendered UI module fragments to cache")
+define("friend_graph", type=bool, default=True,
+       help="Keep the friend graph and clips in memory to answer friend "
+       "lookups")
+define("friend_graph_refresh_interval", type=float, default=5,
+       help="Seconds between loading new friend edges and clips into the "
+       "graph")
+define("friend_graph_reload_interval", type=float, default=900,
+       help="Seconds between full reloads of the friend graph, which pick "
+       "up friends removed by other processes")
+define("friend_join_threshold", type=int, default=200,
+       help="Friend count above which we join cookbook_friends in MySQL "
+       "rather than sending friend ids in queries")
+define("graceful_timeout", type=int, default=30,
+       help="Seconds a worker process waits for requests when stopping")
+define("graph_rate_limit", type=int, default=20,
+       help="Maximum Open Graph actions we publish per user per minute")
+define("graph_spool_path",
+       default=os.path.join(os.path.expanduser("~"), ".cookbook",
+                            "graph-spool.db"),
+       help="SQLite file holding Open Graph calls waiting to be sent")
+define("max_upload_size", type=int, default=10 * 1024 * 1024,
+       help="Maximum size in bytes of an uploaded photo")
 define("mysql_host")
 define("mysql_database")
 define("mysql_user")
 define("mysql_password")
+define("page_cache_size", type=int, default=1000,
+       help="Maximum number of recipe pages to cache for crawlers")
+define("page_size", type=int, default=50,
+       help="Number of recipes on each page of a cookbook")
+define("photo_cache_ttl", type=int, default=3600)
 define("port", type=int, default=8080)
+define("processes", type=int, default=1,
+       help="Number of server processes to fork, or 0 for one per CPU")
+define("query_count_header", type=bool, default=False,
+       help="Send the number of MySQL queries each request made in an "
+       "X-Query-Count header")
+define("recipe_cache_ttl", type=int, default=3600)
+define("resize_processes", type=int, default=2,
+       help="Number of processes that resize uploaded photos")
+define("resize_queue_size", type=int, default=20,
+       help="Maximum number of photos waiting to be resized")
+define("resize_timeout", type=float, default=30,
+       help="Seconds before we give up on resizing a photo")
+define("search_refresh_interval", type=float, default=5,
+       help="Seconds between adding changed recipes to the search index")
+define("search_snapshot_interval", type=float, default=600,
+       help="Seconds between saving the search index to disk")
+define("search_snapshot_path",
+       default=os.path.join(os.path.expanduser("~"), ".cookbook",
+                            "search-index.pickle"),
+       help="File the search index is saved to, so restarts can skip "
+       "indexing every recipe")
 define("silent", type=bool)
+define("user_cache_ttl", type=int, default=600)
 
 
 class CookbookApplication(tornado.web.Application):
@@ -79,6 +186,7 @@ class CookbookApplication(tornado.web.Application):
             tornado.web.url(r"/", HomeHandler, name="home"),
             tornado.web.url(r"/recipe/([^/]+)", RecipeHandler, name="recipe"),
             tornado.web.url(r"/category", CategoryHandler, name="category"),
+            tornado.web.url(r"/search", SearchHandler, name="search"),
             tornado.web.url(r"/cookbook/([^/]+)", CookbookHandler,
                             name="cookbook"),
             tornado.web.url(r"/edit", EditHandler, name="edit"),
@@ -87,12 +195,57 @@ class CookbookApplication(tornado.web.Application):
             tornado.web.url(r"/a/cook", CookHandler, name="cook"),
             tornado.web.url(r"/a/upload", UploadHandler, name="upload"),
         ], **settings)
+        # Pages change when we deploy new templates, so include their
+        # modification time in the validators we give browsers
+        self.template_version = max(os.path.getmtime(path) for path in
+            glob.glob(os.path.join(base_dir, "templates", "*.html")) +
+            [os.path.abspath(__file__)])
+
+
+def nonblocking(method):
+    """Decorate asynchronous methods with this to load the current user on
+    the Backend's thread pool before the method runs.
+
+    Put it below @tornado.web.asynchronous and above
+    @tornado.web.authenticated, which would otherwise look up the user on
+    the IOLoop.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        def on_user(user):
+            self._current_user = user
+            method(self, *args, **kwargs)
+        self.async_backend.run(self.get_current_user, callback=on_user)
+    return wrapper
 
 
 class BaseHandler(tornado.web.RequestHandler):
     @property
     def backend(self):
-        return Backend.instance()
+        if not hasattr(self, "_backend"):
+            self._backend = Backend.instance().scoped()
+        return self._backend
+
+    @property
+    def async_backend(self):
+        """The request's backend, with every method run on a thread pool.
+
+        Each method takes an additional callback argument, which we call
+        with the method's return value on the IOLoop. We run one query
+        at a time per request, so handlers should wait for the callback
+        before making another call.
+        """
+        return AsyncBackend(self.backend)
+
+    def prefetch_clips(self, recipes):
+        """Loads the data RecipeClips needs into our request's backend."""
+        self.backend.prefetch_friends_who_clipped(self.current_user, recipes)
+        self.backend.prefetch_clipped(self.current_user, recipes)
+
+    def prefetch_activity(self, num):
+        """Loads the data ActivityStream needs into our request's backend."""
+        if self.current_user:
+            self.backend.get_friend_activity(self.current_user, num=num)
 
     def get_current_user(self):
         uid = self.get_secure_cookie("uid")
@@ -119,6 +272,12 @@ class BaseHandler(tornado.web.RequestHandler):
             "scope": "offline_access,publish_actions",
         })
 
+    def finish(self, chunk=None):
+        if options.query_count_header and not self._headers_written and \
+           hasattr(self, "_backend"):
+            self.set_header("X-Query-Count", self._backend.db.num_queries)
+        tornado.web.RequestHandler.finish(self, chunk)
+
     def write_json(self, obj):
         self.set_header("Content-Type", "application/json; charset=UTF-8")
         self.finish(json.dumps(obj))
@@ -132,7 +291,6 @@ class BaseHandler(tornado.web.RequestHandler):
 
     def render_string(self, template, **kwargs):
         args = {
-            "markdown": self.markdown,
             "options": options,
             "user_possessive": self.user_possessive,
             "user_link": self.user_link,
@@ -141,6 +299,27 @@ class BaseHandler(tornado.web.RequestHandler):
         args.update(kwargs)
         return tornado.web.RequestHandler.render_string(self, template, **args)
 
+    def get_cursor(self, name):
+        """Returns the (created, recipe_id) cursor in the given argument."""
+        value = self.get_argument(name, None)
+        if not value:
+            return None
+        try:
+            timestamp, recipe_id = value.split("-")
+            return (datetime.datetime.utcfromtimestamp(int(timestamp)),
+                    int(recipe_id))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Bad cursor %r", value)
+
+    def cookbook_page_url(self, user, cursor):
+        """Returns the URL of the page of a cookbook starting at cursor."""
+        if not cursor:
+            return None
+        created, recipe_id = cursor
+        return self.reverse_url("cookbook", user["id"]) + "?" + \
+            urllib.urlencode({"before": "%d-%d" % (
+                calendar.timegm(created.utctimetuple()), recipe_id)})
+
     def set_error_message(self, message):
         self.set_secure_cookie("message", base64.b64encode(message))
 
@@ -171,24 +350,26 @@ class BaseHandler(tornado.web.RequestHandler):
         return '<a href="' + user["link"] + '" class="name">' + \
             tornado.escape.xhtml_escape(name) + '</a>'
 
-    def markdown(self, text):
-        text = re.sub(r"\n\s*\n", "</p><p>",
-                      tornado.escape.xhtml_escape(text.strip()))
-        text = re.sub(r"\n", "<br>", text)
-        return '<p>' + text + '</p>'
-
 
 class HomeHandler(BaseHandler):
+    @tornado.web.asynchronous
+    @nonblocking
     @tornado.web.authenticated
     def get(self):
-        all_recipes = self.backend.get_recently_clipped_recipes(
-            [self.current_user["id"]])
-        existing_ids = set(r["id"] for r in all_recipes)
-        friends_recent = self.backend.get_recently_clipped_recipes(
-            self.backend.get_friend_ids(self.current_user), 10, existing_ids)
-        user_recipe_ids = set(r["id"] for r in all_recipes)
-        friends_recent = [r for r in friends_recent
-                          if r["id"] not in user_recipe_ids]
+        self.async_backend.run(self.load_recipes, callback=self.on_recipes)
+
+    def load_recipes(self):
+        all_recipes, next = self.backend.get_clipped_recipe_page(
+            self.current_user, options.page_size)
+        existing_ids = [r["id"] for r in all_recipes]
+        friends_recent = self.backend.get_friends_recently_clipped_recipes(
+            self.current_user, 10, existing_ids)
+        # We only loaded the first page of the user's recipes, so check the
+        # rest of their cookbook for these
+        self.backend.prefetch_clipped(self.current_user, friends_recent)
+        friends_recent = [
+            r for r in friends_recent
+            if not self.backend.recipe_is_clipped(self.current_user, r)]
         user_recent = all_recipes[:2] if friends_recent else all_recipes[:4]
         if not all_recipes:
             friends_recent = friends_recent[:6]
@@ -196,28 +377,67 @@ class HomeHandler(BaseHandler):
             friends_recent = friends_recent[:4]
         else:
             friends_recent = friends_recent[:2]
+        self.prefetch_clips(user_recent + friends_recent)
+        self.prefetch_activity(10)
+        return all_recipes, next, user_recent, friends_recent
+
+    def on_recipes(self, result):
+        all_recipes, next, user_recent, friends_recent = result
         if not all_recipes and len(friends_recent) < 2:
             self.render("home-empty.html")
             return
         self.render("home.html", all_recipes=all_recipes,
-                    user_recent=user_recent, friends_recent=friends_recent)
+                    user_recent=user_recent, friends_recent=friends_recent,
+                    next_url=self.cookbook_page_url(self.current_user, next))
 
 
 class UploadHandler(BaseHandler):
-    @tornado.web.authenticated
     @tornado.web.asynchronous
+    @nonblocking
+    @tornado.web.authenticated
     def post(self):
-        recipe = self.backend.get_recipe(int(self.get_argument("recipe")))
+        self.async_backend.get_recipe(
+            int(self.get_argument("recipe")), callback=self.on_recipe)
+
+    def on_recipe(self, recipe):
         if not recipe:
             raise tornado.web.HTTPError(404)
         if recipe["photo"] and recipe["author_id"] != self.current_user["id"]:
             raise tornado.web.HTTPError(403)
-        full = images.resize_image(
-            self.request.files.values()[0][0]["body"], max_width=800,
-            max_height=800, quality=85)
-        thumb = images.resize_image(
-            self.request.files.values()[0][0]["body"], max_width=300,
-            max_height=800, quality=85)
+        upload = self.request.files.values()[0][0]["body"]
+        # Spool the upload to disk, and drop the copies the request holds,
+        # so the photo isn't in memory while we wait for it to be resized
+        self.async_backend.run(
+            write_temp_file, upload,
+            callback=functools.partial(self.on_spool, recipe))
+        self.request.files = {}
+        self.request.body = ""
+
+    def on_spool(self, recipe, path):
+        # Resize in other processes so we can serve requests in the meantime
+        try:
+            self.backend.resizer.submit(
+                functools.partial(self.on_resize, recipe),
+                images.resize_image_file, path, [
+                    {"max_width": 800, "max_height": 800, "quality": 85},
+                    {"max_width": 300, "max_height": 800, "quality": 85},
+                ], remove=True)
+        except workers.PoolFullError:
+            os.remove(path)
+            raise tornado.web.HTTPError(503, "Resize queue is full")
+
+    def on_resize(self, recipe, renditions):
+        self.async_backend.run(
+            self.read_renditions, renditions,
+            callback=functools.partial(self.on_read, recipe))
+
+    def read_renditions(self, renditions):
+        for image in renditions:
+            image["data"] = read_temp_file(image.pop("path"))
+        return renditions
+
+    def on_read(self, recipe, renditions):
+        full, thumb = renditions
         resized = {"full": full, "thumb": thumb}
         if full["width"] < 300 or full["height"] < 300:
             self.set_error_message(
@@ -242,119 +462,266 @@ class UploadHandler(BaseHandler):
         images[image_size]["uploaded"] = True
         images[image_size]["hash"] = hash
         if images["thumb"]["uploaded"] and images["full"]["uploaded"]:
-            self.backend.save_photos(recipe, images["full"], images["thumb"])
-            self.redirect(self.reverse_url("recipe", recipe["slug"]))
-            url = "http://" + self.request.host + \
-                self.reverse_url("recipe", recipe["slug"])
-            # Force Facebook to recrawl the object to get the new image
-            ping_url = "http://developers.facebook.com/tools/lint/?" + \
-                urllib.urlencode({"url": url})
-            client = tornado.httpclient.AsyncHTTPClient()
-            client.fetch(ping_url, self.on_ping)
+            self.async_backend.save_photos(
+                recipe, images["full"], images["thumb"],
+                callback=functools.partial(self.on_save, recipe))
 
-    def on_ping(self, response):
-        if response.error:
-            logging.error("Error refreshing Open Graph page: %r",
-                          response.error)
+    def on_save(self, recipe, result):
+        self.redirect(self.reverse_url("recipe", recipe["slug"]))
+        url = "http://" + self.request.host + \
+            self.reverse_url("recipe", recipe["slug"])
+        # Force Facebook to recrawl the object to get the new image
+        self.backend.scrape_open_graph_object(url)
 
 
 class RecipeHandler(BaseHandler):
+    """Shows a recipe to logged in users and to Facebook's crawler.
+
+    We give every page an ETag and Last-Modified date computed from the
+    data on it, and answer conditional requests with 304 before loading
+    anything else. The crawler sees the same page as anyone logged out, so
+    we also cache its pages, keyed by their ETag.
+    """
     @tornado.web.asynchronous
+    @nonblocking
     def get(self, slug):
-        if "facebookexternalhit" not in self.request.headers["User-Agent"] \
-           and not self.current_user:
+        if "facebookexternalhit" not in \
+           self.request.headers.get("User-Agent", "") and \
+           not self.current_user:
             self.redirect(self.get_login_url())
             return
+        # Pages with a pending message can't come from a cache
+        cacheable = not self.get_secure_cookie("message")
+        validators = [self.application.template_version, self.request.host,
+                      self.locale.code]
+        self.async_backend.run(
+            self.load_recipe, slug, cacheable, validators,
+            callback=self.on_recipe)
+
+    def load_recipe(self, slug, cacheable, validators):
         recipe = self.backend.get_recipe_by_slug(slug)
         if not recipe:
             raise tornado.web.HTTPError(404)
-        self.render("recipe.html", recipe=recipe)
+        photo = recipe["photo"]
+        clipped, cooked = self.backend.get_recipe_activity_times(recipe)
+        validators += [recipe["id"], recipe["updated"], clipped, cooked,
+                       photo["full"]["hash"] if photo else None]
+        times = [recipe["updated"], clipped, cooked,
+                 photo["created"] if photo else None]
+        user = self.current_user
+        if user:
+            head = self.backend.get_timeline_head(user)
+            friends = self.backend.get_friends_who_clipped(user, recipe)
+            validators += [
+                user["id"], user["updated"], head,
+                self.backend.recipe_is_clipped(user, recipe),
+                [(f["id"], f["updated"]) for f in friends]]
+            times += [user["updated"], head]
+            times += [f["updated"] for f in friends]
+        etag = '"' + hashlib.sha1(repr(validators)).hexdigest() + '"'
+        modified = max(t for t in times if t)
+        if cacheable and self.not_modified(etag, modified):
+            return recipe, etag, modified, False
+        if user:
+            self.backend.get_clip_count(recipe)
+            self.prefetch_activity(6)
+        return recipe, etag, modified, True
+
+    def not_modified(self, etag, modified):
+        """Returns whether the request's validators match the given ones."""
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match:
+            tags = [t.strip() for t in if_none_match.split(",")]
+            return etag in tags or "*" in tags
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        if if_modified_since:
+            date = email.utils.parsedate(if_modified_since)
+            return date is not None and \
+                modified <= datetime.datetime(*date[:6])
+        return False
+
+    def on_recipe(self, result):
+        recipe, etag, modified, changed = result
+        self.set_header("Etag", etag)
+        self.set_header("Last-Modified", modified)
+        self.set_header("Cache-Control", "%s, max-age=0, must-revalidate" %
+                        ("private" if self.current_user else "public"))
+        if not changed:
+            self.set_status(304)
+            self.finish()
+            return
+        if self.current_user:
+            self.render("recipe.html", recipe=recipe)
+            return
+        pages = self.backend.caches["pages"]
+        html = pages.get(etag)
+        if html is None:
+            html = self.render_string(
+                "recipe.html", recipe=recipe, error_message=None)
+            pages.set(etag, html)
+        self.finish(html)
 
 
 class CookbookHandler(BaseHandler):
+    """Shows a user's cookbook a page at a time, newest recipes first.
+
+    With a fragment argument, we return the page as JSON holding its HTML
+    and the URL of the next page, for the "more" links on our pages.
+    """
+    @tornado.web.asynchronous
+    @nonblocking
     def get(self, id):
+        self.async_backend.run(
+            self.load_recipes, id, self.get_cursor("before"),
+            bool(self.get_argument("fragment", None)),
+            callback=self.on_recipes)
+
+    def load_recipes(self, id, before, fragment):
         user = self.backend.get_user(id)
         if not user:
             raise tornado.web.HTTPError(404)
-        recipes = self.backend.get_recently_clipped_recipes([user["id"]])
-        self.render("cookbook.html", user=user, recipes=recipes)
+        recipes, next = self.backend.get_clipped_recipe_page(
+            user, options.page_size, before)
+        if not fragment:
+            self.prefetch_activity(10)
+        return user, recipes, next, fragment
+
+    def on_recipes(self, result):
+        user, recipes, next, fragment = result
+        next_url = self.cookbook_page_url(user, next)
+        if fragment:
+            self.write_json({
+                "html": self.ui.modules.RecipeList(recipes),
+                "next": next_url,
+            })
+            return
+        self.render("cookbook.html", user=user, recipes=recipes,
+                    next_url=next_url)
 
 
 class CategoryHandler(BaseHandler):
+    @tornado.web.asynchronous
+    @nonblocking
     @tornado.web.authenticated
     def get(self):
         category = self.get_argument("name")
+        self.async_backend.run(
+            self.load_recipes, category,
+            callback=functools.partial(self.on_recipes, category))
+
+    def load_recipes(self, category):
         recipes = self.backend.get_recently_clipped_recipes(
             [self.current_user.id], category=category)
         recipes.sort(key=lambda r: r["title"].lower())
-        friend_recipes = self.backend.get_recently_clipped_recipes(
-            self.backend.get_friend_ids(self.current_user), category=category,
-            exclude_ids=[r["id"] for r in recipes])[:4]
+        friend_recipes = self.backend.get_friends_recently_clipped_recipes(
+            self.current_user, 4, category=category,
+            exclude_ids=[r["id"] for r in recipes])
+        self.prefetch_clips(recipes + friend_recipes)
+        self.prefetch_activity(10)
+        return recipes, friend_recipes
+
+    def on_recipes(self, category, result):
+        recipes, friend_recipes = result
         self.render("category.html", category=category, recipes=recipes,
                     friend_recipes=friend_recipes)
 
 
+class SearchHandler(BaseHandler):
+    @tornado.web.asynchronous
+    @nonblocking
+    @tornado.web.authenticated
+    def get(self):
+        query = self.get_argument("q", "").strip()
+        self.async_backend.run(
+            self.load_recipes, query,
+            callback=functools.partial(self.on_recipes, query))
+
+    def load_recipes(self, query):
+        if not query:
+            return []
+        recipes = self.backend.search_recipes(self.current_user, query)
+        if recipes:
+            self.prefetch_clips(recipes)
+        self.prefetch_activity(10)
+        return recipes
+
+    def on_recipes(self, query, recipes):
+        self.render("search.html", query=query, recipes=recipes)
+
+
 class EditHandler(BaseHandler):
+    @tornado.web.asynchronous
+    @nonblocking
     @tornado.web.authenticated
     def get(self):
         id = self.get_argument("id", None)
+        self.async_backend.run(self.load_recipe, id, callback=self.on_recipe)
+
+    def load_recipe(self, id):
         recipe = self.backend.get_recipe(int(id)) if id else None
         if recipe and recipe["author_id"] != self.current_user["id"]:
             raise tornado.web.HTTPError(403)
         categories = self.backend.get_categories(self.current_user)
+        return recipe, categories
+
+    def on_recipe(self, result):
+        recipe, categories = result
         self.render("edit.html", recipe=recipe, categories=categories)
 
+    @tornado.web.asynchronous
+    @nonblocking
     @tornado.web.authenticated
     def post(self):
-        id = self.get_argument("id", None)
+        self.async_backend.run(
+            self.save_recipe, self.get_argument("id", None),
+            title=self.get_argument("title"),
+            category=self.get_argument("category"),
+            description=self.get_argument("description"),
+            instructions=self.get_argument("instructions", ""),
+            ingredients=self.get_argument("ingredients", ""),
+            callback=self.on_save)
+
+    def save_recipe(self, id, **fields):
         recipe = self.backend.get_recipe(int(id)) if id else None
         if recipe:
             created = False
             if recipe["author_id"] != self.current_user["id"]:
                 raise tornado.web.HTTPError(403)
-            self.backend.update_recipe(
-                id=recipe["id"],
-                title=self.get_argument("title"),
-                category=self.get_argument("category"),
-                description=self.get_argument("description"),
-                instructions=self.get_argument("instructions", ""),
-                ingredients=self.get_argument("ingredients", ""),
-            )
+            self.backend.update_recipe(id=recipe["id"], **fields)
         else:
             created = True
-            id = self.backend.create_recipe(
-                author=self.current_user,
-                title=self.get_argument("title"),
-                category=self.get_argument("category"),
-                description=self.get_argument("description"),
-                instructions=self.get_argument("instructions", ""),
-                ingredients=self.get_argument("ingredients", ""),
-            )
+            id = self.backend.create_recipe(author=self.current_user, **fields)
             self.backend.clip_recipe(user=self.current_user, recipe_id=id)
-        recipe = self.backend.get_recipe(int(id))
+        return self.backend.get_recipe(int(id)), created
+
+    def on_save(self, result):
+        recipe, created = result
         self.redirect(self.reverse_url("recipe", recipe["slug"]))
         if not options.silent and created:
             url = "http://" + self.request.host + \
                 self.reverse_url("recipe", recipe["slug"])
             self.backend.save_open_graph_action(
-                type="clip", recipe=url, user=self.current_user,
-                callback=self.on_open_graph)
-
-    def on_open_graph(self, response):
-        if response.error:
-            logging.error("Error publishing clip to open graph: %r",
-                          response.error)
+                type="clip", recipe=url, user=self.current_user)
 
 
 class ClipHandler(BaseHandler):
+    @tornado.web.asynchronous
+    @nonblocking
     @tornado.web.authenticated
     def post(self):
-        recipe_id = int(self.get_argument("recipe"))
+        self.async_backend.run(
+            self.clip_recipe, int(self.get_argument("recipe")),
+            callback=self.on_clip)
+
+    def clip_recipe(self, recipe_id):
         recipe = self.backend.get_recipe(recipe_id)
         if not recipe:
             raise tornado.web.HTTPError(404)
         if not options.silent:
             self.backend.clip_recipe(self.current_user, recipe["id"])
+        return recipe
+
+    def on_clip(self, recipe):
         self.write_json({
             "html": self.ui.modules.ActivityItem(
                 self.current_user, recipe, datetime.datetime.utcnow(),
@@ -364,24 +731,27 @@ class ClipHandler(BaseHandler):
             self.reverse_url("recipe", recipe["slug"])
         if not options.silent:
             self.backend.save_open_graph_action(
-                type="clip", recipe=url, user=self.current_user,
-                callback=self.on_open_graph)
-
-    def on_open_graph(self, response):
-        if response.error:
-            logging.error("Error publishing clip to open graph: %r",
-                          response.error)
+                type="clip", recipe=url, user=self.current_user)
 
 
 class CookHandler(BaseHandler):
+    @tornado.web.asynchronous
+    @nonblocking
     @tornado.web.authenticated
     def post(self):
-        recipe_id = int(self.get_argument("recipe"))
+        self.async_backend.run(
+            self.cook_recipe, int(self.get_argument("recipe")),
+            callback=self.on_cook)
+
+    def cook_recipe(self, recipe_id):
         recipe = self.backend.get_recipe(recipe_id)
         if not recipe:
             raise tornado.web.HTTPError(404)
         if not options.silent:
             self.backend.cook_recipe(self.current_user, recipe["id"])
+        return recipe
+
+    def on_cook(self, recipe):
         self.write_json({
             "html": self.ui.modules.ActivityItem(
                 self.current_user, recipe, datetime.datetime.utcnow(),
@@ -391,13 +761,7 @@ class CookHandler(BaseHandler):
             self.reverse_url("recipe", recipe["slug"])
         if not options.silent:
             self.backend.save_open_graph_action(
-                type="cook", recipe=url, user=self.current_user,
-                callback=self.on_open_graph)
-
-    def on_open_graph(self, response):
-        if response.error:
-            logging.error("Error publishing cook to open graph: %r (%r)",
-                          response.error, response.body)
+                type="cook", recipe=url, user=self.current_user)
 
 
 class LoginHandler(BaseHandler):
@@ -423,7 +787,7 @@ class LoginHandler(BaseHandler):
             return
         redirect_uri = self.request.protocol + "://" + self.request.host + \
             self.request.path + "?" + urllib.urlencode({"next": next})
-        url = "https://graph.facebook.com/oauth/access_token?" + \
+        url = options.facebook_graph_url + "oauth/access_token?" + \
             urllib.urlencode({
                 "client_id": options.facebook_app_id,
                 "client_secret": options.facebook_app_secret,
@@ -440,7 +804,7 @@ class LoginHandler(BaseHandler):
             self.redirect(self.reverse_url("home"))
             return
         access_token = urlparse.parse_qs(response.body)["access_token"][-1]
-        url = "https://graph.facebook.com/me?" + urllib.urlencode({
+        url = options.facebook_graph_url + "me?" + urllib.urlencode({
             "access_token": access_token,
         })
         client = tornado.httpclient.AsyncHTTPClient()
@@ -453,55 +817,320 @@ class LoginHandler(BaseHandler):
             self.redirect(self.reverse_url("home"))
             return
         profile = json.loads(response.body)
-        url = "https://graph.facebook.com/me/friends?" + urllib.urlencode({
-            "access_token": access_token,
-        })
-        client = tornado.httpclient.AsyncHTTPClient()
-        client.fetch(url, functools.partial(
-            self.on_friends, access_token, profile))
+        self.async_backend.run(
+            self.save_user, profile, access_token,
+            callback=functools.partial(self.on_save, profile, access_token))
 
-    def on_friends(self, access_token, profile, response):
-        if response.error:
+    def save_user(self, profile, access_token):
+        self.backend.create_user(profile, access_token)
+        return bool(self.backend.get_friend_ids(profile))
+
+    def on_save(self, profile, access_token, has_friends):
+        sync = FriendSync(self.backend, profile, access_token)
+        if has_friends:
+            # Returning users already see their friends, so we bring the
+            # list up to date after sending them on their way
+            sync.start()
+            self.on_sync(profile, True)
+        else:
+            sync.start(functools.partial(self.on_sync, profile))
+
+    def on_sync(self, profile, ok):
+        if not ok:
             self.set_error_message(
                 "An error occured with Facebook. Please try again later.")
             self.redirect(self.reverse_url("home"))
             return
-        friend_ids = [f["id"] for f in json.loads(response.body)["data"]]
-        self.backend.create_user(profile, access_token)
-        self.backend.update_friends(profile, friend_ids)
         self.set_secure_cookie("uid", profile["id"])
         self.redirect(self.get_argument("next", self.reverse_url("home")))
 
 
+class FriendSync(object):
+    """Brings a user's friends in cookbook_friends up to date with Facebook.
+
+    We fetch /me/friends a page at a time, adding the edges for each page
+    while we fetch the next. Once we have every page, we remove the edges to
+    people who are no longer friends. Only edges that changed are written.
+
+    The sync does not depend on the request that started it, so it can
+    keep going after the response is finished. start() calls its callback
+    with True if the sync succeeded and False otherwise.
+    """
+    def __init__(self, backend, user, access_token, page_size=1000):
+        self.backend = backend
+        self.user = user
+        self.url = options.facebook_graph_url + "me/friends?" + \
+            urllib.urlencode({"access_token": access_token,
+                              "limit": page_size, "fields": "id"})
+        self.friend_ids = set()
+        self.fetching = False
+        self.writing = 0
+        self.finished = False
+        self.callback = None
+
+    def start(self, callback=None):
+        self.callback = callback
+        # Errors here shouldn't go to a request that may have finished
+        with tornado.stack_context.NullContext():
+            self._fetch(self.url)
+
+    def _fetch(self, url):
+        self.fetching = True
+        client = tornado.httpclient.AsyncHTTPClient()
+        client.fetch(url, self._on_page)
+
+    def _on_page(self, response):
+        self.fetching = False
+        if self.finished:
+            return
+        if response.error:
+            logging.error("Error fetching friends of %s: %r",
+                          self.user["id"], response.error)
+            self._finish(False)
+            return
+        try:
+            page = json.loads(response.body)
+            ids = [f["id"] for f in page.get("data", [])]
+            next_url = page.get("paging", {}).get("next")
+        except Exception:
+            # We run outside any request, so nothing else would tell the
+            # caller we stopped
+            logging.error("Bad friends page for %s: %r", self.user["id"],
+                          response.body[:200], exc_info=True)
+            self._finish(False)
+            return
+        self.friend_ids.update(ids)
+        if ids and next_url:
+            self._fetch(next_url)
+        self._write(self.backend.add_friends, ids)
+
+    def _write(self, fn, *args):
+        self.writing += 1
+        try:
+            self.backend.pool.submit(
+                self._on_write, spool.log_errors, fn, self.user, *args)
+        except workers.PoolFullError:
+            logging.error("Database queue is full; not syncing friends of %s",
+                          self.user["id"])
+            self._on_write(None)
+
+    def _on_write(self, result):
+        self.writing -= 1
+        if self.finished:
+            return
+        if result is None:
+            self._finish(False)
+        elif not self.fetching and not self.writing:
+            if self.friend_ids is None:
+                self._finish(True)
+            else:
+                # We have every page, so anyone we haven't seen is gone
+                friend_ids, self.friend_ids = self.friend_ids, None
+                self._write(self.backend.remove_friends_except, friend_ids)
+
+    def _finish(self, ok):
+        if self.finished:
+            return
+        self.finished = True
+        if self.callback:
+            callback, self.callback = self.callback, None
+            callback(ok)
+
+
+class AsyncBackend(object):
+    """Runs the methods of the given Backend on its thread pool.
+
+    Every method of Backend is available here with an additional callback
+    keyword argument. run() calls an arbitrary function on the pool, so
+    handlers can make a series of Backend calls in a single job.
+    """
+    def __init__(self, backend):
+        self._backend = backend
+
+    def run(self, fn, *args, **kwargs):
+        callback = kwargs.pop("callback")
+        try:
+            self._backend.pool.submit(callback, fn, *args, **kwargs)
+        except workers.PoolFullError:
+            raise tornado.web.HTTPError(503, "Database queue is full")
+
+    def __getattr__(self, name):
+        return functools.partial(self.run, getattr(self._backend, name))
+
+
 class Backend(object):
-    def __init__(self):
-        self.db = tornado.database.Connection(
+    def __init__(self, close_fds=(), services=True):
+        # The maintenance commands pass services=False, so they don't fork
+        # resize processes, send spooled Open Graph calls or run the
+        # periodic refreshes, flushes and trims the servers do
+        self.resizer = None
+        if services:
+            # Fork the resize processes before we start any threads or
+            # create the IOLoop, and without any listening sockets we
+            # inherited
+            self.resizer = workers.ProcessPool(
+                options.resize_processes,
+                max_queue=options.resize_queue_size,
+                timeout=options.resize_timeout, close_fds=close_fds,
+                on_discard=remove_temp_files)
+        self.db = dbpool.ConnectionPool(
             host=options.mysql_host, database=options.mysql_database,
-            user=options.mysql_user, password=options.mysql_password)
-        self.s3 = aws.S3Client(options.aws_s3_bucket)
+            user=options.mysql_user, password=options.mysql_password,
+            min_size=options.db_pool_min_size,
+            max_size=options.db_pool_max_size,
+            idle_timeout=options.db_idle_timeout,
+            query_timeout=options.db_query_timeout,
+            wait_timeout=options.db_wait_timeout)
+        self.pool = workers.ThreadPool(
+            options.db_threads, max_queue=options.db_queue_size)
+        self.s3 = aws.S3Client(
+            options.aws_s3_bucket,
+            max_in_flight=options.aws_s3_max_connections,
+            max_retries=options.aws_s3_retries,
+            request_timeout=options.aws_s3_timeout,
+            known_hashes=aws.HashIndex(options.cdn_index_path)
+            if options.cdn_index_path else None, pool=self.pool)
+        self.caches = {
+            "users": cache.LRUCache(
+                options.cache_size, options.user_cache_ttl),
+            "recipes": cache.LRUCache(
+                options.cache_size, options.recipe_cache_ttl),
+            "photos": cache.LRUCache(
+                options.cache_size, options.photo_cache_ttl),
+            "slugs": cache.LRUCache(options.cache_size),
+            "slug_suffixes": cache.LRUCache(options.cache_size),
+            "fragments": cache.LRUCache(options.fragment_cache_size),
+            "pages": cache.LRUCache(options.page_cache_size),
+        }
+        self._versions = {}
+        self._versions_lock = threading.Lock()
+        self._next_version = itertools.count(1)
+        self.graph_http = tornado.httpclient.AsyncHTTPClient()
+        self.graph_spool = spool.Spool(
+            options.graph_spool_path, self._send_graph_batch,
+            rate_limit=(options.graph_rate_limit, 60), pool=self.pool)
+        self._pending_counts = {}
+        self._counts_lock = threading.Lock()
+        self._grown_timelines = set()
+        self._timelines_lock = threading.Lock()
+        self._loaded = None
+        if services:
+            self.graph_spool.start()
+            tornado.ioloop.PeriodicCallback(
+                functools.partial(self.pool.submit, lambda r: None,
+                                  self.flush_counts),
+                options.count_flush_interval * 1000).start()
+            tornado.ioloop.PeriodicCallback(
+                functools.partial(self.pool.submit, lambda r: None,
+                                  self.trim_timelines),
+                options.activity_trim_interval * 1000).start()
+        self.graph = None
+        if options.friend_graph and services:
+            self.graph = graph.FriendGraph()
+            self.clips = graph.ClipIndex(self.graph)
+            self._graph_ready = threading.Event()
+            self._graph_lock = threading.Lock()
+            self._graph_since = None
+            self._graph_loaded_at = None
+            refresh = functools.partial(
+                self.pool.submit, lambda r: None, self.refresh_friend_graph)
+            tornado.ioloop.IOLoop.instance().add_callback(refresh)
+            tornado.ioloop.PeriodicCallback(
+                refresh, options.friend_graph_refresh_interval * 1000).start()
+        self.search_index = search.SearchIndex()
+        self._search_ready = threading.Event()
+        self._search_lock = threading.Lock()
+        self._search_saved_at = None
+        if services:
+            refresh = functools.partial(
+                self.pool.submit, lambda r: None, self.refresh_search_index)
+            tornado.ioloop.IOLoop.instance().add_callback(refresh)
+            tornado.ioloop.PeriodicCallback(
+                refresh, options.search_refresh_interval * 1000).start()
 
     @classmethod
-    def instance(cls):
+    def instance(cls, **kwargs):
         if not hasattr(cls, "_instance"):
-            cls._instance = cls()
+            cls._instance = cls(**kwargs)
         return cls._instance
 
-    def save_open_graph_action(self, user, type, callback, **properties):
-        url = "https://graph.facebook.com/me/" + options.facebook_canvas_id + \
-            ":" + type
+    def scoped(self):
+        """Returns a copy of this backend that memoizes lookups.
+
+        BaseHandler makes one of these for every request, so the UI modules
+        on a page share the users, recipes, photos and friend lists they look
+        up instead of each going back to MySQL. Lookups for ids we have not
+        seen yet are merged into a single IN query.
+        """
+        backend = copy.copy(self)
+        backend._loaded = {}
+        if options.query_count_header:
+            backend.db = dbpool.QueryCounter(self.db)
+        return backend
+
+    def save_open_graph_action(self, user, type, **properties):
+        """Queues the publishing of an Open Graph action for the user."""
         properties.update({
             "access_token": user["access_token"],
         })
-        client = tornado.httpclient.AsyncHTTPClient()
-        client.fetch(url, method="POST", body=urllib.urlencode(properties),
-                     callback=callback)
+        self.graph_spool.put("user:" + user["id"], {
+            "method": "POST",
+            "relative_url": "me/" + options.facebook_canvas_id + ":" + type,
+            "body": urllib.urlencode(properties),
+        })
+
+    def scrape_open_graph_object(self, url):
+        """Queues a request for Facebook to recrawl the given URL."""
+        self.graph_spool.put("scrape", {
+            "method": "POST",
+            "relative_url": "?" + urllib.urlencode(
+                {"id": url, "scrape": "true"}),
+        }, dedupe="scrape:" + url)
+
+    def retry_graph_jobs(self):
+        """Requeues the Open Graph calls we gave up on."""
+        logging.info("Requeued %d Open Graph calls",
+                     self.graph_spool.retry_dead())
+
+    def _send_graph_batch(self, jobs, callback):
+        """Sends spooled Graph API calls to Facebook as one batch request.
+
+        Each call carries its own user's access token, and the batch as a
+        whole is made with our app's token.
+        """
+        def on_response(response):
+            if response.error:
+                logging.warning("Error sending Graph API batch: %r",
+                                response.error)
+                callback([(False, str(response.error))] * len(jobs))
+                return
+            results = []
+            for result in json.loads(response.body):
+                # Facebook returns null for calls it didn't get to in time
+                if result is None:
+                    results.append((False, "Timed out"))
+                elif result["code"] < 300:
+                    results.append(None)
+                else:
+                    # Retry server errors, but not bad tokens or requests
+                    results.append((result["code"] < 500, result["body"]))
+            callback(results)
+        self.graph_http.fetch(
+            options.facebook_graph_url, method="POST",
+            body=urllib.urlencode({
+                "access_token": options.facebook_app_id + "|" +
+                    options.facebook_app_secret,
+                "batch": json.dumps([job["payload"] for job in jobs]),
+            }), callback=on_response)
 
     def get_user(self, id):
         return self.get_users([id]).get(id)
 
     def get_users(self, ids):
-        if not ids:
-            return {}
+        return self._load_many("users", ids, functools.partial(
+            self._cached, "users", query=self._query_users))
+
+    def _query_users(self, ids):
         users = self.db.query(
             "SELECT * FROM cookbook_users WHERE id IN (" +
             ",".join(["%s"] * len(ids)) + ")", *ids)
@@ -520,71 +1149,307 @@ class Backend(object):
             profile["id"], profile["name"], profile["link"], profile["gender"],
             access_token, profile["name"], profile["link"], profile["gender"],
             access_token)
+        self.caches["users"].delete(profile["id"])
+        self._forget("users", profile["id"])
+        self._bump_version("user", profile["id"])
+
+    def add_friends(self, user, friend_ids):
+        """Adds edges between the user and the given friends who use the app.
 
-    def update_friends(self, user, friend_ids):
+        We only write edges that aren't already there, and return the number
+        of new friends.
+        """
         if not friend_ids:
-            return
-        friend_ids = [r["id"] for r in self.db.query(
-            "SELECT * FROM cookbook_users WHERE id IN (" +
+            return 0
+        registered = [r["id"] for r in self.db.query(
+            "SELECT id FROM cookbook_users WHERE id IN (" +
             ",".join(["%s"] * len(friend_ids)) + ")", *friend_ids)]
-        if not friend_ids:
-            return
-        rows = [(user["id"], fid) for fid in friend_ids]
-        rows += [(fid, user["id"]) for fid in friend_ids]
+        if not registered:
+            return 0
+        existing = set(r["friend_id"] for r in self.db.query(
+            "SELECT friend_id FROM cookbook_friends WHERE user_id = %s AND "
+            "friend_id IN (" + ",".join(["%s"] * len(registered)) + ")",
+            user["id"], *registered))
+        new_ids = [fid for fid in registered if fid not in existing]
+        if not new_ids:
+            return 0
+        rows = [(user["id"], fid) for fid in new_ids]
+        rows += [(fid, user["id"]) for fid in new_ids]
         self.db.executemany(
             "INSERT IGNORE INTO cookbook_friends (user_id, friend_id) "
             "VALUES (%s,%s)", rows)
+        # New friends see each other's recent activity right away
+        self._copy_activity([user["id"]], new_ids)
+        self._copy_activity(new_ids, [user["id"]])
+        self._forget("friend_ids", user["id"])
+        for fid in new_ids:
+            self._forget("friend_ids", fid)
+        if self.graph is not None:
+            self.graph.add_edges(rows)
+        return len(new_ids)
+
+    def remove_friends_except(self, user, friend_ids):
+        """Removes the edges between the user and anyone not in friend_ids.
+
+        Call this with the user's complete list of friends from Facebook.
+        We return the number of friends removed.
+        """
+        friend_ids = set(friend_ids)
+        gone = [r["friend_id"] for r in self.db.query(
+            "SELECT friend_id FROM cookbook_friends WHERE user_id = %s",
+            user["id"]) if r["friend_id"] not in friend_ids]
+        if not gone:
+            return 0
+        in_gone = "IN (" + ",".join(["%s"] * len(gone)) + ")"
+        self.db.execute(
+            "DELETE FROM cookbook_friends WHERE user_id = %s AND friend_id " +
+            in_gone, user["id"], *gone)
+        self.db.execute(
+            "DELETE FROM cookbook_friends WHERE friend_id = %s AND user_id " +
+            in_gone, user["id"], *gone)
+        self.db.execute(
+            "DELETE FROM cookbook_activity WHERE user_id = %s AND actor_id " +
+            in_gone, user["id"], *gone)
+        self.db.execute(
+            "DELETE FROM cookbook_activity WHERE actor_id = %s AND user_id " +
+            in_gone, user["id"], *gone)
+        self._forget("friend_ids", user["id"])
+        for fid in gone:
+            self._forget("friend_ids", fid)
+        if self.graph is not None:
+            self.graph.remove_edges(
+                [(user["id"], fid) for fid in gone] +
+                [(fid, user["id"]) for fid in gone])
+        return len(gone)
+
+    def _graph_loaded(self):
+        return self.graph is not None and self._graph_ready.is_set()
 
     def get_friend_ids(self, user):
+        if self._graph_loaded():
+            return self.graph.friend_ids(user["id"])
+        return self._load_one("friend_ids", user["id"], lambda: [
+            r["friend_id"] for r in self.db.query(
+                "SELECT friend_id FROM cookbook_friends WHERE user_id = %s",
+                user["id"])])
+
+    def get_mutual_friend_ids(self, user, other):
+        """Returns the ids of the people who are friends of both users."""
+        if self._graph_loaded():
+            return self.graph.mutual_friend_ids(user["id"], other["id"])
         return [r["friend_id"] for r in self.db.query(
-            "SELECT friend_id FROM cookbook_friends WHERE user_id = %s",
-            user["id"])]
+            "SELECT a.friend_id FROM cookbook_friends a "
+            "JOIN cookbook_friends b ON b.friend_id = a.friend_id "
+            "WHERE a.user_id = %s AND b.user_id = %s",
+            user["id"], other["id"])]
+
+    def refresh_friend_graph(self):
+        """Brings the in-memory friend graph and clips up to date with MySQL.
+
+        The first call loads every edge and clip, and later calls load only
+        the ones created since the last call. Friends removed by other
+        processes stay in our graph until the next full load, which we do
+        every --friend_graph_reload_interval seconds. Until the first load
+        finishes, friend and clip lookups go to MySQL.
+        """
+        if not self._graph_lock.acquire(False):
+            return
+        try:
+            # Use MySQL's clock, since it sets the created column
+            now = self.db.get("SELECT NOW() AS now")["now"]
+            if self._graph_loaded_at is None or \
+               time.time() - self._graph_loaded_at > \
+               options.friend_graph_reload_interval:
+                self._load_friend_graph()
+            else:
+                # Look back a little for transactions that committed late
+                since = self._graph_since - datetime.timedelta(seconds=10)
+                self.graph.add_edges(
+                    (r["user_id"], r["friend_id"]) for r in self.db.iter(
+                        "SELECT user_id, friend_id FROM cookbook_friends "
+                        "WHERE created >= %s", since))
+                self.clips.add_clips(self._iter_clips(
+                    "WHERE created >= %s", since))
+            self._graph_since = now
+        finally:
+            self._graph_lock.release()
+
+    def _load_friend_graph(self):
+        start = time.time()
+        self.graph.load((r["user_id"], r["friend_id"]) for r in self.db.iter(
+            "SELECT user_id, friend_id FROM cookbook_friends"))
+        self.clips.load(self._iter_clips())
+        self._graph_loaded_at = time.time()
+        self._graph_ready.set()
+        stats = self.graph.stats()
+        logging.info("Loaded %d friend edges for %d users in %.1fs; "
+                     "%d bytes, %.1f per edge", stats["edges"],
+                     stats["users"], self._graph_loaded_at - start,
+                     stats["bytes"], stats["bytes_per_edge"])
+        stats = self.clips.stats()
+        logging.info("Loaded %d clips of %d recipes; %d bytes, %.1f per "
+                     "clip", stats["clips"], stats["recipes"],
+                     stats["bytes"], stats["bytes_per_clip"])
+
+    def _iter_clips(self, where="", *args):
+        """Yields (recipe_id, user_id, time) for rows of cookbook_clipped."""
+        for row in self.db.iter(
+                "SELECT recipe_id, user_id, created FROM cookbook_clipped " +
+                where, *args):
+            yield (row["recipe_id"], row["user_id"],
+                   calendar.timegm(row["created"].utctimetuple()))
+
+    def _friends_filter(self, user, column, include_self=False):
+        """Returns SQL that limits column to the ids of the user's friends.
+
+        We return a JOIN clause and its arguments, followed by a WHERE
+        condition and its arguments. Up to --friend_join_threshold friends,
+        we list their ids in the condition. Beyond that, the query would
+        grow with every friend, so we join cookbook_friends in MySQL
+        instead. If include_self is given, we include the user's own id. If
+        there's nobody to include, we return None.
+        """
+        friend_ids = self.get_friend_ids(user)
+        if len(friend_ids) <= options.friend_join_threshold:
+            ids = friend_ids + [user["id"]] if include_self else friend_ids
+            if not ids:
+                return None
+            return ("", [], column + " IN (" + ",".join(["%s"] * len(ids)) +
+                    ")", ids)
+        if include_self:
+            return (" JOIN (SELECT friend_id FROM cookbook_friends WHERE "
+                    "user_id = %s UNION ALL SELECT %s) f ON f.friend_id = " +
+                    column, [user["id"], user["id"]], "TRUE", [])
+        return (" JOIN cookbook_friends f ON f.friend_id = " + column,
+                [], "f.user_id = %s", [user["id"]])
 
     def get_recipe(self, id):
         return self.get_recipes([id]).get(id)
 
     def get_recipe_by_slug(self, slug):
-        recipe = self.db.get(
-            "SELECT * FROM cookbook_recipes WHERE slug = %s", slug)
-        if not recipe:
-            return None
-        self._fill_recipes([recipe])
-        return recipe
+        # Slugs never change once assigned, so we cache them indefinitely
+        id = self.caches["slugs"].get(slug)
+        if id is None:
+            row = self.db.get(
+                "SELECT id FROM cookbook_recipes WHERE slug = %s", slug)
+            if not row:
+                return None
+            id = row["id"]
+            self.caches["slugs"].set(slug, id)
+        return self.get_recipe(id)
+
+    # cookbook_categories keys on this many characters of the category
+    MAX_CATEGORY_LENGTH = 255
+
+    # Times we try to insert a recipe when its slug keeps being taken
+    SLUG_ATTEMPTS = 10
 
     def create_recipe(self, title, category, description, ingredients,
                       instructions, author):
+        category = category[:self.MAX_CATEGORY_LENGTH]
         slug_base = title.replace(" ", "-").lower()
         valid_letters = string.ascii_letters + string.digits + "-"
         slug_base = "".join(c for c in slug_base if c in valid_letters)[:90]
-        tries = 0
-        while True:
+        for attempt in xrange(self.SLUG_ATTEMPTS):
+            if attempt < self.SLUG_ATTEMPTS / 2:
+                suffix = self._next_slug_suffix(slug_base)
+            else:
+                # Other processes keep taking the next suffix first, so
+                # try one they are unlikely to want
+                suffix = random.randint(10 ** 7, 10 ** 8 - 1)
+            slug = slug_base + "-" + str(suffix) if suffix else slug_base
             try:
-                slug = slug_base + "-" + str(tries) if tries > 0 else slug_base
-                return self.db.execute(
+                id = self.db.execute(
                     "INSERT INTO cookbook_recipes (title,category,description,"
-                    "ingredients,instructions,author_id,slug,created) VALUES "
-                    "(%s,%s,%s,%s,%s,%s,%s,UTC_TIMESTAMP)", title, category,
-                    description, ingredients, instructions, author["id"], slug)
+                    "ingredients,instructions,description_html,"
+                    "ingredients_html,instructions_html,html_version,"
+                    "author_id,slug,created) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,"
+                    "%s,%s,%s,UTC_TIMESTAMP)", title, category, description,
+                    ingredients, instructions, markdown(description),
+                    markdown(ingredients), markdown(instructions),
+                    MARKDOWN_VERSION, author["id"], slug)
+                break
             except tornado.database.IntegrityError:
-                tries += 1
+                if attempt == self.SLUG_ATTEMPTS - 1:
+                    raise
+                # Another process took the slug first, so look again
+                self.caches["slug_suffixes"].delete(slug_base)
+        # The random suffixes don't count toward the next one
+        if suffix < 10 ** 7:
+            self.caches["slug_suffixes"].set(slug_base, suffix)
+        self.caches["slugs"].set(slug, id)
+        self.search_index.add({
+            "id": id, "title": title, "category": category,
+            "ingredients": ingredients, "description": description})
+        return id
+
+    def _next_slug_suffix(self, base):
+        """Returns the first unused suffix for slugs made from base.
+
+        The bare base has suffix 0, and the others look like "base-1". We
+        remember the highest suffix we have seen for each base, so that
+        creating a recipe usually takes just the INSERT. We only count
+        suffixes of up to seven digits, which leaves out the random
+        eight-digit ones create_recipe falls back to, so they don't become
+        the base's next suffix.
+        """
+        last = self.caches["slug_suffixes"].get(base)
+        if last is None:
+            last = self.db.get(
+                "SELECT MAX(IF(slug = %s, 0, CAST(SUBSTRING(slug, %s) AS "
+                "UNSIGNED))) AS suffix FROM cookbook_recipes WHERE slug = %s "
+                "OR (slug LIKE %s AND slug REGEXP %s)", base, len(base) + 2,
+                base, base + "-%", "^" + base + "-[0-9]{1,7}$")["suffix"]
+            if last is None:
+                return 0
+        return last + 1
 
     def update_recipe(self, id, title, category, description, ingredients,
                       instructions):
-        return self.db.execute(
+        category = category[:self.MAX_CATEGORY_LENGTH]
+        old = self.db.get(
+            "SELECT category FROM cookbook_recipes WHERE id = %s", id)
+        self.db.execute(
             "UPDATE cookbook_recipes SET title = %s, category = %s, "
-            "description = %s, ingredients = %s, instructions = %s "
-            "WHERE id = %s", title, category, description, ingredients,
-            instructions, id)
+            "description = %s, ingredients = %s, instructions = %s, "
+            "description_html = %s, ingredients_html = %s, "
+            "instructions_html = %s, html_version = %s WHERE id = %s",
+            title, category, description, ingredients, instructions,
+            markdown(description), markdown(ingredients),
+            markdown(instructions), MARKDOWN_VERSION, id)
+        if old and old["category"] != category:
+            self._move_category(id, old["category"], category)
+        self.search_index.add({
+            "id": int(id), "title": title, "category": category,
+            "ingredients": ingredients, "description": description})
+        self.caches["recipes"].delete(id)
+        self._forget("recipes", id)
+        self._bump_version("recipe", int(id))
 
     def clip_recipe(self, user, recipe_id):
-        self.db.execute(
+        if self.db.execute_rowcount(
             "INSERT IGNORE INTO cookbook_clipped (user_id, recipe_id) "
-            "VALUES (%s,%s)", user["id"], recipe_id)
+            "VALUES (%s,%s)", user["id"], recipe_id):
+            self._count(recipe_id, clips=1)
+            self._publish_activity(user, recipe_id, "clipped")
+            self.db.execute(
+                "INSERT INTO cookbook_categories (user_id, category, recipes) "
+                "SELECT %s, category, 1 FROM cookbook_recipes WHERE id = %s "
+                "ON DUPLICATE KEY UPDATE recipes = recipes + 1",
+                user["id"], recipe_id)
+            self._bump_version("recipe", recipe_id)
+            if self.graph is not None:
+                self.clips.add_clips(
+                    [(recipe_id, user["id"], int(time.time()))])
+        self._forget("clipped", (user["id"], recipe_id))
 
     def cook_recipe(self, user, recipe_id):
         self.db.execute(
             "INSERT IGNORE INTO cookbook_cooked (user_id, recipe_id) "
             "VALUES (%s,%s)", user["id"], recipe_id)
+        self._count(recipe_id, cooks=1)
+        self._publish_activity(user, recipe_id, "cooked")
+        self._bump_version("recipe", recipe_id)
 
     def get_clipped_recipes(self, user):
         recipe_ids = [row["recipe_id"] for row in self.db.query(
@@ -599,28 +1464,98 @@ class Backend(object):
             "(%s,%s,%s,%s,%s,%s,%s)", recipe["id"], full["hash"],
             full["width"], full["height"], thumb["hash"], thumb["width"],
             thumb["height"])
+        self.caches["photos"].delete(recipe["id"])
+        self._forget("photos", recipe["id"])
+        self._forget("recipes", recipe["id"])
+        self._bump_version("recipe", recipe["id"])
 
     def get_recently_clipped_recipes(self, user_ids, num=None,
-                                     exclude_ids=None, category=None):
-        if not user_ids:
+                                     exclude_ids=None, category=None,
+                                     before=None):
+        """Returns the recipes the given users clipped, newest first.
+
+        If before is given, as a (created, recipe_id) cursor, we only return
+        the recipes clipped before that one.
+        """
+        recipe_ids = [row["recipe_id"] for row in self._query_clipped(
+            user_ids, num, exclude_ids, before, category)]
+        recipe_map = self.get_recipes(recipe_ids)
+        return [recipe_map[id] for id in recipe_ids if id in recipe_map]
+
+    def get_friends_recently_clipped_recipes(self, user, num=None,
+                                             exclude_ids=None, category=None):
+        """Returns the recipes the user's friends clipped, newest first."""
+        recipe_ids = [row["recipe_id"] for row in self._query_clipped(
+            None, num, exclude_ids, category=category, friends_of=user)]
+        recipe_map = self.get_recipes(recipe_ids)
+        return [recipe_map[id] for id in recipe_ids if id in recipe_map]
+
+    def get_clipped_recipe_page(self, user, num, before=None):
+        """Returns a page of the recipes the user clipped, newest first.
+
+        We return the recipes along with the cursor to pass as before to get
+        the next page, or None if this is the last page.
+        """
+        rows = self._query_clipped([user["id"]], num + 1, before=before)
+        next = None
+        if len(rows) > num:
+            rows = rows[:num]
+            next = (rows[-1]["created"], rows[-1]["recipe_id"])
+        recipe_map = self.get_recipes([r["recipe_id"] for r in rows])
+        return [recipe_map[r["recipe_id"]] for r in rows
+                if r["recipe_id"] in recipe_map], next
+
+    def _query_clipped(self, user_ids, num=None, exclude_ids=None,
+                       before=None, category=None, friends_of=None):
+        """Returns the recipe_id and created time of clips, newest first.
+
+        We return the clips of the given users, or if friends_of is given,
+        the clips of that user's friends.
+        """
+        if friends_of:
+            users = self._friends_filter(friends_of, "c.user_id")
+        elif user_ids:
+            users = ("", [], "c.user_id IN (" +
+                     ",".join(["%s"] * len(user_ids)) + ")", list(user_ids))
+        else:
+            users = None
+        if not users:
             return []
-        query = "SELECT DISTINCT recipe_id FROM cookbook_clipped WHERE " \
-            "user_id IN (" + ",".join(["%s"] * len(user_ids)) + ")"
-        args = list(user_ids)
+        join, args, where, where_args = users
+        single = not friends_of and len(user_ids) == 1
+        if single:
+            # Keep to the (user_id, created) index, so we read only one page
+            query = "SELECT c.recipe_id, c.created FROM cookbook_clipped c"
+        else:
+            query = "SELECT c.recipe_id, MAX(c.created) AS created FROM " \
+                "cookbook_clipped c"
+        query += join
+        if category:
+            query += " JOIN cookbook_recipes r ON r.id = c.recipe_id"
+        query += " WHERE " + where
+        args += where_args
+        if category:
+            query += " AND r.category = %s"
+            args.append(category)
         if exclude_ids:
-            query += " AND recipe_id NOT IN (" + \
+            query += " AND c.recipe_id NOT IN (" + \
                 ",".join(["%s"] * len(exclude_ids)) + ")"
             args += exclude_ids
-        query += " ORDER BY created DESC"
-        if num is not None:
-            query += " LIMIT " + str(num)
-        recipe_ids = [row["recipe_id"] for row in self.db.query(query, *args)]
-        recipe_map = self.get_recipes(recipe_ids)
-        if category:
-            return [recipe_map[id] for id in recipe_ids
-                    if recipe_map[id]["category"] == category]
+        if before:
+            condition = "(%(c)s < %%s OR (%(c)s = %%s AND c.recipe_id < %%s))"
+            args += [before[0], before[0], before[1]]
+        if single:
+            if before:
+                query += " AND " + condition % {"c": "c.created"}
         else:
-            return [recipe_map[id] for id in recipe_ids]
+            query += " GROUP BY c.recipe_id"
+            if before:
+                query += " HAVING " + condition % {"c": "MAX(c.created)"}
+        query += " ORDER BY %s DESC, c.recipe_id DESC" % (
+            "c.created" if single else "MAX(c.created)")
+        if num is not None:
+            query += " LIMIT " + str(int(num))
+        return self.db.query(query, *args)
 
     def get_recently_cooked_recipes(self, user, num):
         recipe_ids = [row["recipe_id"] for row in self.db.query(
@@ -630,17 +1565,15 @@ class Backend(object):
         return [recipe_map[id] for id in recipe_ids]
 
     def get_friend_activity(self, user, num):
-        friend_ids = self.get_friend_ids(user) + [user["id"]]
-        activity = self._make_activity("cooked", self.db.query(
-            "SELECT user_id, recipe_id, created FROM cookbook_cooked WHERE "
-            "user_id IN (" + ",".join(["%s"] * len(friend_ids)) + ") ORDER BY "
-            "created DESC LIMIT " + str(num), *friend_ids))
-        activity += self._make_activity("clipped", self.db.query(
-            "SELECT user_id, recipe_id, created FROM cookbook_clipped WHERE "
-            "user_id IN (" + ",".join(["%s"] * len(friend_ids)) + ") ORDER BY "
-            "created DESC LIMIT " + str(num), *friend_ids))
-        activity.sort(key=lambda a: a["created"], reverse=True)
-        activity = activity[:num]
+        return self._load_one(
+            "activity", (user["id"], num),
+            lambda: self._query_friend_activity(user, num))
+
+    def _query_friend_activity(self, user, num):
+        activity = self.db.query(
+            "SELECT actor_id AS user_id, recipe_id, action, created FROM "
+            "cookbook_activity WHERE user_id = %s ORDER BY created DESC "
+            "LIMIT " + str(num), user["id"])
         users = self.get_users(set(a["user_id"] for a in activity))
         recipes = self.get_recipes(set(a["recipe_id"] for a in activity))
         for item in activity:
@@ -649,62 +1582,330 @@ class Backend(object):
         return activity
 
     def get_recipes(self, ids):
-        if not ids:
-            return {}
-        recipes = dict((r["id"], r) for r in self.db.query(
-            "SELECT * FROM cookbook_recipes WHERE id IN (" +
-            ",".join(["%s"] * len(ids)) + ")", *ids))
+        return self._load_many("recipes", ids, self._query_recipes)
+
+    def _query_recipes(self, ids):
+        # The cache holds the bare rows, since the authors and photos we fill
+        # in have their own cache lifetimes
+        rows = self._cached("recipes", ids, query=self._query_recipe_rows)
+        recipes = dict((id, tornado.database.Row(row))
+                       for id, row in rows.iteritems())
         self._fill_recipes(recipes.values())
         return recipes
 
+    def _query_recipe_rows(self, ids):
+        rows = self.db.query(
+            "SELECT * FROM cookbook_recipes WHERE id IN (" +
+            ",".join(["%s"] * len(ids)) + ")", *ids)
+        for row in rows:
+            # Until rerender_recipes catches up, render stale rows ourselves
+            if row["html_version"] != MARKDOWN_VERSION:
+                _render_recipe_html(row)
+        return dict((r["id"], r) for r in rows)
+
     def get_categories(self, user):
-        friend_ids = self.get_friend_ids(user) + [user["id"]]
-        recipe_ids = [r["recipe_id"] for r in self.db.query(
-            "SELECT DISTINCT recipe_id FROM cookbook_clipped WHERE "
-            "user_id IN (" + ",".join(["%s"] * len(friend_ids)) + ")",
-            *friend_ids)]
-        if not recipe_ids:
-            return []
-        categories = [r["category"] for r in self.db.query(
-            "SELECT DISTINCT category FROM cookbook_recipes WHERE id "
-            "IN (" + ",".join(["%s"] * len(recipe_ids)) + ")", *recipe_ids)]
-        categories.sort(key=lambda c: c.lower())
+        """Returns the categories of the recipes the user and friends clipped.
+        """
+        return [r["category"] for r in self.get_category_counts(user)]
+
+    def get_category_counts(self, user):
+        """Returns the categories the user and friends clipped recipes in.
+
+        Each row has a category and the number of clips in it, summed over
+        the users. We read these from cookbook_categories, which clip_recipe
+        and update_recipe keep up to date.
+        """
+        join, args, where, where_args = self._friends_filter(
+            user, "g.user_id", include_self=True)
+        categories = self.db.query(
+            "SELECT g.category, SUM(g.recipes) AS recipes FROM "
+            "cookbook_categories g" + join + " WHERE " + where +
+            " AND g.recipes > 0 GROUP BY g.category",
+            *(args + where_args))
+        categories.sort(key=lambda r: r["category"].lower())
         return categories
 
     def recipe_is_clipped(self, user, recipe):
-        return self.db.get(
+        if self._graph_loaded():
+            return self.clips.is_clipped(user["id"], recipe["id"])
+        return self._load_one(
+            "clipped", (user["id"], recipe["id"]), lambda: self.db.get(
+                "SELECT recipe_id FROM cookbook_clipped WHERE user_id = %s "
+                "AND recipe_id = %s", user["id"], recipe["id"]) is not None)
+
+    def prefetch_clipped(self, user, recipes):
+        """Loads recipe_is_clipped for all the given recipes in one query."""
+        if self._loaded is None or not recipes or self._graph_loaded():
+            return
+        loaded = self._loaded.setdefault("clipped", {})
+        recipe_ids = [r["id"] for r in recipes
+                      if (user["id"], r["id"]) not in loaded]
+        if not recipe_ids:
+            return
+        clipped = set(r["recipe_id"] for r in self.db.query(
             "SELECT recipe_id FROM cookbook_clipped WHERE user_id = %s AND "
-            "recipe_id = %s", user["id"], recipe["id"]) is not None
+            "recipe_id IN (" + ",".join(["%s"] * len(recipe_ids)) + ")",
+            user["id"], *recipe_ids))
+        for recipe_id in recipe_ids:
+            loaded[(user["id"], recipe_id)] = recipe_id in clipped
 
     def get_friends_who_clipped(self, user, recipe):
-        all_friends = self.get_friend_ids(user)
-        if not all_friends:
-            return []
-        friend_ids = [r["user_id"] for r in self.db.query(
-            "SELECT user_id FROM cookbook_clipped WHERE recipe_id = %s AND "
-            "user_id IN (" + ",".join(["%s"] * len(all_friends)) + ") "
-            "ORDER BY created DESC", recipe["id"], *all_friends)]
-        friends = self.get_users(friend_ids)
-        return [friends[fid] for fid in friend_ids]
+        if self._graph_loaded():
+            return self._friends_who_clipped_from_graph(user, [recipe])[
+                recipe["id"]]
+        return self._load_one(
+            "friends_who_clipped", (user["id"], recipe["id"]),
+            lambda: self._query_friends_who_clipped(user, [recipe])[
+                recipe["id"]])
+
+    def prefetch_friends_who_clipped(self, user, recipes):
+        """Loads get_friends_who_clipped for all the given recipes at once."""
+        if self._loaded is None or not recipes:
+            return
+        if self._graph_loaded():
+            # Look up all the friends' profiles at once
+            self._friends_who_clipped_from_graph(user, recipes)
+            return
+        loaded = self._loaded.setdefault("friends_who_clipped", {})
+        recipes = [r for r in recipes if (user["id"], r["id"]) not in loaded]
+        if not recipes:
+            return
+        for recipe_id, friends in \
+                self._query_friends_who_clipped(user, recipes).iteritems():
+            loaded[(user["id"], recipe_id)] = friends
+
+    def _friends_who_clipped_from_graph(self, user, recipes):
+        ids = dict((r["id"], self.clips.friends_who_clipped(
+            user["id"], r["id"])) for r in recipes)
+        friends = self.get_users(set(itertools.chain(*ids.values())))
+        return dict((recipe_id, [friends[id] for id in friend_ids
+                                 if id in friends])
+                    for recipe_id, friend_ids in ids.iteritems())
+
+    def _query_friends_who_clipped(self, user, recipes):
+        result = dict((r["id"], []) for r in recipes)
+        friends = self._friends_filter(user, "c.user_id")
+        if not friends:
+            return result
+        join, args, where, where_args = friends
+        rows = self.db.query(
+            "SELECT c.user_id, c.recipe_id FROM cookbook_clipped c" + join +
+            " WHERE c.recipe_id IN (" + ",".join(["%s"] * len(result)) +
+            ") AND " + where + " ORDER BY c.created DESC",
+            *(args + list(result.keys()) + where_args))
+        friends = self.get_users(set(r["user_id"] for r in rows))
+        for row in rows:
+            result[row["recipe_id"]].append(friends[row["user_id"]])
+        return result
+
+    def search_recipes(self, user, query, num=20):
+        """Returns the best recipes matching query that the user or their
+        friends clipped, or None if the search index isn't loaded yet.
+        """
+        if not self._search_ready.is_set():
+            return None
+        if self._graph_loaded():
+            ids = self.search_index.search(query, functools.partial(
+                self._clipped_by_friends, user), num)
+        else:
+            # Check which of the best matches are in scope in one query
+            ids = self.search_index.search(query, limit=num * 20)
+            if ids:
+                join, args, where, where_args = self._friends_filter(
+                    user, "c.user_id", include_self=True)
+                found = set(r["recipe_id"] for r in self.db.query(
+                    "SELECT DISTINCT c.recipe_id FROM cookbook_clipped c" +
+                    join + " WHERE c.recipe_id IN (" +
+                    ",".join(["%s"] * len(ids)) + ") AND " + where,
+                    *(args + ids + where_args)))
+                ids = [id for id in ids if id in found][:num]
+        recipes = self.get_recipes(ids)
+        return [recipes[id] for id in ids if id in recipes]
+
+    def _clipped_by_friends(self, user, recipe_id):
+        return self.clips.is_clipped(user["id"], recipe_id) or \
+            bool(self.clips.friends_who_clipped(user["id"], recipe_id))
+
+    def refresh_search_index(self):
+        """Brings the search index up to date with cookbook_recipes.
+
+        The first call loads the index from --search_snapshot_path, or
+        indexes every recipe if there is no usable snapshot. Later calls
+        index the recipes updated since the last one, and every
+        --search_snapshot_interval seconds we save a new snapshot.
+        """
+        if not self._search_lock.acquire(False):
+            return
+        try:
+            now = self.db.get("SELECT NOW() AS now")["now"]
+            index = self.search_index
+            path = options.search_snapshot_path
+            start = time.time()
+            if not self._search_ready.is_set() and not index.load(path):
+                index.build(self.db.iter(
+                    "SELECT id, title, category, ingredients, description "
+                    "FROM cookbook_recipes"))
+            else:
+                # Look back a little for transactions that committed late
+                index.add_many(self.db.iter(
+                    "SELECT id, title, category, ingredients, description "
+                    "FROM cookbook_recipes WHERE updated >= %s",
+                    index.updated - datetime.timedelta(seconds=10)))
+            index.updated = now
+            if not self._search_ready.is_set():
+                self._search_ready.set()
+                logging.info("Loaded %d recipes into the search index in "
+                             "%.1fs", len(index), time.time() - start)
+            if self._search_saved_at is None or \
+               time.time() - self._search_saved_at > \
+               options.search_snapshot_interval:
+                try:
+                    index.save(path)
+                except Exception:
+                    logging.exception("Could not save the search index to "
+                                      "%s", path)
+                # After a failure, wait as long as we would after a save
+                self._search_saved_at = time.time()
+        finally:
+            self._search_lock.release()
+
+    def get_recipe_activity_times(self, recipe):
+        """Returns when the given recipe was last clipped and last cooked."""
+        row = self.db.get(
+            "SELECT (SELECT MAX(created) FROM cookbook_clipped WHERE "
+            "recipe_id = %s) AS clipped, (SELECT MAX(created) FROM "
+            "cookbook_cooked WHERE recipe_id = %s) AS cooked",
+            recipe["id"], recipe["id"])
+        return row["clipped"], row["cooked"]
+
+    def get_timeline_head(self, user):
+        """Returns the time of the newest item in the user's timeline."""
+        return self.db.get(
+            "SELECT MAX(created) AS created FROM cookbook_activity "
+            "WHERE user_id = %s", user["id"])["created"]
 
     def get_clip_count(self, recipe):
-        return self.db.get(
-            "SELECT COUNT(*) AS num FROM cookbook_clipped WHERE "
-            "recipe_id = %s", recipe["id"]).num
+        return self._get_counts(recipe)[0]
 
     def get_cook_count(self, recipe):
-        return self.db.get(
-            "SELECT COUNT(*) AS num FROM cookbook_cooked WHERE "
-            "recipe_id = %s", recipe["id"]).num
+        return self._get_counts(recipe)[1]
+
+    def shutdown(self, callback, timeout=10):
+        """Finishes our background work before the process exits.
+
+        We stop sending Open Graph calls, and wait up to timeout seconds for
+        the batches already sent and for the jobs on the thread pool. Then
+        we write the buffered counts, stop the resize processes and call
+        callback on the IOLoop.
+        """
+        self.graph_spool.stop()
+        deadline = time.time() + timeout
+        io_loop = tornado.ioloop.IOLoop.instance()
+
+        def check():
+            if self.graph_spool.in_flight() and time.time() < deadline:
+                io_loop.add_timeout(time.time() + 0.1, check)
+                return
+            if not self.pool.wait(max(0, deadline - time.time())):
+                logging.warning("Stopping with %d database jobs unfinished",
+                                self.pool.pending())
+            spool.log_errors(self.flush_counts)
+            if self.resizer is not None:
+                self.resizer.close()
+            callback()
+        check()
+
+    def flush_counts(self):
+        """Writes the clip and cook counts buffered by _count to MySQL."""
+        with self._counts_lock:
+            pending = dict(self._pending_counts)
+            self._pending_counts.clear()
+        if not pending:
+            return
+        try:
+            self.db.executemany(
+                "INSERT INTO cookbook_counts (recipe_id, clips, cooks) VALUES "
+                "(%s,%s,%s) ON DUPLICATE KEY UPDATE "
+                "clips = clips + VALUES(clips), cooks = cooks + VALUES(cooks)",
+                [(id, c[0], c[1]) for id, c in pending.iteritems()])
+        except Exception:
+            logging.error("Error writing recipe counts", exc_info=True)
+            for id, counts in pending.iteritems():
+                self._count(id, *counts)
+
+    def reconcile_counts(self):
+        """Recomputes every recipe's counts from the clip and cook tables.
+
+        Run this to backfill cookbook_counts, or to repair it after a process
+        crashes with buffered increments. Increments from running servers that
+        land while this runs can be lost, so run it when traffic is low.
+        """
+        self.flush_counts()
+        num = self.db.execute_rowcount(
+            "REPLACE INTO cookbook_counts (recipe_id, clips, cooks) "
+            "SELECT r.id, (SELECT COUNT(*) FROM cookbook_clipped c "
+            "WHERE c.recipe_id = r.id), (SELECT COUNT(*) FROM cookbook_cooked "
+            "c WHERE c.recipe_id = r.id) FROM cookbook_recipes r")
+        logging.info("Reconciled counts for %d recipes", num)
+
+    def _move_category(self, recipe_id, old, new):
+        """Moves the recipe's clips from one category to another in
+        cookbook_categories.
+        """
+        self.db.execute(
+            "UPDATE cookbook_categories g JOIN cookbook_clipped c ON "
+            "c.user_id = g.user_id SET g.recipes = g.recipes - 1 WHERE "
+            "c.recipe_id = %s AND g.category = %s", recipe_id, old)
+        self.db.execute(
+            "INSERT INTO cookbook_categories (user_id, category, recipes) "
+            "SELECT user_id, %s, 1 FROM cookbook_clipped WHERE recipe_id = %s "
+            "ON DUPLICATE KEY UPDATE recipes = recipes + 1", new, recipe_id)
+        self.db.execute(
+            "DELETE FROM cookbook_categories WHERE category = %s AND "
+            "recipes <= 0", old)
+
+    def rebuild_categories(self):
+        """Recomputes cookbook_categories from the clips and recipes.
+
+        Run this to backfill the table. Clips made while it runs can be
+        lost, so run it when traffic is low.
+        """
+        self.db.execute("DELETE FROM cookbook_categories")
+        num = self.db.execute_rowcount(
+            "INSERT INTO cookbook_categories (user_id, category, recipes) "
+            "SELECT c.user_id, r.category, COUNT(*) FROM cookbook_clipped c "
+            "JOIN cookbook_recipes r ON r.id = c.recipe_id "
+            "GROUP BY c.user_id, r.category "
+            "ON DUPLICATE KEY UPDATE recipes = recipes + VALUES(recipes)")
+        logging.info("Rebuilt %d category counts", num)
+
+    def _count(self, recipe_id, clips=0, cooks=0):
+        with self._counts_lock:
+            counts = self._pending_counts.setdefault(recipe_id, [0, 0])
+            counts[0] += clips
+            counts[1] += cooks
+
+    def _get_counts(self, recipe):
+        row = self._load_many("counts", [recipe["id"]], lambda ids: dict(
+            (r["recipe_id"], r) for r in self.db.query(
+                "SELECT * FROM cookbook_counts WHERE recipe_id IN (" +
+                ",".join(["%s"] * len(ids)) + ")", *ids))).get(recipe["id"])
+        pending = self._pending_counts.get(recipe["id"], (0, 0))
+        if not row:
+            return tuple(pending)
+        return (row["clips"] + pending[0], row["cooks"] + pending[1])
 
     def get_recipe_photos(self, recipe_ids):
-        if not recipe_ids:
-            return {}
+        return self._load_many("photos", recipe_ids, functools.partial(
+            self._cached, "photos", query=self._query_photos))
+
+    def _query_photos(self, recipe_ids):
         photos = {}
         for row in self.db.query(
             "SELECT * FROM cookbook_photos WHERE recipe_id IN (" +
             ",".join(["%s"] * len(recipe_ids)) + ")", *recipe_ids):
             photos[row["recipe_id"]] = {
+                "created": row["created"],
                 "full": {
                     "hash": row["full_hash"],
                     "url": cdn_url(row["full_hash"]),
@@ -729,14 +1930,304 @@ class Backend(object):
             recipe["author"] = authors[recipe["author_id"]]
             recipe["photo"] = photos.get(recipe["id"])
 
-    def _make_activity(self, action, rows):
-        for row in rows:
-            row["action"] = action
+    def get_version(self, kind, id):
+        """Returns a number that changes whenever we write the given object.
+
+        Cached UI modules include these in their keys. Versions are kept per
+        process, so keys should also include data like recipe["updated"]
+        that reflects writes made by other processes.
+        """
+        return self._versions.get((kind, id), 0)
+
+    def _bump_version(self, kind, id):
+        with self._versions_lock:
+            self._versions[(kind, id)] = next(self._next_version)
+
+    def _load_many(self, kind, ids, query):
+        """Returns a dict of the given ids to the rows query(ids) returns.
+
+        Within a scoped() backend, we remember every row we load, including
+        the ids that turned out not to exist, and only query for the rest.
+        """
+        ids = set(ids)
+        if not ids:
+            return {}
+        if self._loaded is None:
+            return query(list(ids))
+        loaded = self._loaded.setdefault(kind, {})
+        missing = [id for id in ids if id not in loaded]
+        if missing:
+            rows = query(missing)
+            for id in missing:
+                loaded[id] = rows.get(id)
+        return dict((id, loaded[id]) for id in ids
+                    if loaded[id] is not None)
+
+    # The table, key column and timestamp column behind each cached kind
+    _CACHE_STAMPS = {
+        "photos": ("cookbook_photos", "recipe_id", "created"),
+        "recipes": ("cookbook_recipes", "id", "updated"),
+        "users": ("cookbook_users", "id", "updated"),
+    }
+
+    def _cached(self, kind, ids, query):
+        """Looks up the given ids in our process-wide cache of the given kind,
+        calling query(ids) for the ones that are not cached.
+
+        Other processes write these rows too, so once a cached row is more
+        than --cache_check_interval seconds old, we read its timestamp from
+        MySQL, in one query for all such rows, and reload it if it changed.
+        Timestamps only have whole seconds, so a row loaded within a couple
+        of seconds of its last write is reloaded rather than trusted.
+        """
+        cache = self.caches[kind]
+        table, key, column = self._CACHE_STAMPS[kind]
+        now = time.time()
+        entries = cache.get_many(ids)
+        unchecked = [id for id, (row, loaded, checked) in entries.iteritems()
+                     if checked < now - options.cache_check_interval]
+        if unchecked:
+            stamps = dict((r["id"], r["stamp"]) for r in self.db.query(
+                "SELECT " + key + " AS id, " + column + " AS stamp FROM " +
+                table + " WHERE " + key + " IN (" +
+                ",".join(["%s"] * len(unchecked)) + ")", *unchecked))
+            for id in unchecked:
+                row, loaded, checked = entries[id]
+                stamp = row[column]
+                if stamps.get(id) == stamp and \
+                   loaded - calendar.timegm(stamp.utctimetuple()) > 2:
+                    cache.set(id, (row, loaded, now))
+                else:
+                    cache.delete(id)
+                    del entries[id]
+        rows = dict((id, entry[0]) for id, entry in entries.iteritems())
+        missing = [id for id in ids if id not in rows]
+        if missing:
+            for id, row in query(missing).iteritems():
+                cache.set(id, (row, now, now))
+                rows[id] = row
         return rows
 
+    def _load_one(self, kind, key, query):
+        if self._loaded is None:
+            return query()
+        loaded = self._loaded.setdefault(kind, {})
+        if key not in loaded:
+            loaded[key] = query()
+        return loaded[key]
+
+    def _forget(self, kind, key):
+        if self._loaded is not None:
+            self._loaded.get(kind, {}).pop(key, None)
+
+    def rerender_recipes(self):
+        """Renders the HTML of every recipe written by an older markdown()."""
+        num = 0
+        while True:
+            rows = self.db.query(
+                "SELECT id, description, ingredients, instructions FROM "
+                "cookbook_recipes WHERE html_version != %s LIMIT 500",
+                MARKDOWN_VERSION)
+            if not rows:
+                break
+            for row in rows:
+                _render_recipe_html(row)
+            # Skip recipes edited since we read them; update_recipe has
+            # rendered those already. BINARY makes the comparison exact.
+            self.db.executemany(
+                "UPDATE cookbook_recipes SET description_html = %s, "
+                "ingredients_html = %s, instructions_html = %s, "
+                "html_version = %s WHERE id = %s AND description = BINARY %s "
+                "AND ingredients = BINARY %s AND instructions = BINARY %s",
+                [(r["description_html"], r["ingredients_html"],
+                  r["instructions_html"], MARKDOWN_VERSION, r["id"],
+                  r["description"], r["ingredients"], r["instructions"])
+                 for r in rows])
+            num += len(rows)
+        logging.info("Rendered %d recipes", num)
+
+    def rebuild_activity(self):
+        """Rebuilds every user's activity timeline from scratch.
+
+        Run this to backfill cookbook_activity, or after changing
+        --activity_timeline_size.
+        """
+        self.db.execute("DELETE FROM cookbook_activity")
+        for action, table in self._ACTIVITY_TABLES:
+            self.db.execute(
+                "INSERT IGNORE INTO cookbook_activity (user_id, actor_id, "
+                "recipe_id, action, created) SELECT user_id, user_id, "
+                "recipe_id, %s, created FROM " + table, action)
+            self.db.execute(
+                "INSERT IGNORE INTO cookbook_activity (user_id, actor_id, "
+                "recipe_id, action, created) SELECT f.user_id, a.user_id, "
+                "a.recipe_id, %s, a.created FROM cookbook_friends f, " +
+                table + " a WHERE a.user_id = f.friend_id", action)
+        self.trim_activity()
+
+    def trim_activity(self):
+        """Drops the activity beyond --activity_timeline_size for each user.
+
+        The servers trim the timelines they add to, so this is only needed
+        after a rebuild or after lowering --activity_timeline_size.
+        """
+        num = 0
+        for row in self.db.query(
+            "SELECT user_id FROM cookbook_activity GROUP BY user_id HAVING "
+            "COUNT(*) > %s", options.activity_timeline_size):
+            num += self._trim_timeline(row["user_id"])
+        logging.info("Trimmed %d activity items", num)
+
+    def trim_timelines(self):
+        """Trims the timelines we added activity to since the last call."""
+        with self._timelines_lock:
+            user_ids = list(self._grown_timelines)
+            self._grown_timelines.clear()
+        for user_id in user_ids:
+            self._trim_timeline(user_id)
+
+    def _trim_timeline(self, user_id):
+        # MySQL can't read the table it deletes from in a subquery, so we
+        # read the cutoff through a derived table
+        return self.db.execute_rowcount(
+            "DELETE FROM cookbook_activity WHERE user_id = %s AND created < "
+            "(SELECT created FROM (SELECT created FROM cookbook_activity "
+            "WHERE user_id = %s ORDER BY created DESC LIMIT 1 OFFSET %s) t)",
+            user_id, user_id, options.activity_timeline_size - 1)
+
+    def friend_graph_stats(self):
+        """Loads the friend graph and clips and logs the memory they take.
+
+        Use this to size servers: each process holds its own copy.
+        """
+        if self.graph is None:
+            self.graph = graph.FriendGraph()
+            self.clips = graph.ClipIndex(self.graph)
+            self._graph_ready = threading.Event()
+        self._load_friend_graph()
+
+    def sync_cdn_index(self):
+        """Adds every object in the S3 bucket to the --cdn_index_path index.
+
+        The servers add the photos they upload to the index themselves, so
+        this is only needed to fill in a new index.
+        """
+        index = self.s3.known_hashes
+        if index is None:
+            raise SystemExit("--cdn_index_path is not set")
+        io_loop = tornado.ioloop.IOLoop.instance()
+        result = {"objects": 0, "error": False}
+
+        def on_list(names, marker):
+            if names is None:
+                result["error"] = True
+                io_loop.stop()
+                return
+            index.add_many(names)
+            result["objects"] += len(names)
+            if marker:
+                self.s3.list_objects(on_list, marker=marker)
+            else:
+                io_loop.stop()
+        self.s3.list_objects(on_list)
+        io_loop.start()
+        if result["error"]:
+            raise SystemExit("Could not list the S3 bucket")
+        logging.info("Added %d objects to the CDN index", result["objects"])
+
+    _ACTIVITY_TABLES = (
+        ("clipped", "cookbook_clipped"),
+        ("cooked", "cookbook_cooked"),
+    )
+
+    def _publish_activity(self, user, recipe_id, action):
+        """Adds the given action to the timelines of the user and friends."""
+        self.db.execute(
+            "INSERT IGNORE INTO cookbook_activity (user_id, actor_id, "
+            "recipe_id, action, created) SELECT %s, %s, %s, %s, UTC_TIMESTAMP "
+            "UNION ALL SELECT friend_id, %s, %s, %s, UTC_TIMESTAMP FROM "
+            "cookbook_friends WHERE user_id = %s", user["id"], user["id"],
+            recipe_id, action, user["id"], recipe_id, action, user["id"])
+        self._timelines_grew([user["id"]] + self.get_friend_ids(user))
+
+    def _copy_activity(self, user_ids, actor_ids):
+        """Copies the recent activity of the given actors to the timelines of
+        the given users.
+        """
+        for action, table in self._ACTIVITY_TABLES:
+            self.db.execute(
+                "INSERT IGNORE INTO cookbook_activity (user_id, actor_id, "
+                "recipe_id, action, created) SELECT u.id, a.user_id, "
+                "a.recipe_id, %s, a.created FROM cookbook_users u, (SELECT "
+                "user_id, recipe_id, created FROM " + table + " WHERE user_id "
+                "IN (" + ",".join(["%s"] * len(actor_ids)) + ") ORDER BY "
+                "created DESC LIMIT " + str(options.activity_timeline_size) +
+                ") a WHERE u.id IN (" + ",".join(["%s"] * len(user_ids)) + ")",
+                action, *(list(actor_ids) + list(user_ids)))
+        self._timelines_grew(user_ids)
+
+    def _timelines_grew(self, user_ids):
+        """Marks the given users' timelines for trim_timelines()."""
+        with self._timelines_lock:
+            self._grown_timelines.update(user_ids)
+
+
+class CachedModule(tornado.web.UIModule):
+    """A UIModule whose output we cache in the Backend's fragment cache.
+
+    Subclasses implement render_fragment() instead of render(), and
+    cache_key(), which takes the same arguments and returns a tuple of
+    everything the output depends on. We add the module name and locale.
+    Writes don't delete fragments; they change the keys, and the old
+    fragments fall out of the LRU cache.
+    """
+    def render(self, *args, **kwargs):
+        key = (self.__class__.__name__, self.locale.code) + \
+            self.cache_key(*args, **kwargs)
+        fragments = self.handler.backend.caches["fragments"]
+        html = fragments.get(key)
+        if html is None:
+            html = self.render_fragment(*args, **kwargs)
+            fragments.set(key, html)
+        return html
+
+    def cache_key(self, *args, **kwargs):
+        raise NotImplementedError()
+
+    def render_fragment(self, *args, **kwargs):
+        raise NotImplementedError()
+
+    def recipe_key(self, recipe):
+        photo = recipe["photo"]
+        return (recipe["id"], recipe["updated"],
+                self.handler.backend.get_version("recipe", recipe["id"]),
+                photo["full"]["hash"] if photo else None,
+                photo["thumb"]["hash"] if photo else None)
+
+    def user_key(self, user):
+        if not user:
+            return None
+        return (user["id"], user["updated"],
+                self.handler.backend.get_version("user", user["id"]))
+
+    def context_key(self, recipe):
+        """Returns the key for the RecipeContext of the given recipe."""
+        backend = self.handler.backend
+        friends = backend.get_friends_who_clipped(self.current_user, recipe)
+        if not friends:
+            return None
+        return (self.user_key(self.current_user),
+                backend.recipe_is_clipped(self.current_user, recipe),
+                tuple(self.user_key(f) for f in friends))
+
+
+class RecipeList(CachedModule):
+    def cache_key(self, recipes):
+        return tuple((r["id"], r["updated"],
+                      self.handler.backend.get_version("recipe", r["id"]))
+                     for r in recipes)
 
-class RecipeList(tornado.web.UIModule):
-    def render(self, recipes):
+    def render_fragment(self, recipes):
         categories = {}
         for recipe in recipes:
             categories.setdefault(recipe["category"], []).append(recipe)
@@ -750,8 +2241,16 @@ class Facepile(tornado.web.UIModule):
         return self.render_string("facepile.html", friends=friends, num=num)
 
 
-class RecipeClips(tornado.web.UIModule):
-    def render(self, recipes):
+class RecipeClips(CachedModule):
+    def cache_key(self, recipes):
+        # Every clip renders a RecipeContext, so load them all up front
+        self.handler.backend.prefetch_friends_who_clipped(
+            self.current_user, recipes)
+        self.handler.backend.prefetch_clipped(self.current_user, recipes)
+        return tuple((self.recipe_key(r), self.context_key(r))
+                     for r in recipes)
+
+    def render_fragment(self, recipes):
         return self.render_string("recipe-clips.html", recipes=recipes)
 
 
@@ -766,15 +2265,25 @@ class ActivityStream(tornado.web.UIModule):
         return self.render_string("activity-stream.html", activity=activity)
 
 
-class ActivityItem(tornado.web.UIModule):
-    def render(self, user, recipe, date, action):
+class ActivityItem(CachedModule):
+    def cache_key(self, user, recipe, date, action):
+        # The date is shown relative to now, so key on how it reads
+        return (self.user_key(user), self.recipe_key(recipe), action,
+                self.locale.format_date(date, relative=True, shorter=True))
+
+    def render_fragment(self, user, recipe, date, action):
         return self.render_string(
             "activity-item.html", user=user, recipe=recipe, date=date,
             action=action)
 
 
-class RecipePhoto(tornado.web.UIModule):
-    def render(self, recipe, width, max_height=None, height=None, href=None):
+class RecipePhoto(CachedModule):
+    def cache_key(self, recipe, width, max_height=None, height=None,
+                  href=None):
+        return (self.recipe_key(recipe), width, max_height, height, href)
+
+    def render_fragment(self, recipe, width, max_height=None, height=None,
+                        href=None):
         if not recipe["photo"]:
             if not height:
                 height = max_height
@@ -807,8 +2316,14 @@ class RecipeActions(tornado.web.UIModule):
             "recipe-actions.html", recipe=recipe, clipped=clipped)
 
 
-class RecipeInfo(tornado.web.UIModule):
-    def render(self, recipe):
+class RecipeInfo(CachedModule):
+    def cache_key(self, recipe):
+        backend = self.handler.backend
+        return (self.recipe_key(recipe), self.context_key(recipe),
+                backend.get_cook_count(recipe),
+                backend.get_clip_count(recipe))
+
+    def render_fragment(self, recipe):
         cook_count = self.handler.backend.get_cook_count(recipe)
         clip_count = self.handler.backend.get_clip_count(recipe)
         return self.render_string(
@@ -830,19 +2345,136 @@ class RecipeContext(tornado.web.UIModule):
             facepile_size=facepile_size)
 
 
+# Bump this when markdown() changes, then run "cookbook.py rerender_recipes"
+MARKDOWN_VERSION = 1
+
+
+def markdown(text):
+    """Renders recipe text as HTML paragraphs.
+
+    Recipes store the result of this alongside their text, so it only runs
+    when a recipe is written.
+    """
+    text = re.sub(r"\n\s*\n", "</p><p>",
+                  tornado.escape.xhtml_escape(text.strip()))
+    text = re.sub(r"\n", "<br>", text)
+    return '<p>' + text + '</p>'
+
+
+def _render_recipe_html(recipe):
+    for field in ("description", "ingredients", "instructions"):
+        recipe[field + "_html"] = markdown(recipe[field])
+
+
 def cdn_url(hash):
     return "http://" + options.aws_cloudfront_host + "/" + hash
 
 
+def write_temp_file(data):
+    """Writes the given data to a new temporary file and returns its path"""
+    fd, path = tempfile.mkstemp(prefix="upload-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return path
+
+
+def remove_temp_files(renditions):
+    """Removes the files of renditions from images.resize_image_file()"""
+    for image in renditions:
+        try:
+            os.remove(image["path"])
+        except OSError:
+            pass
+
+
+def read_temp_file(path):
+    """Returns the contents of the given file, removing it afterwards"""
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+class CookbookHTTPServer(tornado.httpserver.HTTPServer):
+    """An HTTPServer that rejects bodies over --max_upload_size.
+
+    Tornado checks Content-Length against the connection's buffer size
+    before it reads the body, so we limit that buffer rather than reading
+    an oversized upload into memory only to reject it.
+    """
+    def handle_stream(self, stream, address):
+        # Leave room for the headers and multipart boundaries
+        stream.max_buffer_size = options.max_upload_size + 65536
+        tornado.httpserver.HTTPServer.handle_stream(self, stream, address)
+
+
+# Maintenance commands, run as "cookbook.py [options] <command>"
+COMMANDS = (
+    "friend_graph_stats",
+    "rebuild_activity",
+    "rebuild_categories",
+    "reconcile_counts",
+    "rerender_recipes",
+    "retry_graph_jobs",
+    "sync_cdn_index",
+    "trim_activity",
+)
+
+
 def main():
-    tornado.options.parse_command_line()
+    args = tornado.options.parse_command_line()
     if options.config:
         tornado.options.parse_config_file(options.config)
     else:
         path = os.path.join(os.path.dirname(__file__), "settings.py")
         tornado.options.parse_config_file(path)
-    CookbookApplication().listen(options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    if args:
+        if args[0] not in COMMANDS:
+            raise SystemExit("Unknown command %r; commands are %s" %
+                             (args[0], ", ".join(COMMANDS)))
+        backend = Backend.instance(services=False)
+        try:
+            getattr(backend, args[0])()
+        finally:
+            backend.db.close()
+        return
+    if options.processes == 1:
+        # Fork the resize processes before we open the listening socket,
+        # and have the ones that replace them later close it
+        backend = Backend.instance()
+        sockets = tornado.netutil.bind_sockets(options.port)
+        backend.resizer.add_close_fds([s.fileno() for s in sockets])
+        server = CookbookHTTPServer(CookbookApplication())
+        server.add_sockets(sockets)
+        io_loop = tornado.ioloop.IOLoop.instance()
+
+        def stop():
+            server.stop()
+            shutdown_backend(io_loop.stop)
+        prefork.call_on_signal(stop, (signal.SIGTERM, signal.SIGINT))
+        io_loop.start()
+    else:
+        def make_app():
+            # Each worker creates its own Backend, and with it its own
+            # database connections and resize processes, before it serves
+            Backend.instance(close_fds=[s.fileno() for s in
+                                        supervisor.sockets])
+            return CookbookApplication()
+        supervisor = prefork.Supervisor(
+            make_app, options.port, options.processes,
+            server_class=CookbookHTTPServer,
+            graceful_timeout=options.graceful_timeout,
+            on_stop=shutdown_backend)
+        supervisor.run()
+
+
+def shutdown_backend(callback):
+    """Lets this process's Backend, if it made one, finish its work."""
+    if hasattr(Backend, "_instance"):
+        Backend._instance.shutdown(callback)
+    else:
+        callback()
 
 
 if __name__ == "__main__":
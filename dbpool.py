@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A thread-safe pool of tornado.database connections"""
+
+import contextlib
+import logging
+import threading
+import time
+import tornado.database
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection frees up within the pool's wait_timeout"""
+    pass
+
+
+class ConnectionPool(object):
+    """Lends MySQL connections to threads for one query at a time.
+
+    The pool has the same query methods as tornado.database.Connection, so
+    it can be used in place of one. Each call checks out a connection, runs
+    the query and puts the connection back.
+
+    We open up to max_size connections as needed. Connections idle for
+    more than idle_timeout seconds are closed, down to min_size. If a
+    connection has been idle for more than ping_interval seconds, we ping
+    it before lending it out and reconnect if the server went away. If
+    query_timeout is given, the server aborts SELECTs that run longer than
+    that many seconds. Threads wait at most wait_timeout seconds for a
+    connection when all of them are in use.
+    """
+    def __init__(self, host, database, user=None, password=None,
+                 min_size=1, max_size=10, idle_timeout=300, ping_interval=1,
+                 query_timeout=None, wait_timeout=10):
+        self._connect_args = dict(
+            host=host, database=database, user=user, password=password)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self.query_timeout = query_timeout
+        self.wait_timeout = wait_timeout
+        self._idle = []
+        self._size = 0
+        self._lock = threading.Condition()
+        self._last_reap = time.time()
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "max_wait_time": 0.0,
+            "timeouts": 0,
+            "reconnects": 0,
+        }
+
+    def query(self, query, *parameters):
+        with self.connection() as db:
+            return db.query(query, *parameters)
+
+    def get(self, query, *parameters):
+        with self.connection() as db:
+            return db.get(query, *parameters)
+
+    def execute(self, query, *parameters):
+        with self.connection() as db:
+            return db.execute(query, *parameters)
+
+    def execute_rowcount(self, query, *parameters):
+        with self.connection() as db:
+            return db.execute_rowcount(query, *parameters)
+
+    def executemany(self, query, parameters):
+        with self.connection() as db:
+            return db.executemany(query, parameters)
+
+    def iter(self, query, *parameters):
+        """Returns an iterator over a query's rows without loading them all.
+
+        We hold on to the connection until the iterator is exhausted.
+        """
+        with self.connection() as db:
+            rows = db.iter(query, *parameters)
+            try:
+                for row in rows:
+                    yield row
+            finally:
+                # Finish with the cursor before the connection goes back
+                rows.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Checks out a connection for the duration of a with block"""
+        db = self._checkout()
+        broken = False
+        try:
+            yield db
+        except tornado.database.OperationalError:
+            # The connection is likely broken, so don't lend it out again
+            broken = True
+            raise
+        finally:
+            if broken:
+                self._discard(db)
+            else:
+                self._checkin(db)
+
+    def stats(self):
+        """Returns the size of the pool and how long threads wait on it"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(size=self._size, idle=len(self._idle))
+        checkouts = stats["checkouts"]
+        stats["mean_wait_time"] = \
+            stats["wait_time"] / checkouts if checkouts else 0.0
+        return stats
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+        for db, last_used in idle:
+            db.close()
+
+    def _checkout(self):
+        start = time.time()
+        waited = False
+        with self._lock:
+            while not self._idle and self._size >= self.max_size:
+                remaining = start + self.wait_timeout - time.time()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeoutError(
+                        "No MySQL connection free after %.1fs" %
+                        self.wait_timeout)
+                waited = True
+                self._lock.wait(remaining)
+            if self._idle:
+                db, last_used = self._idle.pop()
+            else:
+                db, last_used = None, None
+                self._size += 1
+            wait_time = time.time() - start
+            self._stats["checkouts"] += 1
+            self._stats["wait_time"] += wait_time
+            self._stats["max_wait_time"] = max(
+                self._stats["max_wait_time"], wait_time)
+            if waited:
+                self._stats["waits"] += 1
+        try:
+            if db is None:
+                db = self._connect()
+            elif time.time() - last_used > self.ping_interval:
+                self._ping(db)
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+        return db
+
+    def _checkin(self, db):
+        now = time.time()
+        with self._lock:
+            # Most recently used connections go on the end, so the ones at
+            # the front are the ones that have been idle longest
+            self._idle.append((db, now))
+            self._lock.notify()
+            if now - self._last_reap < min(self.idle_timeout, 60):
+                return
+            self._last_reap = now
+            expired = []
+            while self._size > self.min_size and self._idle and \
+                    now - self._idle[0][1] > self.idle_timeout:
+                expired.append(self._idle.pop(0)[0])
+                self._size -= 1
+        for db in expired:
+            db.close()
+
+    def _discard(self, db):
+        with self._lock:
+            self._size -= 1
+            self._lock.notify()
+        db.close()
+
+    def _connect(self):
+        db = tornado.database.Connection(**self._connect_args)
+        if self.query_timeout:
+            try:
+                db.execute("SET SESSION max_execution_time = %s",
+                           int(self.query_timeout * 1000))
+            except tornado.database.OperationalError:
+                logging.warning("MySQL server does not support query "
+                                "timeouts; ignoring --db_query_timeout")
+                self.query_timeout = None
+        return db
+
+    def _ping(self, db):
+        try:
+            db.get("SELECT 1 AS ok")
+        except tornado.database.OperationalError:
+            logging.warning("Lost MySQL connection; reconnecting")
+            with self._lock:
+                self._stats["reconnects"] += 1
+            db.reconnect()
+            if self.query_timeout:
+                db.execute("SET SESSION max_execution_time = %s",
+                           int(self.query_timeout * 1000))
+
+
+class QueryCounter(object):
+    """Wraps a connection or pool, counting the queries made through it.
+
+    Everything but the query methods is passed through to the wrapped
+    object.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.num_queries = 0
+
+    def query(self, query, *parameters):
+        self.num_queries += 1
+        return self.db.query(query, *parameters)
+
+    def get(self, query, *parameters):
+        self.num_queries += 1
+        return self.db.get(query, *parameters)
+
+    def execute(self, query, *parameters):
+        self.num_queries += 1
+        return self.db.execute(query, *parameters)
+
+    def execute_rowcount(self, query, *parameters):
+        self.num_queries += 1
+        return self.db.execute_rowcount(query, *parameters)
+
+    def executemany(self, query, parameters):
+        self.num_queries += 1
+        return self.db.executemany(query, parameters)
+
+    def iter(self, query, *parameters):
+        self.num_queries += 1
+        return self.db.iter(query, *parameters)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
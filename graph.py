@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A compact in-memory index of the friend graph"""
+
+import array
+import bisect
+import sys
+import threading
+
+
+class FriendGraph(object):
+    """Maps each user to the sorted list of their friends.
+
+    We intern user ids as small integers and keep each user's friends in a
+    sorted array of them, which takes about four bytes per edge rather than
+    the dozens a list of strings would. Lookups don't take a lock: writers
+    build a new array and swap it in, so readers always see a complete list.
+
+    Edges are directed, like the rows of cookbook_friends, so callers add
+    both directions of a friendship. A user keeps the same integer across
+    loads, so a ClipIndex can store them too.
+    """
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+        self._friends = []
+        self._lock = threading.Lock()
+        self.num_edges = 0
+
+    def load(self, edges):
+        """Replaces the graph with the given (user_id, friend_id) edges."""
+        lists = {}
+        for user_id, friend_id in edges:
+            lists.setdefault(self.intern(user_id), []).append(
+                self.intern(friend_id))
+        empty = array.array("i")
+        with self._lock:
+            friends = [array.array("i", sorted(set(lists[user])))
+                       if user in lists else empty
+                       for user in xrange(len(self._names))]
+            self._friends = friends
+            self.num_edges = sum(len(a) for a in friends)
+
+    def friend_ids(self, user_id):
+        """Returns the ids of the user's friends."""
+        user = self._ids.get(user_id)
+        if user is None:
+            return []
+        names = self._names
+        return [names[f] for f in self._friends[user]]
+
+    def are_friends(self, user_id, friend_id):
+        user = self._ids.get(user_id)
+        friend = self._ids.get(friend_id)
+        if user is None or friend is None:
+            return False
+        friends = self._friends[user]
+        i = bisect.bisect_left(friends, friend)
+        return i < len(friends) and friends[i] == friend
+
+    def mutual_friend_ids(self, user_id, other_id):
+        """Returns the ids of the people both users are friends with."""
+        user = self._ids.get(user_id)
+        other = self._ids.get(other_id)
+        if user is None or other is None:
+            return []
+        names = self._names
+        return [names[f] for f in _intersect(
+            self._friends[user], self._friends[other])]
+
+    def intern(self, user_id):
+        """Returns the integer for the given user id, assigning one if needed.
+        """
+        user = self._ids.get(user_id)
+        if user is not None:
+            return user
+        with self._lock:
+            return _intern(user_id, self._ids, self._names, self._friends)
+
+    def add_edges(self, edges):
+        """Adds the given (user_id, friend_id) edges to the graph."""
+        with self._lock:
+            added = {}
+            for user_id, friend_id in edges:
+                user = _intern(user_id, self._ids, self._names, self._friends)
+                friend = _intern(friend_id, self._ids, self._names,
+                                 self._friends)
+                added.setdefault(user, set()).add(friend)
+            for user, new in added.iteritems():
+                old = self._friends[user]
+                merged = array.array("i", sorted(new.union(old)))
+                self.num_edges += len(merged) - len(old)
+                self._friends[user] = merged
+
+    def remove_edges(self, edges):
+        """Removes the given (user_id, friend_id) edges from the graph."""
+        with self._lock:
+            removed = {}
+            for user_id, friend_id in edges:
+                user = self._ids.get(user_id)
+                friend = self._ids.get(friend_id)
+                if user is not None and friend is not None:
+                    removed.setdefault(user, set()).add(friend)
+            for user, gone in removed.iteritems():
+                old = self._friends[user]
+                kept = array.array("i", [f for f in old if f not in gone])
+                self.num_edges += len(kept) - len(old)
+                self._friends[user] = kept
+
+    def stats(self):
+        """Returns the size of the graph and the memory it uses.
+
+        The byte counts include the arrays, the id tables and the interned
+        id strings, but not memory the allocator holds on to.
+        """
+        with self._lock:
+            friends = list(self._friends)
+            names = list(self._names)
+            ids = self._ids
+            num_edges = self.num_edges
+        size = sys.getsizeof(ids) + sys.getsizeof(names) + \
+            sys.getsizeof(friends) + \
+            sum(sys.getsizeof(a) for a in friends) + \
+            sum(sys.getsizeof(n) for n in names)
+        return {
+            "users": len(names),
+            "edges": num_edges,
+            "bytes": size,
+            "bytes_per_edge": size * 1.0 / num_edges if num_edges else 0.0,
+        }
+
+
+class ClipIndex(object):
+    """Maps each recipe to the sorted list of the users who clipped it.
+
+    Users are stored as their integers in the given FriendGraph, so we can
+    find the friends who clipped a recipe by intersecting two sorted arrays
+    without going to MySQL. Next to each recipe's users we keep when each
+    of them clipped it, in seconds since the epoch, so we can list the
+    newest clips first. Like FriendGraph, writers swap in new arrays so
+    lookups don't need the lock.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self._clippers = {}
+        self._lock = threading.Lock()
+        self.num_clips = 0
+
+    def load(self, clips):
+        """Replaces the index with the given (recipe_id, user_id, time)
+        clips.
+        """
+        lists = {}
+        for recipe_id, user_id, clipped in clips:
+            lists.setdefault(recipe_id, {})[self.graph.intern(user_id)] = \
+                clipped
+        clippers = dict((recipe_id, _clip_arrays(times))
+                        for recipe_id, times in lists.iteritems())
+        with self._lock:
+            self._clippers = clippers
+            self.num_clips = sum(len(users)
+                                 for users, times in clippers.itervalues())
+
+    def add_clips(self, clips):
+        """Adds the given (recipe_id, user_id, time) clips to the index."""
+        added = {}
+        for recipe_id, user_id, clipped in clips:
+            added.setdefault(recipe_id, {})[self.graph.intern(user_id)] = \
+                clipped
+        with self._lock:
+            for recipe_id, new in added.iteritems():
+                users, times = self._clippers.get(recipe_id, ((), ()))
+                if set(new).issubset(users):
+                    continue
+                # Keep the time we already have for a clip we see again
+                new.update(zip(users, times))
+                self.num_clips += len(new) - len(users)
+                self._clippers[recipe_id] = _clip_arrays(new)
+
+    def is_clipped(self, user_id, recipe_id):
+        user = self.graph._ids.get(user_id)
+        clippers = self._clippers.get(recipe_id)
+        if user is None or not clippers:
+            return False
+        users = clippers[0]
+        i = bisect.bisect_left(users, user)
+        return i < len(users) and users[i] == user
+
+    def friends_who_clipped(self, user_id, recipe_id):
+        """Returns the ids of the user's friends who clipped the recipe,
+        the most recent clip first.
+        """
+        user = self.graph._ids.get(user_id)
+        clippers = self._clippers.get(recipe_id)
+        if user is None or not clippers:
+            return []
+        users, times = clippers
+        friends = _intersect(self.graph._friends[user], users)
+        friends.sort(key=lambda f: times[bisect.bisect_left(users, f)],
+                     reverse=True)
+        names = self.graph._names
+        return [names[f] for f in friends]
+
+    def stats(self):
+        """Returns the size of the index and the memory it uses."""
+        with self._lock:
+            clippers = dict(self._clippers)
+            num_clips = self.num_clips
+        size = sys.getsizeof(clippers) + \
+            sum(sys.getsizeof(c) + sys.getsizeof(c[0]) + sys.getsizeof(c[1])
+                for c in clippers.itervalues())
+        return {
+            "recipes": len(clippers),
+            "clips": num_clips,
+            "bytes": size,
+            "bytes_per_clip": size * 1.0 / num_clips if num_clips else 0.0,
+        }
+
+
+def _clip_arrays(times):
+    """Returns the sorted users in the given {user: time} dict and an array
+    of their times in the same order.
+    """
+    users = sorted(times)
+    return (array.array("i", users),
+            array.array("l", [times[u] for u in users]))
+
+
+def _intersect(a, b):
+    """Returns the integers in both of the given sorted arrays, in order."""
+    if len(a) > len(b):
+        a, b = b, a
+    result = []
+    if len(a) * 8 < len(b):
+        # Look up each item of the short list in the long one
+        lo = 0
+        for x in a:
+            lo = bisect.bisect_left(b, x, lo)
+            if lo == len(b):
+                break
+            if b[lo] == x:
+                result.append(x)
+        return result
+    # Both lists are sorted, so walk them together
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            result.append(a[i])
+            i += 1
+            j += 1
+    return result
+
+
+def _intern(name, ids, names, friends):
+    """Returns the integer for the given user id, assigning one if needed."""
+    id = ids.get(name)
+    if id is None:
+        id = len(names)
+        names.append(intern(str(name)))
+        friends.append(array.array("i"))
+        ids[name] = id
+    return id
@@ -19,6 +19,8 @@
 import binascii
 import ctypes
 import ctypes.util
+import os
+import tempfile
 
 
 def get_image_info(data):
@@ -49,6 +51,35 @@ def resize_image(data, max_width, max_height, quality=85, crop=False,
         crop=crop, force=force)
 
 
+def resize_image_multi(data, specs):
+    """Resizes the given image to several specifications at once.
+
+    specs is a list of dicts with the keyword arguments of resize_image, e.g.,
+    [{"max_width": 800, "max_height": 800}, {"max_width": 300, ...}].
+
+    We decode the image only once, and derive each size from the next larger
+    one. For JPEG images, we ask the decoder to scale the image down to the
+    largest size we need as it reads it, which is much faster than decoding
+    it at full size.
+
+    We return a list of dicts like those from resize_image, one for each spec,
+    in the same order.
+    """
+    return _ImageMagick.instance().resize_image_multi(data, specs)
+
+
+def resize_image_file(path, specs, remove=False):
+    """Like resize_image_multi, but reads the image from the given file and
+    writes each resized image to a new temporary file.
+
+    ImageMagick reads and writes the files directly, so the image data
+    never passes through Python. Each dict we return has a "path" key in
+    place of "data"; the caller is responsible for removing those files.
+    If remove is True, we remove the source file once we have read it.
+    """
+    return _ImageMagick.instance().resize_image_file(path, specs, remove)
+
+
 class ImageException(Exception):
     """An exception related to the ImageMagick library"""
     pass
@@ -92,32 +123,101 @@ class _ImageMagick(object):
 
     def resize_image(self, data, max_width, max_height, quality=85,
                      crop=False, force=False):
+        return self.resize_image_multi(data, [{
+            "max_width": max_width,
+            "max_height": max_height,
+            "quality": quality,
+            "crop": crop,
+            "force": force,
+        }])[0]
+
+    def resize_image_multi(self, data, specs):
+        return self._resize_image(
+            specs, data[:32],
+            lambda wand: self.lib.MagickReadImageBlob(wand, data, len(data)))
+
+    def resize_image_file(self, path, specs, remove=False):
+        with open(path, "rb") as f:
+            header = f.read(32)
+        def read(wand):
+            try:
+                return self.lib.MagickReadImage(wand, path)
+            finally:
+                if remove:
+                    os.remove(path)
+        return self._resize_image(specs, header, read, to_file=True)
+
+    def _resize_image(self, specs, header, read, to_file=False):
+        specs = [dict({"quality": 85, "crop": False, "force": False}, **spec)
+                 for spec in specs]
         wand = self.lib.NewMagickWand()
         try:
-            if not self.lib.MagickReadImageBlob(wand, data, len(data)):
+            if header[:2] == "\xff\xd8" and \
+               not any(s["crop"] or s["force"] for s in specs):
+                # libjpeg can scale by 1/2, 1/4 or 1/8 while decoding, and
+                # this tells it the smallest size we can use
+                self.lib.MagickSetOption(wand, "jpeg:size", "%dx%d" % (
+                    max(s["max_width"] for s in specs),
+                    max(s["max_height"] for s in specs)))
+            if not read(wand):
                 raise ImageException("Unsupported image format; data: %s...",
-                                     binascii.b2a_hex(data[:32]))
+                                     binascii.b2a_hex(header))
             width = self.lib.MagickGetImageWidth(wand)
             height = self.lib.MagickGetImageHeight(wand)
             self.lib.MagickStripImage(wand)
-            if crop:
-                ratio = max(max_height * 1.0 / height, max_width * 1.0 / width)
-            else:
-                ratio = min(max_height * 1.0 / height, max_width * 1.0 / width)
 
             ptr = self.lib.MagickGetImageFormat(wand)
             src_format = ctypes.string_at(ptr).upper()
             self.lib.MagickRelinquishMemory(ptr)
-            format = src_format
 
-            if ratio < 1.0 or force:
-                format = "JPEG"
-                self.lib.MagickResizeImage(
-                    wand, int(ratio * width + 0.5), int(ratio * height + 0.5),
-                    0, 1.0)
-            elif format not in ("GIF", "JPEG", "PNG"):
-                format = "JPEG"
+            ratios = []
+            for spec in specs:
+                if spec["crop"]:
+                    ratios.append(max(spec["max_height"] * 1.0 / height,
+                                      spec["max_width"] * 1.0 / width))
+                else:
+                    ratios.append(min(spec["max_height"] * 1.0 / height,
+                                      spec["max_width"] * 1.0 / width))
+
+            # Resize the one wand from the largest size to the smallest,
+            # encoding a copy of it at each step
+            results = [None] * len(specs)
+            order = sorted(range(len(specs)), key=lambda i: -ratios[i])
+            try:
+                for n, i in enumerate(order):
+                    format = src_format
+                    if ratios[i] < 1.0 or specs[i]["force"]:
+                        format = "JPEG"
+                        new_width = int(ratios[i] * width + 0.5)
+                        new_height = int(ratios[i] * height + 0.5)
+                        if new_width != self.lib.MagickGetImageWidth(wand) or \
+                           new_height != self.lib.MagickGetImageHeight(wand):
+                            self.lib.MagickResizeImage(
+                                wand, new_width, new_height, 0, 1.0)
+                    elif format not in ("GIF", "JPEG", "PNG"):
+                        format = "JPEG"
+                    if n == len(order) - 1:
+                        output, wand = wand, None
+                    else:
+                        output = self.lib.CloneMagickWand(wand)
+                    results[i] = self._encode_image(
+                        output, src_format, format, specs[i], to_file)
+            except Exception:
+                # Don't leave behind the files of the sizes we finished
+                for result in results:
+                    if result and "path" in result:
+                        os.remove(result["path"])
+                raise
+            return results
+        finally:
+            if wand is not None:
+                self.lib.DestroyMagickWand(wand)
 
+    def _encode_image(self, wand, src_format, format, spec, to_file=False):
+        """Crops and encodes the given wand, and then destroys it."""
+        max_width = spec["max_width"]
+        max_height = spec["max_height"]
+        try:
             if format != src_format:
                 # Flatten to fix background on transparent images. We have to
                 # do this before cropping, as MagickFlattenImages appears to
@@ -127,26 +227,33 @@ class _ImageMagick(object):
                 self.lib.DestroyMagickWand(wand)
                 wand = flat_wand
 
-            if crop:
+            if spec["crop"]:
                 x = (self.lib.MagickGetImageWidth(wand) - max_width) / 2
                 y = (self.lib.MagickGetImageHeight(wand) - max_height) / 2
                 self.lib.MagickCropImage(wand, max_width, max_height, x, y)
 
             if format == "JPEG":
                 # Default compression is best for PNG, GIF.
-                self.lib.MagickSetCompressionQuality(wand, quality)
+                self.lib.MagickSetCompressionQuality(wand, spec["quality"])
 
             self.lib.MagickSetFormat(wand, format)
-            size = ctypes.c_size_t()
-            ptr = self.lib.MagickGetImageBlob(wand, ctypes.byref(size))
-            body = ctypes.string_at(ptr, size.value)
-            self.lib.MagickRelinquishMemory(ptr)
-
-            return {
-                "data": body,
+            result = {
                 "mime_type": "image/" + format.lower(),
                 "width": self.lib.MagickGetImageWidth(wand),
                 "height": self.lib.MagickGetImageHeight(wand),
             }
+            if to_file:
+                fd, path = tempfile.mkstemp(prefix="resized-")
+                os.close(fd)
+                if not self.lib.MagickWriteImage(wand, format + ":" + path):
+                    os.remove(path)
+                    raise ImageException("Could not write %s" % path)
+                result["path"] = path
+            else:
+                size = ctypes.c_size_t()
+                ptr = self.lib.MagickGetImageBlob(wand, ctypes.byref(size))
+                result["data"] = ctypes.string_at(ptr, size.value)
+                self.lib.MagickRelinquishMemory(ptr)
+            return result
         finally:
             self.lib.DestroyMagickWand(wand)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Serves a Tornado application from several pre-forked processes"""
+
+import errno
+import logging
+import os
+import random
+import signal
+import time
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+
+
+class Supervisor(object):
+    """Forks worker processes that share a listening socket.
+
+    We bind the socket in the parent, then fork num_processes workers. Each
+    worker calls make_app() to build its application, so everything it
+    creates, like database connections and thread pools, belongs to that
+    worker alone. The parent must not create an IOLoop before run().
+
+    The parent restarts workers that exit unexpectedly. On SIGHUP, it
+    replaces every worker: new workers start serving right away, and the
+    old ones stop accepting connections and exit once their requests
+    finish, or after graceful_timeout seconds. On SIGTERM or SIGINT, it
+    shuts all the workers down the same way and exits.
+
+    If on_stop is given, a stopping worker calls on_stop(callback) once
+    its requests finish, so the application can write what it holds in
+    memory, and exits when on_stop calls the callback.
+    """
+    def __init__(self, make_app, port, num_processes=None, address="",
+                 graceful_timeout=30, on_stop=None,
+                 server_class=tornado.httpserver.HTTPServer, **server_args):
+        self.make_app = make_app
+        self.on_stop = on_stop
+        self.server_class = server_class
+        self.num_processes = num_processes or _cpu_count()
+        self.graceful_timeout = graceful_timeout
+        self.server_args = server_args
+        self.sockets = tornado.netutil.bind_sockets(port, address=address)
+        self._workers = {}
+        self._retiring = set()
+        self._restart = False
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._on_restart)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        for i in xrange(self.num_processes):
+            self._spawn()
+        while self._workers or self._retiring:
+            if self._restart:
+                self._restart = False
+                self._replace_workers()
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid in self._retiring:
+                self._retiring.discard(pid)
+                continue
+            started = self._workers.pop(pid, None)
+            if started is None or self._stopping:
+                continue
+            logging.error("Worker %d exited with status %d; restarting",
+                          pid, status)
+            # Don't spin if workers crash on startup
+            time.sleep(max(0, started + 1 - time.time()))
+            self._spawn()
+        logging.info("All workers stopped")
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._workers[pid] = time.time()
+            return
+        # In the worker process
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, signal.SIG_DFL)
+        random.seed()
+        try:
+            Worker(self).run()
+        except Exception:
+            logging.error("Worker %d failed", os.getpid(), exc_info=True)
+            os._exit(1)
+        os._exit(0)
+
+    def _replace_workers(self):
+        old = list(self._workers.keys())
+        logging.info("Replacing %d workers", len(old))
+        for pid in old:
+            self._spawn()
+            self._retire(pid)
+
+    def _retire(self, pid):
+        self._workers.pop(pid, None)
+        self._retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+            self._retiring.discard(pid)
+
+    def _on_restart(self, signum, frame):
+        self._restart = True
+
+    def _on_stop(self, signum, frame):
+        if self._stopping:
+            return
+        self._stopping = True
+        for pid in list(self._workers.keys()):
+            self._retire(pid)
+
+
+class Worker(object):
+    """Serves requests in a forked process until it gets a SIGTERM."""
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.active = 0
+        self.app = supervisor.make_app()
+        self.io_loop = tornado.ioloop.IOLoop.instance()
+        self.server = supervisor.server_class(
+            self._handle_request, **supervisor.server_args)
+
+    def run(self):
+        self.server.add_sockets(self.supervisor.sockets)
+        call_on_signal(self._drain, io_loop=self.io_loop)
+        self.io_loop.start()
+
+    def _handle_request(self, request):
+        self.active += 1
+        finish = request.finish
+        def tracked_finish():
+            self.active -= 1
+            finish()
+        request.finish = tracked_finish
+        self.app(request)
+
+    def _drain(self):
+        """Stops accepting connections and waits for active requests."""
+        self.server.stop()
+        deadline = time.time() + self.supervisor.graceful_timeout
+        def check():
+            if self.active > 0 and time.time() <= deadline:
+                self.io_loop.add_timeout(time.time() + 0.1, check)
+            elif self.supervisor.on_stop:
+                self.supervisor.on_stop(self.io_loop.stop)
+            else:
+                self.io_loop.stop()
+        check()
+
+
+def call_on_signal(callback, signals=(signal.SIGTERM,), io_loop=None):
+    """Calls callback on the IOLoop once the process gets one of signals.
+
+    The IOLoop isn't safe to use from a signal handler, which can run while
+    the IOLoop holds its locks, so the handler only sets a flag, which we
+    check from the IOLoop ten times a second.
+    """
+    io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+    received = []
+
+    def on_signal(signum, frame):
+        received.append(signum)
+
+    def check():
+        if received:
+            timer.stop()
+            callback()
+    timer = tornado.ioloop.PeriodicCallback(check, 100, io_loop=io_loop)
+    timer.start()
+    for sig in signals:
+        signal.signal(sig, on_signal)
+
+
+def _cpu_count():
+    try:
+        return os.sysconf("SC_NPROCESSORS_CONF")
+    except ValueError:
+        return 1
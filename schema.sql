@@ -26,10 +26,15 @@ CREATE TABLE cookbook_recipes (
     description MEDIUMTEXT NOT NULL,
     ingredients MEDIUMTEXT NOT NULL,
     instructions MEDIUMTEXT NOT NULL,
+    description_html MEDIUMTEXT NOT NULL,
+    ingredients_html MEDIUMTEXT NOT NULL,
+    instructions_html MEDIUMTEXT NOT NULL,
+    html_version INT NOT NULL DEFAULT 0,
     created DATETIME NOT NULL,
     updated TIMESTAMP NOT NULL,
     KEY (author_id, created),
-    KEY (category)
+    KEY (category),
+    KEY (updated)
 );
 
 DROP TABLE IF EXISTS cookbook_users;
@@ -48,7 +53,8 @@ CREATE TABLE cookbook_friends (
     user_id VARCHAR(25) NOT NULL,
     friend_id VARCHAR(25) NOT NULL,
     created TIMESTAMP NOT NULL,
-    PRIMARY KEY (user_id, friend_id)
+    PRIMARY KEY (user_id, friend_id),
+    KEY (created)
 );
 
 DROP TABLE IF EXISTS cookbook_clipped;
@@ -58,7 +64,8 @@ CREATE TABLE cookbook_clipped (
     created TIMESTAMP NOT NULL,
     PRIMARY KEY (user_id, recipe_id),
     KEY (user_id, created),
-    KEY (recipe_id)
+    KEY (recipe_id, created),
+    KEY (created)
 );
 
 DROP TABLE IF EXISTS cookbook_cooked;
@@ -68,7 +75,24 @@ CREATE TABLE cookbook_cooked (
     created TIMESTAMP NOT NULL,
     KEY (user_id, recipe_id),
     KEY (user_id, created),
-    KEY (recipe_id)
+    KEY (recipe_id, created)
+);
+
+DROP TABLE IF EXISTS cookbook_activity;
+CREATE TABLE cookbook_activity (
+    user_id VARCHAR(25) NOT NULL REFERENCES cookbook_users(id),
+    actor_id VARCHAR(25) NOT NULL REFERENCES cookbook_users(id),
+    recipe_id INT NOT NULL REFERENCES cookbook_recipes(id),
+    action VARCHAR(25) NOT NULL,
+    created TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, created, actor_id, recipe_id, action)
+);
+
+DROP TABLE IF EXISTS cookbook_counts;
+CREATE TABLE cookbook_counts (
+    recipe_id INT NOT NULL PRIMARY KEY REFERENCES cookbook_recipes(id),
+    clips INT NOT NULL DEFAULT 0,
+    cooks INT NOT NULL DEFAULT 0
 );
 
 DROP TABLE IF EXISTS cookbook_photos;
@@ -82,3 +106,11 @@ CREATE TABLE cookbook_photos (
     thumb_width INT NOT NULL,
     thumb_height INT NOT NULL
 );
+
+DROP TABLE IF EXISTS cookbook_categories;
+CREATE TABLE cookbook_categories (
+    user_id VARCHAR(25) NOT NULL,
+    category VARCHAR(512) NOT NULL,
+    recipes INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, category(255))
+);
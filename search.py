@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""An in-memory full-text index of recipes"""
+
+import bisect
+import cPickle
+import logging
+import math
+import os
+import re
+import tempfile
+import threading
+
+# How much a word counts toward a recipe's score in each field
+FIELD_WEIGHTS = (
+    ("title", 5.0),
+    ("category", 3.0),
+    ("ingredients", 2.0),
+    ("description", 1.0),
+)
+
+# Bump this when tokenize() or FIELD_WEIGHTS change to ignore old snapshots
+SNAPSHOT_VERSION = 1
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+_STOP_WORDS = frozenset([
+    "a", "an", "and", "as", "at", "be", "by", "for", "from", "in", "into",
+    "is", "it", "of", "on", "or", "the", "then", "to", "until", "with",
+    "cup", "cups", "lb", "lbs", "oz", "tbsp", "tsp",
+    "tablespoon", "tablespoons", "teaspoon", "teaspoons",
+])
+
+
+def tokenize(text):
+    """Returns the lowercase words in text, skipping numbers, single
+    letters and stop words.
+    """
+    return [w for w in _WORD_RE.findall(text.lower())
+            if len(w) > 1 and w not in _STOP_WORDS and not w.isdigit()]
+
+
+class SearchIndex(object):
+    """Finds recipes by the words in their title, category, ingredients and
+    description.
+
+    Every word in a query has to match a word in the recipe, either exactly
+    or as a prefix, so "choc chip" finds "Chocolate Chip Cookies". We rank
+    matches by how often the words appear, weighted by field, and by how
+    rare they are across all recipes.
+
+    Each recipe's word weights are kept in a forward index alongside the
+    inverted one, so updating a recipe replaces its words, and so we can
+    save the index to a snapshot file and load it on restart instead of
+    reading every recipe from MySQL. All methods are safe to call from
+    multiple threads.
+    """
+    def __init__(self, max_expansions=50):
+        self.max_expansions = max_expansions
+        self.updated = None
+        self._docs = {}
+        self._postings = {}
+        self._terms = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, recipe):
+        """Indexes the given recipe, replacing any earlier version of it."""
+        self.add_many([recipe])
+
+    def add_many(self, recipes):
+        docs = [(r["id"], _weigh(r)) for r in recipes]
+        with self._lock:
+            for id, weights in docs:
+                self._remove(id)
+                self._add(id, weights)
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def search(self, query, visible=None, limit=20):
+        """Returns the ids of the best recipes matching query, best first.
+
+        If visible is given, we only return the recipes for which
+        visible(id) is true.
+        """
+        words = tokenize(query)
+        if not words:
+            return []
+        with self._lock:
+            num_docs = len(self._docs)
+            scores = None
+            for word in set(words):
+                matches = {}
+                for term, factor in self._expand(word):
+                    postings = self._postings[term]
+                    idf = math.log(1.0 + float(num_docs) / len(postings))
+                    for id, weight in postings.iteritems():
+                        score = weight * idf * factor
+                        if score > matches.get(id, 0):
+                            matches[id] = score
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = dict((id, score + matches[id])
+                                  for id, score in scores.iteritems()
+                                  if id in matches)
+                if not scores:
+                    return []
+        ranked = sorted(scores.iteritems(), key=lambda i: (-i[1], i[0]))
+        result = []
+        for id, score in ranked:
+            if visible is None or visible(id):
+                result.append(id)
+                if len(result) >= limit:
+                    break
+        return result
+
+    def save(self, path):
+        """Writes the index to path, replacing the file atomically."""
+        with self._lock:
+            # Word weights are replaced, never changed, so a shallow copy
+            # is consistent
+            docs = dict(self._docs)
+            updated = self.updated
+        dir = os.path.dirname(path) or "."
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        fd, temp = tempfile.mkstemp(dir=dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                cPickle.dump((SNAPSHOT_VERSION, updated, docs), f,
+                             cPickle.HIGHEST_PROTOCOL)
+            os.rename(temp, path)
+        except Exception:
+            os.unlink(temp)
+            raise
+
+    def load(self, path):
+        """Replaces the index with the one saved in path.
+
+        Returns False if the file is missing, from an older version or
+        can't be read for any other reason.
+        """
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, "rb") as f:
+                version, updated, docs = cPickle.load(f)
+        except Exception:
+            logging.warning("Could not load the search index from %s",
+                            path, exc_info=True)
+            return False
+        if version != SNAPSHOT_VERSION:
+            return False
+        self._replace(docs.iteritems())
+        self.updated = updated
+        return True
+
+    def build(self, recipes):
+        """Replaces the index with the given recipes."""
+        self._replace((r["id"], _weigh(r)) for r in recipes)
+
+    def _replace(self, docs):
+        with self._lock:
+            self._docs = {}
+            self._postings = {}
+            for id, weights in docs:
+                self._add(id, weights, insort=False)
+            # Sorting once is much faster than inserting each term in order
+            self._terms = sorted(self._postings)
+
+    def _add(self, id, weights, insort=True):
+        self._docs[id] = weights
+        for term, weight in weights.iteritems():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                if insort:
+                    bisect.insort(self._terms, term)
+            postings[id] = weight
+
+    def _remove(self, id):
+        weights = self._docs.pop(id, None)
+        if not weights:
+            return
+        for term in weights:
+            postings = self._postings[term]
+            del postings[id]
+            if not postings:
+                del self._postings[term]
+                del self._terms[bisect.bisect_left(self._terms, term)]
+
+    def _expand(self, word):
+        """Yields the terms matching word and how much each match counts.
+
+        An exact match counts fully; a word that merely starts with it
+        counts for less.
+        """
+        if word in self._postings:
+            yield word, 1.0
+        i = bisect.bisect_right(self._terms, word)
+        for term in self._terms[i:i + self.max_expansions]:
+            if not term.startswith(word):
+                break
+            yield term, 0.7
+
+
+def _weigh(recipe):
+    """Returns a dict of each term in the recipe to its weight."""
+    counts = {}
+    for field, weight in FIELD_WEIGHTS:
+        for word in tokenize(recipe[field]):
+            counts[word] = counts.get(word, 0) + weight
+    # Saturate, so a word repeated ten times doesn't count ten times as
+    # much as a word used once
+    return dict((term, count * 2.2 / (count + 1.2))
+                for term, count in counts.iteritems())
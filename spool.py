@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A durable queue of background jobs stored in SQLite"""
+
+import collections
+import functools
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import tornado.ioloop
+import tornado.stack_context
+import workers
+
+
+class Spool(object):
+    """Runs jobs in batches on the IOLoop, retrying them until they succeed.
+
+    put() stores a job in a SQLite file and returns right away. Every
+    interval seconds, we claim up to batch_size jobs that are due and pass
+    them to send(jobs, callback), which must call callback with a list
+    holding a result for each job: None if it succeeded, or a (permanent,
+    message) tuple if it failed. We retry failed jobs with exponential
+    backoff, and after max_attempts attempts, or a permanent failure, we
+    mark them dead and leave them in the file for retry_dead().
+
+    Every process on a machine can share one file. Claiming a job leases it
+    for lease_time seconds, so if a process dies while sending, another one
+    sends the job again once the lease runs out. Jobs are sent at least
+    once, not exactly once.
+
+    Each job has a key, like a user id. If rate_limit is given as a
+    (count, seconds) tuple, we send at most count jobs with the same key in
+    any period of that many seconds from each process. Keys over the limit
+    are left out of the claim query, so one busy key can't hold up the
+    others. If a job is put with a dedupe string and a pending job already
+    has it, we drop the new job.
+
+    If pool is given, as a workers.ThreadPool, we read and write the file
+    on it, so waiting for another process's lock never blocks the IOLoop.
+    """
+    def __init__(self, path, send, batch_size=50, concurrency=2, interval=1,
+                 max_attempts=8, lease_time=300, rate_limit=None, pool=None,
+                 io_loop=None):
+        self.path = path
+        self.send = send
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.lease_time = lease_time
+        self.rate_limit = rate_limit
+        self.pool = pool
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self._in_flight = 0
+        self._claiming = False
+        self._sent = collections.defaultdict(collections.deque)
+        self._timer = None
+        # Pool threads share the connection, one at a time
+        self._lock = threading.Lock()
+        dir = os.path.dirname(path)
+        if dir and not os.path.isdir(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                # Another process may have just made it
+                if not os.path.isdir(dir):
+                    raise
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "key TEXT NOT NULL, "
+            "dedupe TEXT UNIQUE, "
+            "payload TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "run_at REAL NOT NULL, "
+            "dead INTEGER NOT NULL DEFAULT 0, "
+            "error TEXT)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_due ON jobs (dead, run_at)")
+        self._db.execute(
+            "CREATE TEMP TABLE limited (key TEXT NOT NULL PRIMARY KEY)")
+
+    def put(self, key, payload, dedupe=None):
+        """Stores a job whose payload can be encoded as JSON."""
+        self._on_pool(lambda result: None, self._put, key,
+                      json.dumps(payload), dedupe, time.time())
+
+    def _put(self, key, payload, dedupe, now):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO jobs (key, dedupe, payload, run_at) "
+                "VALUES (?, ?, ?, ?)", (key, dedupe, payload, now))
+
+    def start(self):
+        """Starts sending jobs from the IOLoop, including any left over."""
+        self._timer = tornado.ioloop.PeriodicCallback(
+            self._send_jobs, self.interval * 1000, io_loop=self.io_loop)
+        self._timer.start()
+
+    def stop(self):
+        """Stops claiming jobs. Batches already sent still finish."""
+        if self._timer:
+            self._timer.stop()
+            self._timer = None
+
+    def in_flight(self):
+        """Returns the number of batches sent that haven't finished"""
+        return self._in_flight
+
+    def retry_dead(self):
+        """Makes every dead job due again, returning how many there were."""
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE jobs SET dead = 0, attempts = 0, run_at = ? "
+                "WHERE dead = 1", (time.time(),))
+            return cursor.rowcount
+
+    def stats(self):
+        """Returns the number of pending and dead jobs in the file"""
+        stats = {"pending": 0, "dead": 0, "in_flight": self._in_flight}
+        with self._lock:
+            for dead, count in self._db.execute(
+                "SELECT dead, COUNT(*) FROM jobs GROUP BY dead"):
+                stats["dead" if dead else "pending"] = count
+        return stats
+
+    def _on_pool(self, callback, fn, *args):
+        """Calls fn on our pool, or right away if we don't have one."""
+        if self.pool is None:
+            callback(log_errors(fn, *args))
+            return
+        try:
+            with tornado.stack_context.NullContext():
+                self.pool.submit(callback, log_errors, fn, *args)
+        except workers.PoolFullError:
+            logging.error("Thread pool is full; not running %s", fn.__name__)
+            callback(None)
+
+    def _send_jobs(self):
+        if self._claiming or self._in_flight >= self.concurrency:
+            return
+        self._claiming = True
+        self._on_pool(self._on_claim, self._claim)
+
+    def _on_claim(self, jobs):
+        self._claiming = False
+        if not jobs:
+            return
+        self._in_flight += 1
+        with tornado.stack_context.NullContext():
+            try:
+                self.send(jobs, functools.partial(self._on_sent, jobs))
+            except Exception, e:
+                logging.error("Error sending jobs", exc_info=True)
+                self._on_sent(jobs, [(False, str(e))] * len(jobs))
+        # Claim another batch if we have room for it
+        if self._timer:
+            self._send_jobs()
+
+    def _claim(self):
+        """Leases a batch of due jobs to this process.
+
+        We query for jobs whose keys are under the rate limit. When a key
+        reaches the limit partway through a batch, we add it to the
+        excluded keys and query again for the rest of the batch.
+        """
+        now = time.time()
+        with self._lock:
+            limited = self._limited_keys(now)
+            # Lock the file while we claim, so no other process gets the jobs
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("DELETE FROM limited")
+                self._db.executemany(
+                    "INSERT INTO limited (key) VALUES (?)",
+                    [(key,) for key in limited])
+                jobs = []
+                while len(jobs) < self.batch_size:
+                    wanted = self.batch_size - len(jobs)
+                    rows = self._db.execute(
+                        "SELECT id, key, payload, attempts FROM jobs "
+                        "WHERE dead = 0 AND run_at <= ? AND key NOT IN "
+                        "(SELECT key FROM limited) ORDER BY run_at LIMIT ?",
+                        (now, wanted)).fetchall()
+                    claimed = []
+                    for id, key, payload, attempts in rows:
+                        if key in limited:
+                            continue
+                        if not self._allow(key, now):
+                            limited.add(key)
+                            self._db.execute(
+                                "INSERT INTO limited (key) VALUES (?)",
+                                (key,))
+                            continue
+                        claimed.append({
+                            "id": id, "key": key, "attempts": attempts,
+                            "payload": json.loads(payload)})
+                    self._db.executemany(
+                        "UPDATE jobs SET run_at = ? WHERE id = ?",
+                        [(now + self.lease_time, job["id"])
+                         for job in claimed])
+                    jobs += claimed
+                    if len(rows) < wanted:
+                        break
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._prune_sent(now)
+        return jobs
+
+    def _limited_keys(self, now):
+        """Returns the set of keys at the rate limit."""
+        if not self.rate_limit:
+            return set()
+        count, seconds = self.rate_limit
+        limited = set()
+        for key, sent in self._sent.iteritems():
+            while sent and sent[0] <= now - seconds:
+                sent.popleft()
+            if len(sent) >= count:
+                limited.add(key)
+        return limited
+
+    def _allow(self, key, now):
+        if not self.rate_limit:
+            return True
+        count, seconds = self.rate_limit
+        sent = self._sent[key]
+        while sent and sent[0] <= now - seconds:
+            sent.popleft()
+        if len(sent) >= count:
+            return False
+        sent.append(now)
+        return True
+
+    def _on_sent(self, jobs, results):
+        self._in_flight -= 1
+        now = time.time()
+        done = []
+        retry = []
+        dead = []
+        results = list(results)
+        results += [(False, "No result")] * (len(jobs) - len(results))
+        for job, result in zip(jobs, results):
+            if result is None:
+                done.append((job["id"],))
+                continue
+            permanent, message = result
+            attempts = job["attempts"] + 1
+            if permanent or attempts >= self.max_attempts:
+                logging.error("Giving up on job %d after %d attempts: %s",
+                              job["id"], attempts, message)
+                dead.append((attempts, message, job["id"]))
+            else:
+                delay = min(2 ** attempts, 3600) * (1 + random.random())
+                retry.append((attempts, message, now + delay, job["id"]))
+        self._on_pool(lambda result: None, self._record, done, retry, dead)
+
+    def _record(self, done, retry, dead):
+        """Writes the results of a batch to the file."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany("DELETE FROM jobs WHERE id = ?", done)
+                self._db.executemany(
+                    "UPDATE jobs SET attempts = ?, error = ?, run_at = ? "
+                    "WHERE id = ?", retry)
+                # Dead jobs no longer count as pending for dedupe
+                self._db.executemany(
+                    "UPDATE jobs SET attempts = ?, error = ?, dead = 1, "
+                    "dedupe = NULL WHERE id = ?", dead)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _prune_sent(self, now):
+        """Forgets the keys that can't be rate limited any more."""
+        if not self.rate_limit or len(self._sent) < 10000:
+            return
+        seconds = self.rate_limit[1]
+        for key in list(self._sent.keys()):
+            sent = self._sent[key]
+            if not sent or sent[-1] <= now - seconds:
+                del self._sent[key]
+
+
+def log_errors(fn, *args):
+    """Calls fn, returning None rather than raising if it fails."""
+    try:
+        return fn(*args)
+    except Exception:
+        logging.error("Error in %s", fn.__name__, exc_info=True)
+        return None
@@ -67,6 +67,19 @@ $(function() {
 	}
 	return true;
     });
+    $("a.more").live("click", function() {
+	var link = $(this);
+	link.addClass("loading");
+	$.getJSON(link.attr("href"), {fragment: 1}, function(response) {
+	    link.removeClass("loading").before(response.html);
+	    if (response.next) {
+		link.attr("href", response.next);
+	    } else {
+		link.remove();
+	    }
+	});
+	return false;
+    });
     window.setTimeout(function() {
 	$("#error").slideUp();
     }, 4000);
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os.path
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import cache
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_get_and_set(self):
+        c = cache.LRUCache(10)
+        c.set("a", 1)
+        self.assertEqual(c.get("a"), 1)
+        self.assertEqual(c.get("b", "default"), "default")
+        self.assertEqual(c.stats()["hits"], 1)
+        self.assertEqual(c.stats()["misses"], 1)
+
+    def test_evicts_least_recently_used(self):
+        c = cache.LRUCache(2)
+        c.set("a", 1)
+        c.set("b", 2)
+        c.get("a")
+        c.set("c", 3)
+        self.assertEqual(c.get("a"), 1)
+        self.assertEqual(c.get("b"), None)
+        self.assertEqual(c.get("c"), 3)
+        self.assertEqual(len(c), 2)
+
+    def test_set_replaces_and_refreshes(self):
+        c = cache.LRUCache(2)
+        c.set("a", 1)
+        c.set("b", 2)
+        c.set("a", 3)
+        c.set("c", 4)
+        self.assertEqual(c.get("a"), 3)
+        self.assertEqual(c.get("b"), None)
+
+    def test_expires_after_ttl(self):
+        c = cache.LRUCache(10, ttl=0.05)
+        c.set("a", 1)
+        c.set("b", 2, ttl=60)
+        self.assertEqual(c.get("a"), 1)
+        time.sleep(0.1)
+        self.assertEqual(c.get("a"), None)
+        self.assertEqual(c.get("b"), 2)
+
+    def test_get_many_skips_misses(self):
+        c = cache.LRUCache(10)
+        c.set("a", 1)
+        c.set("b", None)
+        self.assertEqual(c.get_many(["a", "b", "c"]), {"a": 1, "b": None})
+
+    def test_delete_and_clear(self):
+        c = cache.LRUCache(10)
+        c.set("a", 1)
+        c.set("b", 2)
+        c.delete("a")
+        c.delete("missing")
+        self.assertEqual(c.get("a"), None)
+        c.clear()
+        self.assertEqual(len(c), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
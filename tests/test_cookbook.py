@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import os.path
+import re
+import sys
+import unittest
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import cache
+import cookbook
+import search
+import tornado.database
+import tornado.httpserver
+import tornado.web
+
+
+class CursorTest(unittest.TestCase):
+    def make_handler(self, uri):
+        app = tornado.web.Application([
+            tornado.web.url(r"/cookbook/([^/]+)", cookbook.CookbookHandler,
+                            name="cookbook"),
+        ])
+        request = tornado.httpserver.HTTPRequest("GET", uri)
+        return cookbook.BaseHandler(app, request)
+
+    def test_round_trip(self):
+        cursor = (datetime.datetime(2011, 10, 1, 12, 30, 5), 42)
+        url = self.make_handler("/").cookbook_page_url({"id": "me"}, cursor)
+        self.assertEqual(urlparse.urlparse(url).path, "/cookbook/me")
+        self.assertEqual(self.make_handler(url).get_cursor("before"), cursor)
+
+    def test_no_cursor(self):
+        handler = self.make_handler("/cookbook/me?before=")
+        self.assertEqual(handler.get_cursor("before"), None)
+        self.assertEqual(handler.get_cursor("after"), None)
+        self.assertEqual(handler.cookbook_page_url({"id": "me"}, None), None)
+
+    def test_bad_cursor(self):
+        for value in ("abc", "12", "1-2-3", "1-x"):
+            handler = self.make_handler("/cookbook/me?before=" + value)
+            try:
+                handler.get_cursor("before")
+            except tornado.web.HTTPError, e:
+                self.assertEqual(e.status_code, 400)
+            else:
+                self.fail("accepted cursor %r" % value)
+
+
+class FakeSlugDatabase(object):
+    """Answers create_recipe's queries from a set of taken slugs.
+
+    The first steal INSERTs lose a race: another process takes the slug
+    just before we do.
+    """
+    def __init__(self, slugs=(), steal=0):
+        self.slugs = set(slugs)
+        self.steal = steal
+        self.suffix_queries = 0
+        self.inserted = {}
+
+    def get(self, query, base, start, bare, like, regexp):
+        self.suffix_queries += 1
+        pattern = re.compile(regexp)
+        suffixes = [0 if slug == base else int(slug[start - 1:])
+                    for slug in self.slugs
+                    if slug == base or pattern.match(slug)]
+        return {"suffix": max(suffixes) if suffixes else None}
+
+    def execute(self, query, *args):
+        slug = args[-1]
+        if self.steal:
+            self.steal -= 1
+            self.slugs.add(slug)
+        if slug in self.slugs:
+            raise tornado.database.IntegrityError(1062, "Duplicate entry")
+        self.slugs.add(slug)
+        id = len(self.inserted) + 1
+        self.inserted[id] = slug
+        return id
+
+
+class SlugTest(unittest.TestCase):
+    def make_backend(self, db):
+        # Just what create_recipe needs, without connecting to anything
+        backend = cookbook.Backend.__new__(cookbook.Backend)
+        backend.db = db
+        backend.caches = {
+            "slugs": cache.LRUCache(100),
+            "slug_suffixes": cache.LRUCache(100),
+        }
+        backend.search_index = search.SearchIndex()
+        return backend
+
+    def create(self, backend, title):
+        """Creates a recipe with the given title, returning its slug."""
+        id = backend.create_recipe(title, "Dessert", "", "", "",
+                                   {"id": "me"})
+        return backend.db.inserted[id]
+
+    def test_suffixes_count_up(self):
+        db = FakeSlugDatabase()
+        backend = self.make_backend(db)
+        self.assertEqual(self.create(backend, "Chocolate Cake!"),
+                         "chocolate-cake")
+        self.assertEqual(self.create(backend, "Chocolate Cake"),
+                         "chocolate-cake-1")
+        self.assertEqual(self.create(backend, "chocolate cake"),
+                         "chocolate-cake-2")
+        # We remember the last suffix instead of asking MySQL each time
+        self.assertEqual(db.suffix_queries, 1)
+
+    def test_ignores_long_suffixes(self):
+        db = FakeSlugDatabase(["cookies", "cookies-3", "cookies-48213371",
+                               "cookies-and-cream"])
+        self.assertEqual(self.create(self.make_backend(db), "Cookies"),
+                         "cookies-4")
+
+    @unittest.skipIf(not hasattr(tornado.database, "IntegrityError"),
+                     "tornado.database needs MySQLdb for IntegrityError")
+    def test_falls_back_to_random_suffix(self):
+        db = FakeSlugDatabase(
+            ["cookies"], steal=cookbook.Backend.SLUG_ATTEMPTS / 2)
+        backend = self.make_backend(db)
+        self.assertTrue(re.match(r"^cookies-[0-9]{8}$",
+                                 self.create(backend, "Cookies")))
+        # The random suffix doesn't become the next one
+        self.assertEqual(self.create(backend, "Cookies"), "cookies-6")
+
+    @unittest.skipIf(not hasattr(tornado.database, "IntegrityError"),
+                     "tornado.database needs MySQLdb for IntegrityError")
+    def test_gives_up_after_attempts(self):
+        db = FakeSlugDatabase(steal=cookbook.Backend.SLUG_ATTEMPTS)
+        self.assertRaises(tornado.database.IntegrityError, self.create,
+                          self.make_backend(db), "Cookies")
+
+
+if __name__ == "__main__":
+    unittest.main()
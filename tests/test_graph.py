@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import array
+import os.path
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import graph
+
+
+class FriendGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = graph.FriendGraph()
+        self.graph.load([("me", "b"), ("me", "a"), ("me", "c"),
+                         ("a", "me"), ("a", "c"), ("me", "a")])
+
+    def test_load(self):
+        self.assertEqual(sorted(self.graph.friend_ids("me")),
+                         ["a", "b", "c"])
+        self.assertEqual(self.graph.friend_ids("nobody"), [])
+        self.assertEqual(self.graph.num_edges, 5)
+
+    def test_edges_are_directed(self):
+        self.assertTrue(self.graph.are_friends("me", "b"))
+        self.assertFalse(self.graph.are_friends("b", "me"))
+        self.assertFalse(self.graph.are_friends("me", "nobody"))
+
+    def test_mutual_friends(self):
+        self.assertEqual(self.graph.mutual_friend_ids("me", "a"), ["c"])
+        self.assertEqual(self.graph.mutual_friend_ids("me", "nobody"), [])
+
+    def test_add_and_remove_edges(self):
+        self.graph.add_edges([("b", "me"), ("me", "d"), ("me", "a")])
+        self.assertTrue(self.graph.are_friends("b", "me"))
+        self.assertTrue(self.graph.are_friends("me", "d"))
+        self.assertEqual(self.graph.num_edges, 7)
+        self.graph.remove_edges([("me", "a"), ("me", "nobody")])
+        self.assertFalse(self.graph.are_friends("me", "a"))
+        self.assertEqual(self.graph.num_edges, 6)
+
+    def test_reload_keeps_user_integers(self):
+        before = self.graph.intern("c")
+        self.graph.load([("c", "me")])
+        self.assertEqual(self.graph.intern("c"), before)
+        self.assertEqual(self.graph.friend_ids("me"), [])
+        self.assertEqual(self.graph.friend_ids("c"), ["me"])
+
+    def test_stats(self):
+        stats = self.graph.stats()
+        self.assertEqual(stats["users"], 4)
+        self.assertEqual(stats["edges"], 5)
+        self.assertTrue(stats["bytes"] > 0)
+
+
+class ClipIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = graph.FriendGraph()
+        self.graph.load([("me", f) for f in ("a", "b", "c", "d")])
+        self.clips = graph.ClipIndex(self.graph)
+        self.clips.load([(1, "a", 100), (1, "c", 300), (1, "b", 200),
+                         (1, "stranger", 400), (2, "me", 100)])
+
+    def test_is_clipped(self):
+        self.assertTrue(self.clips.is_clipped("me", 2))
+        self.assertFalse(self.clips.is_clipped("me", 1))
+        self.assertFalse(self.clips.is_clipped("nobody", 1))
+        self.assertFalse(self.clips.is_clipped("a", 3))
+
+    def test_friends_newest_clip_first(self):
+        self.assertEqual(self.clips.friends_who_clipped("me", 1),
+                         ["c", "b", "a"])
+        self.assertEqual(self.clips.friends_who_clipped("me", 2), [])
+        self.assertEqual(self.clips.friends_who_clipped("nobody", 1), [])
+
+    def test_add_clips_keeps_first_time(self):
+        self.clips.add_clips([(1, "d", 250), (1, "a", 999), (3, "b", 50)])
+        self.assertEqual(self.clips.friends_who_clipped("me", 1),
+                         ["c", "d", "b", "a"])
+        self.assertEqual(self.clips.friends_who_clipped("me", 3), ["b"])
+        self.assertEqual(self.clips.num_clips, 7)
+
+    def test_stats(self):
+        stats = self.clips.stats()
+        self.assertEqual(stats["recipes"], 2)
+        self.assertEqual(stats["clips"], 5)
+
+
+class IntersectTest(unittest.TestCase):
+    def test_similar_sizes(self):
+        self.assertEqual(graph._intersect(array.array("i", [1, 3, 5, 7]),
+                                          array.array("i", [2, 3, 4, 7])),
+                         [3, 7])
+
+    def test_one_much_shorter(self):
+        long = array.array("i", xrange(0, 1000, 3))
+        self.assertEqual(graph._intersect(array.array("i", [3, 4, 999]),
+                                          long), [3, 999])
+        self.assertEqual(graph._intersect(long, array.array("i", [1000])),
+                         [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import search
+
+
+def recipe(id, title, category="Dessert", ingredients="", description=""):
+    return {"id": id, "title": title, "category": category,
+            "ingredients": ingredients, "description": description}
+
+
+class TokenizeTest(unittest.TestCase):
+    def test_skips_stop_words_numbers_and_letters(self):
+        self.assertEqual(search.tokenize("2 cups of Flour, a Pinch x"),
+                         ["flour", "pinch"])
+
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = search.SearchIndex()
+        self.index.build([
+            recipe(1, "Chocolate Chip Cookies", ingredients="chocolate"),
+            recipe(2, "Chicken Soup", category="Soup",
+                   ingredients="chicken\ncarrots", description="chocolate"),
+            recipe(3, "Chocolate Cake"),
+            recipe(4, "Chip Dip", category="Snack"),
+        ])
+
+    def test_every_word_must_match(self):
+        self.assertEqual(self.index.search("chocolate chip"), [1])
+        self.assertEqual(self.index.search("chocolate soup"), [2])
+        self.assertEqual(self.index.search("chocolate pizza"), [])
+        self.assertEqual(self.index.search("the"), [])
+
+    def test_prefixes_match(self):
+        self.assertEqual(self.index.search("choc chip"), [1])
+        self.assertEqual(sorted(self.index.search("chi")), [1, 2, 4])
+
+    def test_exact_match_beats_prefix(self):
+        index = search.SearchIndex()
+        index.build([recipe(1, "Chips"), recipe(2, "Chip")])
+        self.assertEqual(index.search("chip"), [2, 1])
+
+    def test_ranks_by_field_weight(self):
+        # Chocolate is in the title of 1 and 3, but only the description
+        # of 2, and 1 also lists it as an ingredient
+        self.assertEqual(self.index.search("chocolate"), [1, 3, 2])
+
+    def test_visible_and_limit(self):
+        self.assertEqual(self.index.search("chocolate", lambda id: id != 1),
+                         [3, 2])
+        self.assertEqual(self.index.search("chocolate", limit=2), [1, 3])
+
+    def test_update_and_remove(self):
+        self.index.add(recipe(3, "Carrot Cake"))
+        self.assertEqual(self.index.search("chocolate"), [1, 2])
+        self.assertEqual(self.index.search("carrot"), [3, 2])
+        self.index.remove(2)
+        self.assertEqual(self.index.search("carrot"), [3])
+        self.assertEqual(self.index.search("soup"), [])
+        self.assertEqual(len(self.index), 3)
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "snapshots", "index.pickle")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save_and_load(self):
+        index = search.SearchIndex()
+        index.build([recipe(1, "Chocolate Cake")])
+        index.updated = "then"
+        index.save(self.path)
+        loaded = search.SearchIndex()
+        self.assertTrue(loaded.load(self.path))
+        self.assertEqual(loaded.updated, "then")
+        self.assertEqual(loaded.search("choc"), [1])
+
+    def test_missing_or_bad_snapshot(self):
+        index = search.SearchIndex()
+        self.assertFalse(index.load(self.path))
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "wb") as f:
+            f.write("not a pickle")
+        self.assertFalse(index.load(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import spool
+import tornado.testing
+
+
+class SpoolTest(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(SpoolTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "spool", "jobs.db")
+        self.sent = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(SpoolTest, self).tearDown()
+
+    def make_spool(self, results=None, **kwargs):
+        """Returns a spool whose send() answers every job with results."""
+        def send(jobs, callback):
+            self.sent.append([job["payload"] for job in jobs])
+            callback([results] * len(jobs))
+            self.stop()
+        return spool.Spool(self.path, send, io_loop=self.io_loop,
+                           interval=0.01, **kwargs)
+
+    def test_sends_and_removes_jobs(self):
+        s = self.make_spool()
+        s.put("a", {"n": 1})
+        s.put("b", {"n": 2})
+        s.start()
+        self.wait()
+        s.stop()
+        self.assertEqual(self.sent, [[{"n": 1}, {"n": 2}]])
+        self.assertEqual(s.stats()["pending"], 0)
+
+    def test_dedupe_drops_pending_duplicates(self):
+        s = self.make_spool(results=(True, "bad"))
+        s.put("a", {"n": 1}, dedupe="x")
+        s.put("a", {"n": 2}, dedupe="x")
+        self.assertEqual(s.stats()["pending"], 1)
+        s.start()
+        self.wait()
+        s.stop()
+        # A dead job no longer blocks its dedupe string
+        s.put("a", {"n": 3}, dedupe="x")
+        self.assertEqual(s.stats(), {"pending": 1, "dead": 1, "in_flight": 0})
+
+    def test_retries_until_max_attempts(self):
+        s = self.make_spool(results=(False, "flaky"), max_attempts=1)
+        s.put("a", {"n": 1})
+        s.start()
+        self.wait()
+        s.stop()
+        self.assertEqual(s.stats()["dead"], 1)
+        self.assertEqual(s.retry_dead(), 1)
+        self.assertEqual(s.stats()["pending"], 1)
+
+    def test_lease_hides_claimed_jobs(self):
+        first = self.make_spool(lease_time=0.2)
+        second = self.make_spool(lease_time=0.2)
+        first.put("a", {"n": 1})
+        self.assertEqual(len(first._claim()), 1)
+        self.assertEqual(second._claim(), [])
+        time.sleep(0.3)
+        # The lease ran out, so another process may send it again
+        self.assertEqual(len(second._claim()), 1)
+
+    def test_rate_limit_skips_busy_keys(self):
+        s = self.make_spool(rate_limit=(1, 60))
+        for i in xrange(3):
+            s.put("busy", {"n": i})
+        s.put("quiet", {"n": 3})
+        jobs = s._claim()
+        self.assertEqual(sorted(job["key"] for job in jobs),
+                         ["busy", "quiet"])
+        self.assertEqual(s._claim(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import os.path
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import tornado.stack_context
+import tornado.testing
+import workers
+
+
+class ThreadPoolTest(tornado.testing.AsyncTestCase):
+    def test_passes_result_to_callback(self):
+        pool = workers.ThreadPool(2, io_loop=self.io_loop)
+        pool.submit(self.stop, lambda x, y: x * y, 6, y=7)
+        self.assertEqual(self.wait(), 42)
+
+    def test_reraises_in_submitter_context(self):
+        pool = workers.ThreadPool(1, io_loop=self.io_loop)
+
+        def handle(type, value, traceback):
+            self.stop(value)
+            return True
+
+        def fail():
+            raise ValueError("boom")
+        with tornado.stack_context.ExceptionStackContext(handle):
+            pool.submit(lambda result: self.fail("callback ran"), fail)
+        error = self.wait()
+        self.assertTrue(isinstance(error, ValueError))
+        self.assertEqual(str(error), "boom")
+
+    def test_raises_when_queue_is_full(self):
+        pool = workers.ThreadPool(1, max_queue=1, io_loop=self.io_loop)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+        pool.submit(lambda r: None, block)
+        started.wait()
+        pool.submit(lambda r: None, lambda: None)
+        self.assertEqual(pool.pending(), 1)
+        self.assertRaises(workers.PoolFullError, pool.submit,
+                          lambda r: None, lambda: None)
+        release.set()
+
+    def test_wait_for_jobs(self):
+        pool = workers.ThreadPool(1, io_loop=self.io_loop)
+        release = threading.Event()
+        pool.submit(lambda r: None, release.wait)
+        self.assertFalse(pool.wait(0.05))
+        release.set()
+        self.assertTrue(pool.wait(5))
+
+
+class ProcessPoolTest(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(ProcessPoolTest, self).setUp()
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+        super(ProcessPoolTest, self).tearDown()
+
+    def make_pool(self, *args, **kwargs):
+        pool = workers.ProcessPool(*args, io_loop=self.io_loop, **kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def catch(self):
+        def handle(type, value, traceback):
+            self.stop(value)
+            return True
+        return tornado.stack_context.ExceptionStackContext(handle)
+
+    def test_passes_result_to_callback(self):
+        pool = self.make_pool(1)
+        pool.submit(self.stop, _sleep, 0, "done")
+        self.assertEqual(self.wait(), "done")
+        self.assertEqual(pool.pending(), 0)
+
+    def test_reraises_in_submitter_context(self):
+        pool = self.make_pool(1)
+        with self.catch():
+            pool.submit(lambda result: self.fail("callback ran"), _fail)
+        self.assertTrue(isinstance(self.wait(), ValueError))
+
+    def test_discards_result_of_timed_out_job(self):
+        pool = self.make_pool(1, timeout=0.1, on_discard=self.stop)
+        with self.catch():
+            pool.submit(lambda result: self.fail("callback ran"), _sleep,
+                        0.5, "late")
+        self.assertTrue(isinstance(self.wait(), workers.JobTimeoutError))
+        # The process is still busy, so the job still counts
+        self.assertEqual(pool.pending(), 1)
+        self.assertEqual(self.wait(), "late")
+        self.assertEqual(pool.pending(), 0)
+
+    def test_raises_when_queue_is_full(self):
+        pool = self.make_pool(1, max_queue=1)
+        pool.submit(self.stop, _sleep, 0.1, None)
+        self.assertRaises(workers.PoolFullError, pool.submit,
+                          lambda r: None, _sleep, 0, None)
+        self.wait()
+
+    def test_replacements_close_added_fds(self):
+        pool = self.make_pool(1, max_jobs=1)
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(1)
+        pool.add_close_fds([sock.fileno()])
+        # The first process was forked before the socket existed
+        pool.submit(self.stop, _sleep, 0, None)
+        self.wait()
+        pool.submit(self.stop, _is_open, sock.fileno())
+        self.assertFalse(self.wait())
+
+
+def _sleep(seconds, value):
+    time.sleep(seconds)
+    return value
+
+
+def _fail():
+    raise ValueError("boom")
+
+
+def _is_open(fd):
+    try:
+        os.fstat(fd)
+        return True
+    except OSError:
+        return False
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+-- Copyright 2011 Bret Taylor
+--
+-- Licensed under the Apache License, Version 2.0 (the "License"); you may
+-- not use this file except in compliance with the License. You may obtain
+-- a copy of the License at
+--
+--     http://www.apache.org/licenses/LICENSE-2.0
+--
+-- Unless required by applicable law or agreed to in writing, software
+-- distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+-- WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+-- License for the specific language governing permissions and limitations
+-- under the License.
+
+-- Brings a database created from an older schema.sql up to date without
+-- dropping any rows. Load it once, and then fill in the new tables and
+-- columns as described in the README. New databases should load
+-- schema.sql instead.
+
+SET SESSION storage_engine = "InnoDB";
+SET SESSION time_zone = "+0:00";
+
+ALTER TABLE cookbook_recipes
+    ADD COLUMN description_html MEDIUMTEXT NOT NULL AFTER instructions,
+    ADD COLUMN ingredients_html MEDIUMTEXT NOT NULL AFTER description_html,
+    ADD COLUMN instructions_html MEDIUMTEXT NOT NULL AFTER ingredients_html,
+    ADD COLUMN html_version INT NOT NULL DEFAULT 0 AFTER instructions_html,
+    ADD KEY (updated);
+
+ALTER TABLE cookbook_friends
+    ADD KEY (created);
+
+ALTER TABLE cookbook_clipped
+    DROP KEY recipe_id,
+    ADD KEY recipe_id (recipe_id, created),
+    ADD KEY (created);
+
+ALTER TABLE cookbook_cooked
+    DROP KEY recipe_id,
+    ADD KEY recipe_id (recipe_id, created);
+
+CREATE TABLE IF NOT EXISTS cookbook_activity (
+    user_id VARCHAR(25) NOT NULL REFERENCES cookbook_users(id),
+    actor_id VARCHAR(25) NOT NULL REFERENCES cookbook_users(id),
+    recipe_id INT NOT NULL REFERENCES cookbook_recipes(id),
+    action VARCHAR(25) NOT NULL,
+    created TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, created, actor_id, recipe_id, action)
+);
+
+CREATE TABLE IF NOT EXISTS cookbook_counts (
+    recipe_id INT NOT NULL PRIMARY KEY REFERENCES cookbook_recipes(id),
+    clips INT NOT NULL DEFAULT 0,
+    cooks INT NOT NULL DEFAULT 0
+);
+
+-- cookbook_categories keys on the first 255 characters of the category,
+-- which is all create_recipe and update_recipe now keep
+UPDATE cookbook_recipes SET category = LEFT(category, 255)
+    WHERE CHAR_LENGTH(category) > 255;
+
+CREATE TABLE IF NOT EXISTS cookbook_categories (
+    user_id VARCHAR(25) NOT NULL,
+    category VARCHAR(512) NOT NULL,
+    recipes INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, category(255))
+);
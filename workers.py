@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Bret Taylor
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Worker pools that run blocking jobs off of the Tornado IOLoop"""
+
+import functools
+import logging
+import multiprocessing
+import os
+import Queue
+import sys
+import threading
+import time
+import tornado.ioloop
+import tornado.stack_context
+import traceback
+
+
+class PoolFullError(Exception):
+    """Raised when a job is submitted to a pool whose queue is full"""
+    pass
+
+
+class JobTimeoutError(Exception):
+    """Raised when a job does not finish within its pool's timeout"""
+    pass
+
+
+class ThreadPool(object):
+    """A fixed number of threads that run jobs submitted from the IOLoop.
+
+    submit() runs a function on one of the threads and passes its result
+    to a callback on the IOLoop. If the function raises an exception, we
+    re-raise it on the IOLoop in the stack context of the submit() call,
+    so a RequestHandler that submits a job handles its errors as if it
+    had called the function itself.
+
+    If max_queue is given, at most that many jobs may wait for a thread,
+    and submit() raises PoolFullError beyond that.
+    """
+    def __init__(self, num_threads, max_queue=0, io_loop=None):
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self._queue = Queue.Queue(max_queue)
+        self._threads = []
+        for i in xrange(num_threads):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, callback, fn, *args, **kwargs):
+        callback = tornado.stack_context.wrap(callback)
+        on_error = tornado.stack_context.wrap(_reraise)
+        try:
+            self._queue.put_nowait((fn, args, kwargs, callback, on_error))
+        except Queue.Full:
+            raise PoolFullError("%d jobs already queued" % self._queue.qsize())
+
+    def pending(self):
+        """Returns the number of jobs waiting for a thread"""
+        return self._queue.qsize()
+
+    def wait(self, timeout):
+        """Waits up to timeout seconds for every submitted job to finish.
+
+        Returns whether they all finished. Their callbacks run on the IOLoop
+        as usual, so they won't have run yet if we're called from it.
+        """
+        deadline = time.time() + timeout
+        done = self._queue.all_tasks_done
+        with done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                done.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            fn, args, kwargs, callback, on_error = self._queue.get()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                self.io_loop.add_callback(
+                    functools.partial(on_error, sys.exc_info()))
+            else:
+                self.io_loop.add_callback(functools.partial(callback, result))
+            finally:
+                self._queue.task_done()
+
+
+class ProcessPool(object):
+    """A fixed number of processes that run CPU-bound jobs from the IOLoop.
+
+    submit() works like ThreadPool.submit(), but the function runs in another
+    process, so it must be a module-level function, and its arguments and
+    result must be picklable.
+
+    If timeout is given, a job that takes longer than that many seconds
+    raises JobTimeoutError on the IOLoop. We can't interrupt the process
+    running it, but we throw away its result when it finishes, passing it
+    to on_discard if given, so the caller can release what it holds, like
+    temporary files. Until then the job still counts toward max_queue.
+    Each process exits after max_jobs jobs, so a leak in a job can't grow
+    forever.
+
+    Create the pool before starting any threads or creating the IOLoop,
+    since the processes are forked from the current one. They close the
+    file descriptors in close_fds, like listening sockets, when they start.
+    The processes that replace them are forked from whatever this process
+    has become, so pass descriptors opened after the pool, like a socket
+    we listen on later, to add_close_fds().
+    """
+    def __init__(self, num_processes, max_queue=0, timeout=None,
+                 max_jobs=1000, close_fds=(), on_discard=None,
+                 io_loop=None):
+        # The processes read this list when they start, so descriptors
+        # added to it later are closed by the replacements too
+        self._close_fds = list(close_fds)
+        self._pool = multiprocessing.Pool(
+            num_processes, initializer=_close_fds,
+            initargs=(self._close_fds,), maxtasksperchild=max_jobs)
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.on_discard = on_discard
+        self._pending = 0
+
+    def submit(self, callback, fn, *args, **kwargs):
+        if self.max_queue and self._pending >= self.max_queue:
+            raise PoolFullError("%d jobs already queued" % self._pending)
+        self._pending += 1
+        callback = tornado.stack_context.wrap(callback)
+        on_error = tornado.stack_context.wrap(_reraise)
+        job = {"finished": False, "timeout": None}
+
+        def finish(result):
+            if job["finished"]:
+                return
+            job["finished"] = True
+            ok, value = result
+            if ok:
+                callback(value)
+            else:
+                on_error(value)
+
+        def on_done(result):
+            # The process is free again, even if the job already timed out
+            self._pending -= 1
+            if job["timeout"]:
+                self.io_loop.remove_timeout(job["timeout"])
+            ok, value = result
+            if job["finished"] and ok and self.on_discard:
+                with tornado.stack_context.NullContext():
+                    self.on_discard(value)
+            finish(result)
+
+        def on_result(result):
+            # Called on the multiprocessing result thread
+            self.io_loop.add_callback(functools.partial(on_done, result))
+
+        if self.timeout:
+            error = JobTimeoutError("%s took more than %ss" %
+                                    (fn.__name__, self.timeout))
+            job["timeout"] = self.io_loop.add_timeout(
+                time.time() + self.timeout, functools.partial(
+                    finish, (False, (JobTimeoutError, error, None))))
+        self._pool.apply_async(_call, (fn, args, kwargs), callback=on_result)
+
+    def pending(self):
+        """Returns the number of jobs submitted whose processes haven't
+        returned yet.
+        """
+        return self._pending
+
+    def add_close_fds(self, fds):
+        """Makes processes started from now on close the given descriptors.
+        """
+        self._close_fds.extend(fds)
+
+    def close(self):
+        """Stops the processes, abandoning any jobs they are running."""
+        self._pool.terminate()
+
+
+def _close_fds(fds):
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+def _call(fn, args, kwargs):
+    """Runs a ProcessPool job, returning an (ok, value) tuple.
+
+    Tracebacks can't be pickled, so we log them here and send back only the
+    exception.
+    """
+    try:
+        return True, fn(*args, **kwargs)
+    except Exception, e:
+        logging.error("Error in %s: %s", fn.__name__, traceback.format_exc())
+        return False, (type(e), e, None)
+
+
+def _reraise(exc_info):
+    raise exc_info[0], exc_info[1], exc_info[2]